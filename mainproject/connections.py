@@ -0,0 +1,125 @@
+# This file is covered by the BSD license. See LICENSE in the root directory.
+"""Health checks for persistent database connections and a pool.
+
+With CONN_MAX_AGE > 0, a connection is kept open across requests. A
+connection that has been dropped by the database server in between
+(e.g., after MySQL's wait_timeout) would then fail the next request.
+ConnectionHealthMiddleware therefore checks reused connections at the
+beginning of each request and closes those that no longer work, so
+that Django opens a new one. This is done for databases with
+CONN_HEALTH_CHECKS set.
+
+Persistent connections belong to a thread. For threaded deployments
+(e.g., gunicorn with --threads), the pooled_mysql backend instead
+returns connections into a pool shared by all threads of the process
+when Django closes them at the end of a request, and takes them from
+the pool when Django opens a connection.
+
+"""
+import threading
+import time
+
+from django.db import connections
+
+DEFAULT_POOL_SIZE = 10
+
+_lock = threading.Lock()
+pools = {}
+
+
+class ConnectionHealthMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        for connection in connections.all():
+            if (connection.connection is not None and
+                    connection.settings_dict.get('CONN_HEALTH_CHECKS') and
+                    not connection.is_usable()):
+                connection.close()
+        return self.get_response(request)
+
+
+def is_usable(raw_connection):
+    """Return whether a DB-API connection still works."""
+    try:
+        cursor = raw_connection.cursor()
+        try:
+            cursor.execute('SELECT 1')
+        finally:
+            cursor.close()
+        return True
+    except Exception:
+        return False
+
+
+def close_quietly(raw_connection):
+    try:
+        raw_connection.close()
+    except Exception:
+        pass
+
+
+class ConnectionPool:
+    """Idle DB-API connections of one database, most recently used first.
+
+    Connections idle for longer than max_idle seconds are closed
+    instead of being reused.
+    """
+    def __init__(self, size=DEFAULT_POOL_SIZE, max_idle=300):
+        self.size = size
+        self.max_idle = max_idle
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Return a working idle connection or None."""
+        while True:
+            with self.lock:
+                if not self.idle:
+                    return None
+                raw_connection, released = self.idle.pop()
+            if (time.monotonic() - released < self.max_idle and
+                    is_usable(raw_connection)):
+                return raw_connection
+            close_quietly(raw_connection)
+
+    def release(self, raw_connection):
+        """Put the connection back or close it if the pool is full."""
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append((raw_connection, time.monotonic()))
+                return
+        close_quietly(raw_connection)
+
+    def clear(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for raw_connection, _ in idle:
+            close_quietly(raw_connection)
+
+
+def get_pool(alias, settings_dict):
+    with _lock:
+        if alias not in pools:
+            pools[alias] = ConnectionPool(
+                settings_dict.get('POOL_SIZE', DEFAULT_POOL_SIZE))
+        return pools[alias]
+
+
+class PooledDatabaseWrapperMixin:
+    """Take connections from the pool and put them back on close."""
+    def get_new_connection(self, conn_params):
+        raw_connection = get_pool(self.alias, self.settings_dict).acquire()
+        if raw_connection is None:
+            raw_connection = super().get_new_connection(conn_params)
+        return raw_connection
+
+    def _close(self):
+        if self.in_atomic_block or self.errors_occurred:
+            return super()._close()
+        try:
+            self.connection.rollback()
+        except Exception:
+            return super()._close()
+        get_pool(self.alias, self.settings_dict).release(self.connection)
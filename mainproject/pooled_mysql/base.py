@@ -0,0 +1,9 @@
+# This file is covered by the BSD license. See LICENSE in the root directory.
+"""MySQL backend whose connections are pooled (see connections.py)."""
+from django.db.backends.mysql import base
+
+from mainproject.connections import PooledDatabaseWrapperMixin
+
+
+class DatabaseWrapper(PooledDatabaseWrapperMixin, base.DatabaseWrapper):
+    pass
@@ -0,0 +1,159 @@
+# This file is covered by the BSD license. See LICENSE in the root directory.
+"""Profile single requests on demand.
+
+A staff user can add ?profile=1 to any URL (or send the header
+X-Profile: 1) to run that request under cProfile. The profile is saved
+in PROFILE_DIR as <name>.prof (readable with pstats or snakeviz)
+together with <name>.json, which contains the request metadata and the
+SQL queries with their durations. The profiles are listed and can be
+downloaded only at /admin/profiles/, as PROFILE_DIR is not served.
+
+"""
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import re
+import time
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+# Older profiles are removed beyond this number
+MAX_PROFILES = 100
+# Only this many queries are stored in the SQL trace
+MAX_QUERIES = 10000
+SORT_KEYS = ('cumulative', 'tottime', 'ncalls')
+
+
+def profile_directory():
+    return settings.PROFILE_DIR
+
+
+def profile_path(name, extension):
+    """Return the path of a profile file; name must not contain slashes."""
+    if not re.fullmatch(r'[\w.-]+', name):
+        raise ValueError(f'Invalid profile name: {name}')
+    return os.path.join(profile_directory(), f'{name}.{extension}')
+
+
+class SqlTrace:
+    """Database execute wrapper that records the queries and their times."""
+    def __init__(self):
+        self.queries = []
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            if len(self.queries) < MAX_QUERIES:
+                self.queries.append({
+                    'sql': sql,
+                    'ms': round((time.perf_counter() - start)*1000, 3),
+                })
+
+
+def list_profiles():
+    """Return the metadata of all profiles, newest first."""
+    directory = profile_directory()
+    if not os.path.isdir(directory):
+        return []
+    profiles = []
+    for filename in sorted(os.listdir(directory), reverse=True):
+        if filename.endswith('.json'):
+            with open(os.path.join(directory, filename)) as f:
+                metadata = json.load(f)
+            del metadata['queries']
+            profiles.append(metadata)
+    return profiles
+
+
+def load_profile(name):
+    with open(profile_path(name, 'json')) as f:
+        return json.load(f)
+
+
+def summarize(name, sort='cumulative', limit=40):
+    """Return the hottest functions of the profile as text."""
+    if sort not in SORT_KEYS:
+        raise ValueError(f'Invalid sort key: {sort}')
+    output = io.StringIO()
+    stats = pstats.Stats(profile_path(name, 'prof'), stream=output)
+    stats.strip_dirs().sort_stats(sort).print_stats(limit)
+    return output.getvalue()
+
+
+def remove_old_profiles():
+    directory = profile_directory()
+    names = sorted({os.path.splitext(filename)[0]
+                    for filename in os.listdir(directory)})
+    for name in names[:-MAX_PROFILES]:
+        for extension in 'prof', 'json':
+            path = os.path.join(directory, f'{name}.{extension}')
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def wants_profile(request):
+    return (request.GET.get('profile') or
+            request.META.get('HTTP_X_PROFILE')) and (
+                request.user.is_authenticated and request.user.is_staff)
+
+
+class ProfilingMiddleware:
+    """Run requests under cProfile if asked to (see the module docstring).
+
+    Must come after AuthenticationMiddleware in MIDDLEWARE.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not wants_profile(request):
+            return self.get_response(request)
+        profiler = cProfile.Profile()
+        trace = SqlTrace()
+        started = timezone.now()
+        start = time.perf_counter()
+        with ExitStack() as stack:
+            for alias in connections:
+                stack.enter_context(connections[alias].execute_wrapper(trace))
+            response = profiler.runcall(self.get_response, request)
+        total_time = time.perf_counter() - start
+        match = getattr(request, 'resolver_match', None)
+        view = match.view_name if match else ''
+        name = (started.strftime('%Y%m%d-%H%M%S-%f') + '-' +
+                re.sub(r'[^\w-]', '_', view or 'unresolved'))
+        try:
+            os.makedirs(profile_directory(), exist_ok=True)
+            profiler.dump_stats(profile_path(name, 'prof'))
+            with open(profile_path(name, 'json'), 'w') as f:
+                json.dump({
+                    'name': name,
+                    'started': started.isoformat(),
+                    'method': request.method,
+                    'path': request.get_full_path(),
+                    'view': view,
+                    'user': request.user.username,
+                    'status': response.status_code,
+                    'total_ms': round(total_time*1000, 2),
+                    'sql_count': trace.count,
+                    'sql_ms': round(sum(query['ms']
+                                        for query in trace.queries), 2),
+                    'queries': trace.queries,
+                }, f, indent=1)
+            remove_old_profiles()
+        except OSError as error:
+            logger.warning(f'Could not save the profile {name}: {error}')
+            return response
+        response['X-Profile'] = name
+        return response
@@ -0,0 +1,92 @@
+# This file is covered by the BSD license. See LICENSE in the root directory.
+"""Send the reads of safe requests to read replicas.
+
+The replicas are the databases listed in DATABASE_REPLICAS. Reads go
+to a replica only while ReplicaMiddleware is processing a GET, HEAD,
+or OPTIONS request, so that writes and everything outside of requests
+(management commands, ingestion jobs) keep using the primary database.
+The replica is chosen at random once per request, so that all queries
+of a request see the data at the same point of replication. Views
+that must see the latest data even on GET are decorated with
+use_primary.
+
+Replicas lag behind the primary. A user who has just written something
+(any request with an unsafe method) gets a cookie that makes their
+requests read from the primary for REPLICA_PIN_SECONDS, so that they
+see their own changes. For the same reason, values cached from replica
+reads expire after REPLICA_CACHE_TIMEOUT (see materials/caching.py).
+
+"""
+import random
+import threading
+from functools import wraps
+
+from django.conf import settings
+
+PIN_COOKIE = 'use_primary'
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+# Apps that are always read from the primary because they are written
+# during safe requests
+PRIMARY_APPS = ('django_cache', 'sessions')
+
+_local = threading.local()
+
+
+def reading_from_replica():
+    """Return whether reads currently go to a replica."""
+    return getattr(_local, 'replica', None) is not None
+
+
+def is_pinned(request):
+    """Return whether the user reads from the primary after a write."""
+    return PIN_COOKIE in request.COOKIES
+
+
+def use_primary(view):
+    """Make the view read from the primary database."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        return view(*args, **kwargs)
+    wrapper.use_primary = True
+    return wrapper
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if (reading_from_replica() and
+                model._meta.app_label not in PRIMARY_APPS):
+            return _local.replica
+        return 'default'
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, **hints):
+        return db not in settings.DATABASE_REPLICAS
+
+
+class ReplicaMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        _local.replica = None
+        if (request.method in SAFE_METHODS and not is_pinned(request) and
+                settings.DATABASE_REPLICAS):
+            _local.replica = random.choice(settings.DATABASE_REPLICAS)
+        try:
+            response = self.get_response(request)
+        finally:
+            _local.replica = None
+        if request.method not in SAFE_METHODS and settings.DATABASE_REPLICAS:
+            response.set_cookie(PIN_COOKIE, '1',
+                                max_age=settings.REPLICA_PIN_SECONDS,
+                                httponly=True, samesite='Lax')
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if getattr(view_func, 'use_primary', False):
+            _local.replica = None
@@ -48,11 +48,16 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'mainproject.connections.ConnectionHealthMiddleware',
+    'mainproject.replicas.ReplicaMiddleware',
+    'mainproject.timing.RequestTimingMiddleware',
+    'mainproject.slowqueries.SlowQueryMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'mainproject.profiling.ProfilingMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -80,6 +85,9 @@ WSGI_APPLICATION = 'mainproject.wsgi.application'
 
 # Database
 USE_SQLITE = config('USE_SQLITE', default=False, cast=bool)
+# With DB_POOL, MySQL connections are shared between the threads of a
+# worker (see mainproject/connections.py)
+DB_POOL = config('DB_POOL', default=False, cast=bool)
 if USE_SQLITE:
     DATABASES = {
         'default': {
@@ -90,14 +98,85 @@ if USE_SQLITE:
 else:
     DATABASES = {
         'default': {
-            'ENGINE': 'django.db.backends.mysql',
+            'ENGINE': ('mainproject.pooled_mysql' if DB_POOL else
+                       'django.db.backends.mysql'),
             'NAME': 'materials',
             'USER': config('DB_USER', default=''),
             'PASSWORD': config('DB_PASSWORD', default=''),
             'HOST': 'localhost',
             'PORT': '',
+            'POOL_SIZE': config('DB_POOL_SIZE', default=10, cast=int),
         }
     }
+# Seconds to keep a connection open across requests (0 closes it after
+# each request, which returns it to the pool with DB_POOL). Reused
+# connections are checked at the beginning of each request if
+# CONN_HEALTH_CHECKS is set.
+DATABASES['default']['CONN_MAX_AGE'] = config(
+    'DB_CONN_MAX_AGE', default=0 if DB_POOL else 60, cast=int)
+DATABASES['default']['CONN_HEALTH_CHECKS'] = config(
+    'DB_HEALTH_CHECKS', default=True, cast=bool)
+# Read replicas of the default database: comma-separated host names for
+# MySQL or database files for SQLite (see mainproject/replicas.py)
+DATABASE_REPLICAS = []
+for i_replica, replica in enumerate(
+        config('DB_REPLICAS', default='', cast=Csv())):
+    alias = f'replica{i_replica + 1}'
+    DATABASES[alias] = dict(DATABASES['default'], TEST={'MIRROR': 'default'})
+    DATABASES[alias]['NAME' if USE_SQLITE else 'HOST'] = replica
+    DATABASE_REPLICAS.append(alias)
+DATABASE_ROUTERS = ['mainproject.replicas.ReplicaRouter']
+# Seconds after writing during which a user reads from the primary
+REPLICA_PIN_SECONDS = config('REPLICA_PIN_SECONDS', default=10, cast=int)
+# Maximum timeout of cached values computed from replica reads
+REPLICA_CACHE_TIMEOUT = config('REPLICA_CACHE_TIMEOUT', default=60, cast=int)
+
+# Cache shared by all workers (see materials/caching.py). CACHE_BACKEND
+# is "file", "database" (run ./manage.py createcachetable first),
+# "redis" (requires the django-redis package), or "locmem". The
+# default is a file cache if CACHE_LOCATION is set and otherwise a
+# cache in the memory of each process, which is not shared between
+# workers and so only suits development and tests.
+CACHE_LOCATION = config('CACHE_LOCATION', default='')
+CACHE_BACKEND = config('CACHE_BACKEND',
+                       default='file' if CACHE_LOCATION else 'locmem')
+if CACHE_BACKEND == 'redis':
+    CACHES = {
+        'default': {
+            'BACKEND': 'django_redis.cache.RedisCache',
+            'LOCATION': CACHE_LOCATION or 'redis://127.0.0.1:6379/1',
+        }
+    }
+elif CACHE_BACKEND == 'database':
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+            'LOCATION': CACHE_LOCATION or 'matd3_cache',
+            'OPTIONS': {'MAX_ENTRIES': 10000},
+        }
+    }
+elif CACHE_BACKEND == 'file':
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': CACHE_LOCATION or '/var/tmp/matd3_cache',
+            'OPTIONS': {'MAX_ENTRIES': 10000},
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'OPTIONS': {'MAX_ENTRIES': 10000},
+        }
+    }
+CACHES['default']['TIMEOUT'] = config('CACHE_TIMEOUT', default=3600,
+                                      cast=int)
+CACHES['default']['KEY_PREFIX'] = 'matd3'
+
+# Directory under the web root for pre-rendered compound pages (see
+# materials/prerender.py); empty to disable pre-rendering
+PRERENDER_ROOT = config('PRERENDER_ROOT', default='')
 
 # Password validation
 
@@ -172,6 +251,24 @@ MESSAGE_TAGS = {
 
 # Logging
 
+# Directories for log files and for the state kept between runs of
+# management commands, outside of the source tree
+LOG_DIR = config('LOG_DIR', default='/var/log/matd3')
+STATE_DIR = config('STATE_DIR', default='/var/lib/matd3')
+# Request profiles (see mainproject/profiling.py), which must not be
+# served with the media files
+PROFILE_DIR = config('PROFILE_DIR',
+                     default=os.path.join(STATE_DIR, 'profiles'))
+
+# Queries taking longer than this (in ms) are written to SLOW_QUERY_LOG,
+# or to the console unless the log directory exists or is configured
+SLOW_QUERY_THRESHOLD = config('SLOW_QUERY_THRESHOLD', default=100,
+                              cast=float)
+SLOW_QUERY_LOG = config('SLOW_QUERY_LOG', default='')
+if not SLOW_QUERY_LOG and (config('LOG_DIR', default='') or
+                           os.path.isdir(LOG_DIR)):
+    SLOW_QUERY_LOG = os.path.join(LOG_DIR, 'slow_queries.jsonl')
+
 RAVEN_CONFIG = {
     'dsn': config('RAVEN_DSN', default=''),
     'release': raven.fetch_git_sha(BASE_DIR),
@@ -185,12 +282,25 @@ LOGGING = {
             'format': '{levelname} - {asctime} - {module} - {message}',
             'style': '{',
         },
+        'message': {
+            'format': '{message}',
+            'style': '{',
+        },
     },
     'handlers': {
         'console': {
             'class': 'logging.StreamHandler',
             'formatter': 'verbose',
         },
+        'slow_queries': {
+            'class': 'logging.FileHandler',
+            'filename': SLOW_QUERY_LOG,
+            'formatter': 'message',
+            'delay': True,
+        } if SLOW_QUERY_LOG else {
+            'class': 'logging.StreamHandler',
+            'formatter': 'message',
+        },
         'sentry': {
             'level': 'WARNING',
             'class':
@@ -203,6 +313,18 @@ LOGGING = {
             'level': os.getenv('DJANGO_LOG_LEVEL', 'INFO'),
             'propagate': True,
         },
+        # One JSON line per request with its SQL and template timings
+        'mainproject.timing': {
+            'handlers': ['console'],
+            'level': os.getenv('DJANGO_LOG_LEVEL', 'INFO'),
+            'propagate': False,
+        },
+        # One JSON line per slow query (see mainproject/slowqueries.py)
+        'mainproject.slowqueries': {
+            'handlers': ['slow_queries'],
+            'level': 'WARNING',
+            'propagate': False,
+        },
         '': {
             'handlers': ['sentry'],
             'level': os.getenv('DJANGO_LOG_LEVEL', 'INFO'),
@@ -224,3 +346,38 @@ SELENIUM_DRIVER = config('SELENIUM_DRIVER', default='firefox').lower()
 
 # Import-export
 IMPORT_EXPORT_USE_TRANSACTIONS = True
+
+# Ingestion
+
+# If true, all submitted data is queued and written to the database by
+# the process_ingestion_jobs management command.
+ASYNC_INGESTION = config('ASYNC_INGESTION', default=False, cast=bool)
+# How long (in seconds) an idle worker waits before polling the queue again
+INGESTION_POLL_INTERVAL = config('INGESTION_POLL_INTERVAL', default=2,
+                                 cast=float)
+
+# Change feed
+
+# Changes younger than this many seconds are not yet listed in the
+# change feed, which gives transactions in progress time to commit.
+CHANGE_FEED_DELAY = config('CHANGE_FEED_DELAY', default=60, cast=int)
+CHANGE_FEED_MAX_LIMIT = 1000
+
+# Similarity search
+
+# Maximum number of results of the similar structures endpoint
+SIMILARITY_MAX_RESULTS = 100
+
+# 3D viewer
+
+# How long (in seconds) browsers may use the structures loaded by the
+# 3D viewer before revalidating them
+VIEWER_MAX_AGE = config('VIEWER_MAX_AGE', default=86400, cast=int)
+
+# Tolerance factor chart
+
+# Tolerance factors in the viewport above which the chart shows a
+# histogram instead of the individual points
+TF_MAX_POINTS = config('TF_MAX_POINTS', default=2000, cast=int)
+# Maximum number of histogram bins along each axis that can be requested
+TF_MAX_BINS = 256
@@ -0,0 +1,94 @@
+# This file is covered by the BSD license. See LICENSE in the root directory.
+"""Log slow SQL queries together with the code that issued them.
+
+SlowQueryMiddleware wraps every query made during a request. Queries
+that take longer than SLOW_QUERY_THRESHOLD milliseconds are recorded
+with the request path and the innermost stack frame within the project
+(e.g., the line in materials/views.py that evaluated the queryset), so
+that entries of the database's own slow log can be traced back to the
+code. The records are kept in an in-memory ring buffer, shown at
+/admin/timing/, and written as JSON lines to the mainproject.slowqueries
+logger, whose file is summarized by ./manage.py slow_queries.
+
+"""
+import json
+import logging
+import os
+import time
+import traceback
+from collections import deque
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+BUFFER_SIZE = 200
+MAX_SQL_LENGTH = 2000
+recent = deque(maxlen=BUFFER_SIZE)
+# Middleware and execute wrappers whose frames are not call sites
+INSTRUMENTATION = ('profiling', 'slowqueries', 'timing')
+
+
+def project_frames():
+    """Return the stack frames that belong to this project, innermost last.
+
+    Frames of installed packages and of the instrumentation modules
+    are skipped.
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    skipped = {os.path.join(directory, f'{name}.py')
+               for name in INSTRUMENTATION}
+    frames = []
+    for frame in traceback.extract_stack():
+        filename = os.path.abspath(frame.filename)
+        if (not filename.startswith(settings.BASE_DIR) or
+                'site-packages' in filename or filename in skipped):
+            continue
+        frames.append(
+            f'{os.path.relpath(filename, settings.BASE_DIR)}:'
+            f'{frame.lineno} in {frame.name}')
+    return frames
+
+
+class SlowQueryRecorder:
+    """Database execute wrapper that records queries above the threshold."""
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = (time.perf_counter() - start)*1000
+            if duration >= settings.SLOW_QUERY_THRESHOLD:
+                self.record(sql, duration)
+
+    def record(self, sql, duration):
+        frames = project_frames()
+        record = {
+            'time': timezone.now().isoformat(),
+            'ms': round(duration, 2),
+            'path': self.path,
+            'site': frames[-1] if frames else '',
+            'stack': frames[-5:],
+            'sql': sql[:MAX_SQL_LENGTH],
+        }
+        recent.append(record)
+        logger.warning(json.dumps(record))
+
+
+class SlowQueryMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        recorder = SlowQueryRecorder(request.path)
+        with ExitStack() as stack:
+            for alias in connections:
+                stack.enter_context(
+                    connections[alias].execute_wrapper(recorder))
+            return self.get_response(request)
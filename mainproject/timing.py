@@ -0,0 +1,181 @@
+# This file is covered by the BSD license. See LICENSE in the root directory.
+"""Per-request timing of SQL queries, template rendering, and views.
+
+RequestTimingMiddleware measures for each request the number of SQL
+queries, the time spent in them, the time spent rendering templates,
+and the total time. The numbers are sent to the client in a
+Server-Timing header (shown by the network panel of the browser), are
+logged as a JSON line, and are aggregated into per-view histograms of
+the total time. The histograms are kept in memory and are thus per
+worker process; they are shown to staff at /admin/timing/.
+
+"""
+import functools
+import json
+import logging
+import threading
+import time
+from contextlib import ExitStack
+
+from django.db import connections
+from django.template.backends.django import Template
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds (ms) of the histogram buckets. The last bucket collects
+# everything slower.
+BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+_local = threading.local()
+_lock = threading.Lock()
+histograms = {}
+
+
+class RequestTiming:
+    """Timings of a single request.
+
+    Also serves as the database execute wrapper that counts the
+    queries.
+    """
+    def __init__(self):
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.template_time = 0.0
+        self.total_time = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.sql_count += 1
+            self.sql_time += time.perf_counter() - start
+
+
+class ViewHistogram:
+    """Aggregated timings of all requests to one view."""
+    def __init__(self):
+        self.count = 0
+        self.buckets = [0]*(len(BUCKETS) + 1)
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.sql_time = 0.0
+        self.sql_count = 0
+        self.max_sql_count = 0
+        self.template_time = 0.0
+
+    def add(self, timing):
+        self.count += 1
+        total_ms = timing.total_time*1000
+        i_bucket = 0
+        while i_bucket < len(BUCKETS) and total_ms > BUCKETS[i_bucket]:
+            i_bucket += 1
+        self.buckets[i_bucket] += 1
+        self.total_time += timing.total_time
+        self.max_time = max(self.max_time, timing.total_time)
+        self.sql_time += timing.sql_time
+        self.sql_count += timing.sql_count
+        self.max_sql_count = max(self.max_sql_count, timing.sql_count)
+        self.template_time += timing.template_time
+
+    def as_dict(self):
+        """Return the histogram with times converted to mean values in ms."""
+        return {
+            'count': self.count,
+            'buckets': dict(zip(
+                [f'<={bound}ms' for bound in BUCKETS] + [
+                    f'>{BUCKETS[-1]}ms'], self.buckets)),
+            'mean_total_ms': round(self.total_time/self.count*1000, 2),
+            'max_total_ms': round(self.max_time*1000, 2),
+            'mean_sql_ms': round(self.sql_time/self.count*1000, 2),
+            'mean_sql_count': round(self.sql_count/self.count, 2),
+            'max_sql_count': self.max_sql_count,
+            'mean_template_ms': round(
+                self.template_time/self.count*1000, 2),
+        }
+
+
+def get_histograms():
+    """Return a snapshot of the histograms, slowest views first."""
+    with _lock:
+        stats = {view: histogram.as_dict()
+                 for view, histogram in histograms.items()}
+    return dict(sorted(stats.items(),
+                       key=lambda item: -item[1]['mean_total_ms']))
+
+
+def reset_histograms():
+    with _lock:
+        histograms.clear()
+
+
+def instrument_templates():
+    """Make template rendering add its duration to the current request."""
+    if getattr(Template.render, 'timed', False):
+        return
+    render = Template.render
+
+    @functools.wraps(render)
+    def timed_render(self, *args, **kwargs):
+        timing = getattr(_local, 'timing', None)
+        if timing is None:
+            return render(self, *args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return render(self, *args, **kwargs)
+        finally:
+            timing.template_time += time.perf_counter() - start
+    timed_render.timed = True
+    Template.render = timed_render
+
+
+def view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return '<unresolved>'
+    return match.view_name or match._func_path
+
+
+class RequestTimingMiddleware:
+    """Measure each request (see the module docstring).
+
+    Should be placed first in MIDDLEWARE so that the total time
+    includes the other middleware. For streaming responses only the
+    time until the response starts is measured.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+        instrument_templates()
+
+    def __call__(self, request):
+        timing = RequestTiming()
+        _local.timing = timing
+        start = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for alias in connections:
+                    stack.enter_context(
+                        connections[alias].execute_wrapper(timing))
+                response = self.get_response(request)
+        finally:
+            _local.timing = None
+        timing.total_time = time.perf_counter() - start
+        view = view_name(request)
+        with _lock:
+            histograms.setdefault(view, ViewHistogram()).add(timing)
+        response['Server-Timing'] = (
+            f'sql;desc="{timing.sql_count} queries";'
+            f'dur={timing.sql_time*1000:.1f}, '
+            f'template;dur={timing.template_time*1000:.1f}, '
+            f'total;dur={timing.total_time*1000:.1f}')
+        logger.info(json.dumps({
+            'view': view,
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'sql_count': timing.sql_count,
+            'sql_ms': round(timing.sql_time*1000, 2),
+            'template_ms': round(timing.template_time*1000, 2),
+            'total_ms': round(timing.total_time*1000, 2),
+        }))
+        return response
@@ -13,6 +13,15 @@ from . import views
 
 
 urlpatterns = [
+    path('admin/timing/', admin.site.admin_view(views.request_timing),
+         name='request_timing'),
+    path('admin/profiles/', admin.site.admin_view(views.profiles),
+         name='profiles'),
+    path('admin/profiles/<str:name>',
+         admin.site.admin_view(views.profile_detail), name='profile_detail'),
+    path('admin/profiles/<str:name>/download',
+         admin.site.admin_view(views.profile_download),
+         name='profile_download'),
     path('admin/', admin.site.urls),
     path('', views.index, name='index'),
     path('contact/', generic.TemplateView.as_view(
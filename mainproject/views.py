@@ -1,10 +1,21 @@
+from django.contrib import admin
 from django.contrib.auth import get_user_model
 from django.db.models import Count
 from django.db.models import F
 from django.db.models import Q
+from django.http import FileResponse
+from django.http import Http404
+from django.http import JsonResponse
+from django.shortcuts import redirect
 from django.shortcuts import render
 from django.template import TemplateDoesNotExist
 
+from materials import caching
+
+from . import profiling
+from . import slowqueries
+from . import timing
+
 
 def index(request):
     try:
@@ -13,6 +24,8 @@ def index(request):
         return render(request, 'mainproject/home_default.html')
 
 
+@caching.cache_response('auth.User', 'accounts.UserProfile',
+                        'materials.Dataset')
 def contributors(request):
     User = get_user_model()
     num_created = Count('materials_dataset_created_by', distinct=True)
@@ -39,3 +52,63 @@ def contributors(request):
     return render(request, 'mainproject/contributors.html', {
         'designers': designers, 'contributors': contributors,
     })
+
+
+def request_timing(request):
+    """Show the timing histograms and slow queries of this worker process.
+
+    Add ?format=json for the raw numbers. A POST resets the histograms.
+    """
+    if request.method == 'POST':
+        timing.reset_histograms()
+        return redirect('request_timing')
+    histograms = timing.get_histograms()
+    if request.GET.get('format') == 'json':
+        return JsonResponse(histograms)
+    context = admin.site.each_context(request)
+    context.update({
+        'title': 'Request timing',
+        'histograms': histograms,
+        'buckets': [f'≤{bound}' for bound in timing.BUCKETS] + [
+            f'>{timing.BUCKETS[-1]}'],
+        'slow_queries': reversed(slowqueries.recent),
+    })
+    return render(request, 'mainproject/timing.html', context)
+
+
+def profiles(request):
+    """List the profiles captured with ?profile=1."""
+    context = admin.site.each_context(request)
+    context.update({
+        'title': 'Profiles',
+        'profiles': profiling.list_profiles(),
+    })
+    return render(request, 'mainproject/profiles.html', context)
+
+
+def profile_detail(request, name):
+    """Show the hottest functions and the slowest queries of a profile."""
+    sort = request.GET.get('sort', 'cumulative')
+    try:
+        metadata = profiling.load_profile(name)
+        summary = profiling.summarize(name, sort)
+    except (OSError, ValueError):
+        raise Http404
+    metadata['queries'].sort(key=lambda query: -query['ms'])
+    context = admin.site.each_context(request)
+    context.update({
+        'title': f'Profile of {metadata["path"]}',
+        'profile': metadata,
+        'summary': summary,
+        'sort': sort,
+        'sort_keys': profiling.SORT_KEYS,
+    })
+    return render(request, 'mainproject/profile_detail.html', context)
+
+
+def profile_download(request, name):
+    try:
+        return FileResponse(open(profiling.profile_path(name, 'prof'), 'rb'),
+                            as_attachment=True, filename=f'{name}.prof')
+    except (OSError, ValueError):
+        raise Http404
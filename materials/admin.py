@@ -204,3 +204,15 @@ class BondLengthAdmin(BaseAdmin):
 @admin.register(models.ToleranceFactor)
 class ToleranceFactor(BaseAdmin):
     pass
+
+
+class IngestionFileInline(nested_admin.NestedTabularInline):
+    model = models.IngestionFile
+    extra = 0
+
+
+@admin.register(models.IngestionJob)
+class IngestionJobAdmin(BaseAdmin):
+    list_display = ('state', 'created_by', 'created', 'started', 'finished')
+    list_filter = ('state',)
+    inlines = [IngestionFileInline]
@@ -0,0 +1,148 @@
+# This file is covered by the BSD license. See LICENSE in the root directory.
+"""Time the main endpoints against the data currently in the database.
+
+The requests are made through the Django test client, so the numbers
+include the middleware, views, and templates but not the web server.
+Each endpoint is first requested `repeat` times for the latency
+statistics and then once more with tracemalloc running to find the
+peak memory use, because tracing slows down the requests.
+
+"""
+import tempfile
+import time
+import tracemalloc
+from itertools import cycle
+
+import numpy
+from django.db import close_old_connections
+from django.db import connection
+from django.db import transaction
+from django.db.models import Count
+from django.shortcuts import reverse
+from django.test import Client
+from django.test import override_settings
+from django.utils import timezone
+
+from mainproject import timing
+
+from . import models
+from . import synthetic
+
+ENDPOINT_NAMES = ('search', 'compound', 'dataset_details', 'data_for_chart',
+                  'data_for_tf', 'submit_data')
+
+
+class Rollback(Exception):
+    pass
+
+
+def submit(client, i_request):
+    """Submit a data set and roll it back to leave the database as is."""
+    with tempfile.TemporaryDirectory() as media_root:
+        with override_settings(MEDIA_ROOT=media_root):
+            try:
+                with transaction.atomic():
+                    response = client.post(
+                        reverse('materials:submit_data'),
+                        synthetic.submission(
+                            formula=f'Benchmark{i_request}',
+                            datapoints='\n'.join(
+                                f'{x} {x**2}' for x in range(100))))
+                    raise Rollback
+            except Rollback:
+                pass
+    return response
+
+
+def get_endpoints():
+    """Return (name, function(client, i_request)) for each endpoint.
+
+    The compound with the most subsets is used as the sample.
+    """
+    compound = models.Compound.objects.annotate(
+        n_subsets=Count('datasets__subsets')).order_by('-n_subsets').first()
+    if compound is None:
+        raise ValueError('No data found; run generate_synthetic first.')
+    datasets = cycle(compound.datasets.values_list('pk', flat=True))
+    subsets = cycle(models.Subset.objects.filter(
+        dataset__compound=compound, curves__isnull=False).distinct(
+        ).values_list('pk', flat=True)[:100] or [0])
+    data_sources = cycle(
+        [source for source, _ in models.ToleranceFactor.DATA_SOURCES])
+    return (
+        ('search', lambda client, i: client.post(
+            reverse('materials:search'),
+            {'search_term': 'formula', 'search_text': compound.formula})),
+        ('compound', lambda client, i: client.get(
+            reverse('materials:compound', kwargs={'pk': compound.pk}))),
+        ('dataset_details', lambda client, i: client.get(
+            reverse('materials:dataset_details',
+                    kwargs={'pk': next(datasets)}))),
+        ('data_for_chart', lambda client, i: client.get(
+            reverse('materials:data_for_chart',
+                    kwargs={'pk': next(subsets)}))),
+        ('data_for_tf', lambda client, i: client.get(
+            reverse('materials:tolerance_factor_chart', kwargs={
+                'data_source': next(data_sources),
+                'compound_pk': compound.pk}))),
+        ('submit_data', submit),
+    )
+
+
+def run(user, repeat=20, names=None, close_connections=False):
+    """Run the benchmark and return the results as a dictionary.
+
+    user must be staff in order to submit data. names optionally
+    restricts the endpoints. The test client does not close the
+    database connection after a request, so CONN_MAX_AGE has no effect
+    unless close_connections is set, which closes obsolete connections
+    before and after each request as the handler of a web server does.
+    It must not be set within a transaction.
+    """
+    client = Client()
+    client.force_login(user)
+    if not models.Property.objects.filter(name='band gap').exists():
+        synthetic.get_or_create(models.Property, user, name='band gap')
+    results = {
+        'started': timezone.now().isoformat(),
+        'database': connection.vendor,
+        'conn_max_age': connection.settings_dict['CONN_MAX_AGE'],
+        'repeat': repeat,
+        'rows': {model.__name__: model.objects.count() for model in (
+            models.Compound, models.Dataset, models.Subset, models.Chart,
+            models.Datapoint, models.ToleranceFactor)},
+        'endpoints': {},
+    }
+    for name, request in get_endpoints():
+        if names and name not in names:
+            continue
+        times = []
+        for i_request in range(repeat):
+            counter = timing.RequestTiming()
+            with connection.execute_wrapper(counter):
+                start = time.perf_counter()
+                if close_connections:
+                    close_old_connections()
+                response = request(client, i_request)
+                if close_connections:
+                    close_old_connections()
+                times.append(time.perf_counter() - start)
+            if response.status_code >= 400:
+                raise ValueError(
+                    f'{name} returned status {response.status_code}')
+        tracemalloc.start()
+        try:
+            request(client, repeat)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        times = numpy.array(times)*1000
+        results['endpoints'][name] = {
+            'p50_ms': round(numpy.percentile(times, 50), 3),
+            'p95_ms': round(numpy.percentile(times, 95), 3),
+            'p99_ms': round(numpy.percentile(times, 99), 3),
+            'mean_ms': round(times.mean(), 3),
+            'queries': counter.sql_count,
+            'peak_memory_kib': round(peak/1024, 1),
+        }
+    return results
@@ -0,0 +1,216 @@
+# This file is covered by the BSD license. See LICENSE in the root directory.
+"""Cache shared by all workers with versioned invalidation.
+
+Every model of the materials, accounts, and auth apps has a version
+counter in the cache (CACHES in the settings), which is bumped
+whenever an instance is saved or deleted (see signals.py). So does
+every compound, whose counter is bumped whenever any of its data sets
+or their contents or references change. Cached values are keyed by the
+versions they were computed from, so a change made through any worker
+makes the stale entries unreachable for all workers at once. The stale
+entries then expire on their own.
+
+Rows written with bulk_create or update() do not send signals. Code
+that writes like that has to call bump() itself.
+
+"""
+import hashlib
+import time
+from functools import wraps
+
+from django.apps import apps
+from django.core.cache import cache
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.db import transaction
+from django.conf import settings
+from django.dispatch import Signal
+
+from mainproject import replicas
+
+from . import models
+
+MISSING = object()
+# Sent with the primary keys of the compounds whose data have changed
+compounds_changed = Signal()
+# Apps whose models have version counters
+VERSIONED_APPS = ('accounts', 'auth', 'materials')
+# Lookups from Compound to the models that make up its data (see
+# bump_compounds)
+COMPOUND_LOOKUPS = {
+    models.Compound: 'pk',
+    models.Dataset: 'datasets',
+    models.SynthesisMethod: 'datasets__synthesis',
+    models.ExperimentalDetails: 'datasets__experimental',
+    models.ComputationalDetails: 'datasets__computational',
+    models.Subset: 'datasets__subsets',
+    models.Reference: 'datasets__subsets__reference',
+    models.Author: 'datasets__subsets__reference__authors',
+    models.AdditionalFile: 'datasets__subsets__additional_files',
+    models.FixedPropertyValue: 'datasets__subsets__fixed_values',
+    models.Chart: 'datasets__subsets__curves',
+    models.LatticeConstant: 'datasets__subsets__lattice_constants',
+    models.AtomicCoordinate: 'datasets__subsets__atomic_coordinates',
+}
+
+
+def version_key(model):
+    return f'version:{model._meta.label_lower}'
+
+
+def compound_key(pk):
+    return f'version:compound:{pk}'
+
+
+def initial_version():
+    """Return the version of a model whose counter is not in the cache.
+
+    Counting from the current time in ms keeps the versions increasing
+    even if a counter is evicted, so that no stale entry can become
+    reachable again.
+    """
+    return int(time.time()*1000)
+
+
+def increment(key):
+    try:
+        cache.incr(key)
+        # Some backends reset the timeout on incr
+        cache.touch(key, None)
+    except ValueError:
+        cache.add(key, initial_version(), None)
+
+
+def bump_keys(keys):
+    """Bump the version counters now and when the transaction commits.
+
+    Bumping twice is necessary because in between another worker could
+    cache the old data under the new version.
+    """
+    for key in keys:
+        increment(key)
+        transaction.on_commit(lambda key=key: increment(key))
+
+
+def bump(*changed_models):
+    """Invalidate everything cached for the models."""
+    bump_keys([version_key(model) for model in changed_models])
+
+
+def bump_compounds(pks):
+    """Invalidate everything cached for the compounds."""
+    pks = set(pks)
+    bump_keys([compound_key(pk) for pk in pks])
+    compounds_changed.send(sender=None, pks=pks)
+
+
+def get_models(labels):
+    """Return the models given as models or as "app_label.Model"."""
+    return [apps.get_model(label) if isinstance(label, str) else label
+            for label in labels]
+
+
+def get_counters(keys):
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            cache.add(key, initial_version(), None)
+            versions[key] = cache.get(key)
+    return '.'.join(str(versions[key]) for key in keys)
+
+
+def get_versions(*labels):
+    """Return the current versions of the models as a string."""
+    return get_counters([version_key(model) for model in get_models(labels)])
+
+
+def get_compound_pks(model, pks):
+    """Return the compounds whose data include the given objects."""
+    if model is models.Compound:
+        return pks
+    return models.Compound.objects.filter(**{
+        f'{COMPOUND_LOOKUPS[model]}__in': pks}).values_list(
+            'pk', flat=True).distinct()
+
+
+def get_compound_version(pk):
+    return get_counters([compound_key(pk)])
+
+
+def get_timeout(timeout):
+    """Shorten the timeout of values computed from replica reads.
+
+    A replica may not yet have the changes that bumped the versions,
+    so such values can be stale even though their versions are not.
+    """
+    if replicas.reading_from_replica():
+        if timeout is DEFAULT_TIMEOUT:
+            timeout = cache.default_timeout
+        if timeout is None or timeout > settings.REPLICA_CACHE_TIMEOUT:
+            return settings.REPLICA_CACHE_TIMEOUT
+    return timeout
+
+
+def make_key(name, labels, *parts):
+    """Return a cache key that changes with the versions of the models.
+
+    labels are models or "app_label.Model" strings, and parts are
+    whatever else the value depends on, e.g., a primary key.
+    """
+    digest = hashlib.md5(':'.join(
+        [get_versions(*labels)] + [str(part) for part in parts]).encode())
+    return f'{name}:{digest.hexdigest()}'
+
+
+def get_or_set(name, labels, parts, compute, timeout=DEFAULT_TIMEOUT):
+    """Return the cached value or compute and cache it.
+
+    labels and parts are as in make_key. compute is called without
+    arguments.
+    """
+    key = make_key(name, labels, *parts)
+    value = cache.get(key, MISSING)
+    if value is MISSING:
+        value = compute()
+        cache.set(key, value, get_timeout(timeout))
+    return value
+
+
+def cache_response(*labels, timeout=DEFAULT_TIMEOUT, depends_on=None):
+    """Cache the responses of a view to anonymous GET requests.
+
+    The responses are keyed by the URL and the versions of the models.
+    depends_on optionally returns further versions (e.g., that of a
+    compound) and is called with the arguments of the view. Pages of
+    logged-in users are not cached because they contain the user's
+    menu, and neither are pages with a CSRF token. Users who have just
+    written something bypass the cache (see mainproject/replicas.py).
+    Use method_decorator for class-based views.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if (request.method not in ('GET', 'HEAD') or
+                    request.user.is_authenticated or
+                    replicas.is_pinned(request)):
+                return view(request, *args, **kwargs)
+            parts = [request.get_full_path()]
+            if depends_on:
+                parts.append(depends_on(request, *args, **kwargs))
+            key = make_key('response', labels, *parts)
+            response = cache.get(key)
+            if response is not None:
+                return response
+            response = view(request, *args, **kwargs)
+
+            def store(response):
+                if (response.status_code == 200 and
+                        not response.streaming and
+                        not request.META.get('CSRF_COOKIE_USED')):
+                    cache.set(key, response, get_timeout(timeout))
+            if callable(getattr(response, 'render', None)):
+                response.add_post_render_callback(store)
+            else:
+                store(response)
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,351 @@
+# This file is covered by the BSD license. See LICENSE in the root directory.
+"""Change feed for mirroring the database to another MatD3 instance.
+
+The feed lists data sets, subsets, curves, references, and deletions
+in the order of their (modified, pk) values. Every object is sent in
+full together with its dependent rows (e.g., a curve with its data
+points), so that applying the feed is a series of upserts. A mirror
+keeps the cursor of the last page and asks only for what has changed
+since.
+
+Objects referenced by name rather than by primary key (compounds,
+properties, units, and space groups) are looked up or created on the
+receiving end. Uploaded files are not part of the feed.
+
+The feed relies on the "modified" timestamps, which are set whenever
+an object is saved and also when one of its dependent rows is saved
+or deleted (see signals.py). They are kept apart from "updated", which
+is the version time of a data set shown on the website.
+
+"""
+import base64
+import json
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from . import caching
+from . import descriptors
+from . import models
+
+NATURAL_KEYS = {
+    models.Compound: 'formula',
+    models.Property: 'name',
+    models.Unit: 'label',
+    models.SpaceGroup: 'name',
+}
+# Fields that are not sent; they are set to the receiving user instead.
+USER_FIELDS = ('created_by', 'updated_by')
+# Dependent rows that are sent along with each object: (related name,
+# model, name of the foreign key to the parent)
+CHILDREN = {
+    models.Reference: (),
+    models.Dataset: (
+        ('synthesis', models.SynthesisMethod, 'dataset'),
+        ('experimental', models.ExperimentalDetails, 'dataset'),
+        ('computational', models.ComputationalDetails, 'dataset'),
+    ),
+    models.SynthesisMethod: (
+        ('comment', models.Comment, 'synthesis_method'),
+    ),
+    models.ExperimentalDetails: (
+        ('comment', models.Comment, 'experimental_details'),
+    ),
+    models.ComputationalDetails: (
+        ('comment', models.Comment, 'computational_details'),
+        ('repositories', models.ExternalRepository, 'computational_details'),
+    ),
+    models.Subset: (
+        ('fixed_values', models.FixedPropertyValue, 'subset'),
+        ('lattice_constants', models.LatticeConstant, 'subset'),
+        ('atomic_coordinates', models.AtomicCoordinate, 'subset'),
+        ('shannon_ionic_radiis', models.ShannonIonicRadii, 'subset'),
+        ('bond_length', models.BondLength, 'subset'),
+        ('tolerance_factors', models.ToleranceFactor, 'subset'),
+    ),
+    models.Chart: (
+        ('datapoints', models.Datapoint, 'chart'),
+    ),
+}
+# The order is also the order in which the changes are applied, so
+# that parents are created before their children.
+FEED_MODELS = (
+    ('reference', models.Reference),
+    ('dataset', models.Dataset),
+    ('subset', models.Subset),
+    ('chart', models.Chart),
+    ('deletion', models.Deletion),
+)
+FEED_MODEL_NAMES = [name for name, _ in FEED_MODELS]
+SELECT_RELATED = {
+    'dataset': ['compound', 'primary_property', 'space_group'],
+}
+PREFETCH = {
+    'reference': ['authors'],
+    'dataset': ['synthesis__comment', 'experimental__comment',
+                'computational__comment', 'computational__repositories'],
+    'subset': [
+        'fixed_values__fixed_property', 'fixed_values__unit',
+        'lattice_constants', 'atomic_coordinates', 'shannon_ionic_radiis',
+        'bond_length', 'tolerance_factors__space_group',
+        'tolerance_factors__compound', 'bond_length__compound',
+        'shannon_ionic_radiis__compound'],
+    'chart': ['datapoints'],
+    'deletion': [],
+}
+
+
+def related_objects(obj, related_name):
+    """Return the objects of a reverse (one-to-one or many) relation."""
+    related = getattr(obj, related_name, None)
+    if related is None:
+        return []
+    return related.all() if hasattr(related, 'all') else [related]
+
+
+def serialize(obj, exclude=()):
+    """Return the field values of obj as a JSON serializable dict."""
+    data = {}
+    for field in obj._meta.concrete_fields:
+        if field.name in USER_FIELDS or field.name in exclude:
+            continue
+        if field.is_relation and field.related_model in NATURAL_KEYS:
+            related = getattr(obj, field.name)
+            data[field.name] = (getattr(related,
+                                        NATURAL_KEYS[field.related_model])
+                                if related else None)
+        elif field.is_relation:
+            data[field.name] = getattr(obj, field.attname)
+        elif field.get_internal_type() == 'FileField':
+            data[field.name] = getattr(obj, field.name).name or ''
+        else:
+            data[field.name] = field.value_from_object(obj)
+    for related_name, model, parent in CHILDREN.get(type(obj), ()):
+        # Children with dependent rows of their own keep their pk so
+        # that those rows can refer to it.
+        child_exclude = (parent,) if model in CHILDREN else ('id', parent)
+        data[related_name] = [
+            serialize(child, exclude=child_exclude)
+            for child in related_objects(obj, related_name)]
+    if isinstance(obj, models.Reference):
+        data['authors'] = [
+            {'first_name': author.first_name,
+             'last_name': author.last_name,
+             'institution': author.institution}
+            for author in obj.authors.all()]
+    return data
+
+
+def encode_cursor(cursor):
+    return base64.urlsafe_b64encode(
+        json.dumps(cursor).encode()).decode()
+
+
+def decode_cursor(text):
+    """Return {model name: (modified, pk)} from the cursor string.
+
+    Raises ValueError if the cursor is malformed.
+    """
+    if not text:
+        return {}
+    try:
+        cursor = json.loads(base64.urlsafe_b64decode(text.encode()))
+        cursor = {name: (parse_datetime(modified), int(pk))
+                  for name, (modified, pk) in cursor.items()
+                  if name in FEED_MODEL_NAMES}
+    except (TypeError, ValueError, AttributeError):
+        raise ValueError(f'Invalid cursor: {text}')
+    if any(modified is None for modified, _ in cursor.values()):
+        raise ValueError(f'Invalid cursor: {text}')
+    return cursor
+
+
+def get_changes(cursor_text, limit):
+    """Return the next page of the change feed after the given cursor.
+
+    For each model, the rows following that model's position (modified,
+    pk) are fetched with a keyset query and the results are merged so
+    that at most limit changes are returned. Rows modified within the
+    last CHANGE_FEED_DELAY seconds are held back, because a
+    transaction that is still in progress may yet commit rows with an
+    older timestamp.
+
+    """
+    cursor = decode_cursor(cursor_text)
+    horizon = timezone.now() - timedelta(seconds=settings.CHANGE_FEED_DELAY)
+    candidates = []
+    for name, model in FEED_MODELS:
+        queryset = model.objects.filter(modified__lt=horizon)
+        if name in cursor:
+            modified, pk = cursor[name]
+            queryset = queryset.filter(
+                Q(modified__gt=modified) | Q(modified=modified, pk__gt=pk))
+        queryset = queryset.select_related(
+            *SELECT_RELATED.get(name, ())).prefetch_related(*PREFETCH[name])
+        # One extra row tells whether there is more to come
+        rows = list(queryset.order_by('modified', 'pk')[:limit+1])
+        candidates.extend(
+            (obj.modified, FEED_MODEL_NAMES.index(name), obj.pk, name, obj)
+            for obj in rows)
+    candidates.sort(key=lambda candidate: candidate[:3])
+    changes = []
+    has_more = len(candidates) > limit
+    for modified, _, pk, name, obj in candidates[:limit]:
+        if name == 'deletion':
+            data = {'model': obj.model, 'object_pk': obj.object_pk}
+        else:
+            data = serialize(obj)
+        changes.append({
+            'model': name,
+            'pk': pk,
+            'modified': modified,
+            'data': data,
+        })
+        cursor[name] = (modified, pk)
+    return {
+        'changes': changes,
+        'cursor': encode_cursor({
+            name: (modified.isoformat(), pk)
+            for name, (modified, pk) in cursor.items()}),
+        'has_more': has_more,
+    }
+
+
+class Applier:
+    """Apply pages of the change feed to this database.
+
+    Changes whose parent objects do not exist yet (e.g., a subset of a
+    data set that has been updated after the subset and is thus later
+    in the feed) are kept in self.pending and retried with the next
+    page.
+    """
+    def __init__(self, user):
+        self.user = user
+        self.pending = []
+        self.natural_keys = {}
+
+    def natural_key_pk(self, model, value):
+        """Return the pk of the object with the given name, creating it."""
+        key = (model, value)
+        if key not in self.natural_keys:
+            self.natural_keys[key] = model.objects.get_or_create(
+                **{NATURAL_KEYS[model]: value},
+                defaults={'created_by': self.user,
+                          'updated_by': self.user})[0].pk
+        return self.natural_keys[key]
+
+    def deserialize(self, model, data):
+        obj = model()
+        for field in model._meta.concrete_fields:
+            if field.name in USER_FIELDS:
+                setattr(obj, field.attname, self.user.pk)
+            elif field.name not in data:
+                continue
+            elif field.is_relation and field.related_model in NATURAL_KEYS:
+                value = data[field.name]
+                setattr(obj, field.attname,
+                        self.natural_key_pk(field.related_model, value)
+                        if value is not None else None)
+            elif field.is_relation or field.get_internal_type() == 'FileField':
+                setattr(obj, field.attname, data[field.name])
+            else:
+                setattr(obj, field.attname, field.to_python(data[field.name]))
+        return obj
+
+    def missing_parents(self, model, objs):
+        """Return the pks of objs whose foreign keys point nowhere."""
+        missing = set()
+        for field in model._meta.concrete_fields:
+            if (not field.is_relation or field.name in USER_FIELDS or
+                    field.related_model in NATURAL_KEYS):
+                continue
+            targets = {getattr(obj, field.attname) for obj in objs} - {None}
+            existing = set(field.related_model.objects.filter(
+                pk__in=targets).values_list('pk', flat=True))
+            missing.update(obj.pk for obj in objs
+                           if getattr(obj, field.attname) is not None and
+                           getattr(obj, field.attname) not in existing)
+        return missing
+
+    def upsert(self, model, objs):
+        """Update the objects that exist and create the rest."""
+        existing = set(model.objects.filter(
+            pk__in=[obj.pk for obj in objs]).values_list('pk', flat=True))
+        fields = [field.name for field in model._meta.concrete_fields
+                  if not field.primary_key]
+        model.objects.bulk_update(
+            [obj for obj in objs if obj.pk in existing], fields,
+            batch_size=500)
+        model.objects.bulk_create(
+            [obj for obj in objs if obj.pk not in existing])
+        caching.bump(model)
+        if model in caching.COMPOUND_LOOKUPS:
+            caching.bump_compounds(caching.get_compound_pks(
+                model, [obj.pk for obj in objs]))
+        if model in (models.LatticeConstant, models.AtomicCoordinate):
+            descriptors.update({obj.subset_id for obj in objs})
+
+    def apply(self, changes):
+        """Apply a list of changes (including those still pending)."""
+        changes = self.pending + changes
+        self.pending = []
+        for name, model in FEED_MODELS:
+            entries = [change for change in changes
+                       if change['model'] == name]
+            if not entries:
+                continue
+            if model is models.Deletion:
+                for entry in entries:
+                    deleted_model = dict(FEED_MODELS)[entry['data']['model']]
+                    deleted_model.objects.filter(
+                        pk=entry['data']['object_pk']).delete()
+                continue
+            # Only the latest version of each object is needed
+            latest = {entry['pk']: entry for entry in entries}
+            objs = []
+            for pk, entry in latest.items():
+                obj = self.deserialize(model, entry['data'])
+                obj.pk = pk
+                objs.append(obj)
+            missing = self.missing_parents(model, objs)
+            self.pending.extend(latest[pk] for pk in missing)
+            objs = [obj for obj in objs if obj.pk not in missing]
+            self.upsert(model, objs)
+            self.set_children(model, [(obj.pk, latest[obj.pk]['data'])
+                                      for obj in objs])
+            if model is models.Reference:
+                self.set_authors(objs, latest)
+
+    def set_children(self, model, parents):
+        """Replace the dependent rows of the parents.
+
+        parents is a list of (pk, serialized data). The dependent rows
+        of the children are replaced in turn.
+        """
+        for related_name, child_model, parent in CHILDREN.get(model, ()):
+            child_model.objects.filter(**{
+                f'{parent}__in': [pk for pk, _ in parents]}).delete()
+            children = []
+            for pk, data in parents:
+                for child_data in data[related_name]:
+                    child = self.deserialize(child_model, child_data)
+                    setattr(child, f'{parent}_id', pk)
+                    children.append((child, child_data))
+            child_model.objects.bulk_create(
+                [child for child, _ in children])
+            caching.bump(child_model)
+            self.set_children(child_model, [(child.pk, data)
+                                            for child, data in children])
+
+    def set_authors(self, references, latest):
+        for reference in references:
+            authors = []
+            for data in latest[reference.pk]['data']['authors']:
+                authors.append(models.Author.objects.get_or_create(
+                    first_name=data['first_name'],
+                    last_name=data['last_name'],
+                    institution=data['institution'])[0])
+            reference.authors.set(authors)
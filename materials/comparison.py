@@ -0,0 +1,147 @@
+# This file is covered by the BSD license. See LICENSE in the root directory.
+"""Overlay and compare curves of several subsets.
+
+The selected curves are converted into common units (see units.py)
+and interpolated linearly onto a shared grid of x values. Outside of
+the x range of a curve its values are missing (NaN, null in JSON).
+Along with the aligned curves, the result contains the difference of
+each curve to a reference curve and the mean, standard deviation,
+minimum, and maximum over the curves at each grid point.
+
+Results are cached by the selected subsets and curves and the other
+parameters, independently of the order in which they were given.
+
+"""
+import numpy
+from django.db.models import Q
+
+from . import caching
+from . import models
+from . import units
+
+DEFAULT_POINTS = 200
+MAX_POINTS = 5000
+MAX_CURVES = 50
+
+
+class ComparisonError(ValueError):
+    pass
+
+
+def load_curves(chart_pks, subset_pks):
+    """Return the curves and their data points as arrays.
+
+    The curves are ordered by pk. The data points are returned as the
+    index of their curve and the x and y values, ordered by curve.
+    """
+    curves = list(models.Chart.objects.filter(
+        Q(pk__in=chart_pks) | Q(subset__in=subset_pks)).values(
+            'pk', 'subset', 'subset__dataset__compound__formula', 'legend',
+            'x_unit', 'y_unit').order_by('pk'))
+    if len(curves) > MAX_CURVES:
+        raise ComparisonError(f'At most {MAX_CURVES} curves can be compared.')
+    curve_pks = [curve['pk'] for curve in curves]
+    rows = numpy.array(models.Datapoint.objects.filter(
+        chart__in=curve_pks).order_by('chart').values_list(
+            'chart', 'x_value', 'y_value'), dtype=float).reshape(-1, 3)
+    indices = numpy.searchsorted(curve_pks, rows[:, 0].astype(int))
+    return curves, indices, rows[:, 1], rows[:, 2]
+
+
+def summarize(y):
+    """Return the statistics over the curves (rows) at each x.
+
+    NaN values are ignored. Where all values are missing, the
+    statistics are NaN.
+    """
+    present = ~numpy.isnan(y)
+    count = present.sum(axis=0)
+    has_values = count > 0
+    total = numpy.where(present, y, 0).sum(axis=0)
+    mean = numpy.full(y.shape[1], numpy.nan)
+    mean[has_values] = total[has_values]/count[has_values]
+    squares = numpy.where(present, (y - mean)**2, 0).sum(axis=0)
+    std = numpy.full(y.shape[1], numpy.nan)
+    std[has_values] = numpy.sqrt(squares[has_values]/count[has_values])
+    minimum = numpy.where(present, y, numpy.inf).min(axis=0)
+    maximum = numpy.where(present, y, -numpy.inf).max(axis=0)
+    minimum[~has_values] = numpy.nan
+    maximum[~has_values] = numpy.nan
+    return {'count': count, 'mean': mean, 'std': std, 'min': minimum,
+            'max': maximum}
+
+
+def to_list(values):
+    """Return the array as a list with None instead of NaN."""
+    values = numpy.asarray(values, dtype=float)
+    return numpy.where(numpy.isnan(values), None, values).tolist()
+
+
+def compare(chart_pks=(), subset_pks=(), x_unit=None, y_unit=None,
+            n_points=DEFAULT_POINTS, x_min=None, x_max=None, reference=None):
+    """Return the selected curves resampled onto a common grid.
+
+    The units default to those of the first curve and the x range to
+    the union of the ranges of the curves. reference is the pk of the
+    curve that the others are compared with (default: the first one).
+    """
+    curves, indices, x, y = load_curves(chart_pks, subset_pks)
+    if not curves:
+        raise ComparisonError('No curves selected.')
+    x_unit = curves[0]['x_unit'] if x_unit is None else x_unit
+    y_unit = curves[0]['y_unit'] if y_unit is None else y_unit
+    for values, unit, key in ((x, x_unit, 'x_unit'), (y, y_unit, 'y_unit')):
+        labels = numpy.array([curve[key] for curve in curves])
+        if len(indices) and (labels != unit).any():
+            values[:] = units.convert_column(values, labels[indices], unit)
+    x_min = numpy.nanmin(x) if x_min is None and len(x) else x_min
+    x_max = numpy.nanmax(x) if x_max is None and len(x) else x_max
+    if x_min is None or x_max is None or not x_min <= x_max:
+        raise ComparisonError('Invalid x range.')
+    grid = numpy.linspace(x_min, x_max, n_points)
+    aligned = numpy.full((len(curves), n_points), numpy.nan)
+    order = numpy.lexsort((x, indices))
+    x, y, indices = x[order], y[order], indices[order]
+    bounds = numpy.searchsorted(indices, numpy.arange(len(curves) + 1))
+    for i_curve, (start, end) in enumerate(zip(bounds[:-1], bounds[1:])):
+        if start < end:
+            aligned[i_curve] = numpy.interp(grid, x[start:end], y[start:end],
+                                            left=numpy.nan, right=numpy.nan)
+    curve_pks = [curve['pk'] for curve in curves]
+    if reference is None:
+        reference = curve_pks[0]
+    elif reference not in curve_pks:
+        raise ComparisonError('The reference must be one of the curves.')
+    differences = aligned - aligned[curve_pks.index(reference)]
+    result = {
+        'x': grid.tolist(),
+        'x unit': x_unit,
+        'y unit': y_unit,
+        'reference': reference,
+        'curves': [],
+        'statistics': {name: (values.tolist() if name == 'count' else
+                              to_list(values))
+                       for name, values in summarize(aligned).items()},
+    }
+    for curve, values, difference in zip(curves, aligned, differences):
+        present = ~numpy.isnan(difference)
+        result['curves'].append({
+            'curve': curve['pk'],
+            'subset': curve['subset'],
+            'formula': curve['subset__dataset__compound__formula'],
+            'legend': curve['legend'],
+            'y': to_list(values),
+            'difference': to_list(difference),
+            'rmsd': (float(numpy.sqrt((difference[present]**2).mean()))
+                     if present.any() else None),
+        })
+    return result
+
+
+def get_comparison(chart_pks=(), subset_pks=(), **options):
+    """Return compare(...) from the cache if possible."""
+    return caching.get_or_set(
+        'comparison', (models.Chart, models.Datapoint, models.Compound),
+        (tuple(sorted(set(chart_pks))), tuple(sorted(set(subset_pks))),
+         *sorted(options.items())),
+        lambda: compare(chart_pks, subset_pks, **options))
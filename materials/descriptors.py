@@ -0,0 +1,134 @@
+# This file is covered by the BSD license. See LICENSE in the root directory.
+"""Derive descriptors of atomic structures for filtering and sorting.
+
+The cell volume, density, number of atoms, and reduced formula of each
+subset with an atomic structure are stored as a StructureDescriptor.
+They are computed for many subsets at once: the volumes from an array
+of lattice constants, and the numbers of atoms of each element with a
+single aggregate query. The file that the 3D viewer loads is stored
+alongside, so that it can be served with a single query (see
+views.get_jsmol_input). update is called whenever structures are saved
+(see ingestion.py and structures.py), and ./manage.py
+compute_descriptors fills in the descriptors of existing data.
+
+"""
+import math
+import re
+from functools import reduce
+
+import numpy
+from django.db import transaction
+from django.db.models import Count
+from django.db.models import Min
+
+from . import caching
+from . import models
+from . import similarity
+from . import structures
+
+CELL_FIELDS = similarity.CELL_FIELDS
+# g/cm³ of one atomic mass unit per Å³
+AMU_PER_CUBIC_ANGSTROM = 1.66053907
+ATOMIC_MASSES = {
+    'H': 1.008, 'He': 4.0026, 'Li': 6.94, 'Be': 9.0122, 'B': 10.81,
+    'C': 12.011, 'N': 14.007, 'O': 15.999, 'F': 18.998, 'Ne': 20.180,
+    'Na': 22.990, 'Mg': 24.305, 'Al': 26.982, 'Si': 28.085, 'P': 30.974,
+    'S': 32.06, 'Cl': 35.45, 'Ar': 39.948, 'K': 39.098, 'Ca': 40.078,
+    'Sc': 44.956, 'Ti': 47.867, 'V': 50.942, 'Cr': 51.996, 'Mn': 54.938,
+    'Fe': 55.845, 'Co': 58.933, 'Ni': 58.693, 'Cu': 63.546, 'Zn': 65.38,
+    'Ga': 69.723, 'Ge': 72.630, 'As': 74.922, 'Se': 78.971, 'Br': 79.904,
+    'Kr': 83.798, 'Rb': 85.468, 'Sr': 87.62, 'Y': 88.906, 'Zr': 91.224,
+    'Nb': 92.906, 'Mo': 95.95, 'Tc': 98.0, 'Ru': 101.07, 'Rh': 102.91,
+    'Pd': 106.42, 'Ag': 107.87, 'Cd': 112.41, 'In': 114.82, 'Sn': 118.71,
+    'Sb': 121.76, 'Te': 127.60, 'I': 126.90, 'Xe': 131.29, 'Cs': 132.91,
+    'Ba': 137.33, 'La': 138.91, 'Ce': 140.12, 'Pr': 140.91, 'Nd': 144.24,
+    'Pm': 145.0, 'Sm': 150.36, 'Eu': 151.96, 'Gd': 157.25, 'Tb': 158.93,
+    'Dy': 162.50, 'Ho': 164.93, 'Er': 167.26, 'Tm': 168.93, 'Yb': 173.05,
+    'Lu': 174.97, 'Hf': 178.49, 'Ta': 180.95, 'W': 183.84, 'Re': 186.21,
+    'Os': 190.23, 'Ir': 192.22, 'Pt': 195.08, 'Au': 196.97, 'Hg': 200.59,
+    'Tl': 204.38, 'Pb': 207.2, 'Bi': 208.98, 'Po': 209.0, 'At': 210.0,
+    'Rn': 222.0, 'Fr': 223.0, 'Ra': 226.0, 'Ac': 227.0, 'Th': 232.04,
+    'Pa': 231.04, 'U': 238.03, 'Np': 237.0, 'Pu': 244.0,
+}
+ELEMENT = re.compile(r'[A-Z][a-z]?')
+
+
+def cell_volumes(cells):
+    """Return the volumes of an array of (a, b, c, alpha, beta, gamma)."""
+    cells = numpy.asarray(cells, dtype=float).reshape(-1, 6)
+    cosines = numpy.cos(numpy.radians(cells[:, 3:]))
+    return cells[:, :3].prod(axis=1) * numpy.sqrt(numpy.maximum(
+        1 - (cosines**2).sum(axis=1) + 2*cosines.prod(axis=1), 0))
+
+
+def reduced_formula(counts):
+    """Return a formula such as "CsPbI3" with the smallest integers."""
+    if not counts:
+        return ''
+    values = list(counts.values())
+    if all(value == int(value) for value in values):
+        divisor = reduce(math.gcd, (int(value) for value in values))
+        values = [int(value)//divisor for value in values]
+    return ''.join(f'{element}{"" if value == 1 else f"{value:g}"}'
+                   for element, value in zip(counts, values))
+
+
+def compute(subset_pks):
+    """Return unsaved descriptors of the subsets.
+
+    Subsets without lattice constants or atomic coordinates are
+    skipped.
+    """
+    subset_pks = list(subset_pks)
+    cells = {}
+    for subset, *cell in models.LatticeConstant.objects.filter(
+            subset__in=subset_pks).values_list('subset', *CELL_FIELDS):
+        cells[subset] = cell
+    counts = {}
+    for row in models.AtomicCoordinate.objects.filter(
+            subset__in=subset_pks, label__in=('atom', 'atom_frac')).values(
+                'subset', 'element').annotate(
+                    n=Count('pk'), first=Min('pk')).order_by(
+                        'subset', 'first'):
+        counts.setdefault(row['subset'], {})[row['element']] = row['n']
+    formulas = dict(models.Subset.objects.filter(
+        pk__in=subset_pks).values_list('pk', 'dataset__compound__formula'))
+    pks = sorted(set(cells) | set(counts))
+    volumes = cell_volumes([cells.get(pk, [numpy.nan]*6) for pk in pks])
+    structures_by_pk = structures.load_many(counts)
+    descriptors = []
+    for pk, volume in zip(pks, volumes.tolist()):
+        descriptor = models.StructureDescriptor(subset_id=pk)
+        if pk in structures_by_pk:
+            descriptor.viewer_data = structures.viewer_data(
+                structures_by_pk[pk], f'subset_{pk}')
+        if math.isfinite(volume) and volume > 0:
+            descriptor.volume = volume
+        if pk in counts:
+            descriptor.n_atoms = sum(counts[pk].values())
+            descriptor.reduced_formula = reduced_formula(counts[pk])
+            try:
+                mass = sum(ATOMIC_MASSES[ELEMENT.match(element).group()]*n
+                           for element, n in counts[pk].items())
+                if descriptor.volume:
+                    descriptor.density = (mass*AMU_PER_CUBIC_ANGSTROM /
+                                          descriptor.volume)
+            except (AttributeError, KeyError):
+                pass  # Unknown element
+        elif formulas.get(pk):
+            descriptor.reduced_formula = reduced_formula(
+                similarity.count_elements(formulas[pk]))
+        descriptors.append(descriptor)
+    return descriptors
+
+
+@transaction.atomic
+def update(subset_pks):
+    """Recompute the descriptors of the subsets."""
+    subset_pks = list(subset_pks)
+    models.StructureDescriptor.objects.filter(
+        subset__in=subset_pks).delete()
+    descriptors = compute(subset_pks)
+    models.StructureDescriptor.objects.bulk_create(descriptors)
+    caching.bump(models.StructureDescriptor)
+    return descriptors
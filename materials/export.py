@@ -0,0 +1,286 @@
+# This file is covered by the BSD license. See LICENSE in the root directory.
+"""Streaming export of the database contents.
+
+The data are read in chunks (see utils.iterate_in_chunks) and written
+out row by row, so that memory use stays constant regardless of the
+size of the export. Each table is described by the model, the lookup
+from the model to its data set, and the exported columns given as
+(column name, field lookup) pairs.
+
+Atomic structures are exported separately, either as a single extended
+XYZ file or as a zip file of CIF files. The structures are loaded in
+batches of subsets (see structures.load_many), so that only one batch
+is held in memory at a time.
+
+"""
+import csv
+import itertools
+import json
+import re
+import zipfile
+
+from . import models
+from . import structures
+from . import utils
+
+STRUCTURE_FORMATS = ('extxyz', 'zip')
+# Characters that are replaced in the names of exported files
+UNSAFE_CHARACTERS = re.compile(r'[^\w.-]')
+
+TABLES = (
+    ('datasets', models.Dataset, 'pk', (
+        ('dataset', 'pk'),
+        ('compound', 'compound__formula'),
+        ('primary property', 'primary_property__name'),
+        ('is experimental', 'is_experimental'),
+        ('sample type', 'sample_type'),
+        ('crystal system', 'crystal_system'),
+        ('space group', 'space_group__name'),
+        ('created by', 'created_by__username'),
+        ('updated', 'updated'),
+    )),
+    ('subsets', models.Subset, 'dataset', (
+        ('subset', 'pk'),
+        ('dataset', 'dataset'),
+        ('title', 'title'),
+        ('reference', 'reference'),
+        ('input data file', 'input_data_file'),
+    )),
+    ('fixed_values', models.FixedPropertyValue, 'subset__dataset', (
+        ('subset', 'subset'),
+        ('fixed property', 'fixed_property__name'),
+        ('value type', 'value_type'),
+        ('value', 'value'),
+        ('unit', 'unit__label'),
+    )),
+    ('curves', models.Chart, 'subset__dataset', (
+        ('curve', 'pk'),
+        ('subset', 'subset'),
+        ('x title', 'x_title'),
+        ('x unit', 'x_unit'),
+        ('y title', 'y_title'),
+        ('y unit', 'y_unit'),
+        ('legend', 'legend'),
+    )),
+    ('datapoints', models.Datapoint, 'chart__subset__dataset', (
+        ('curve', 'chart'),
+        ('point', 'point_counter'),
+        ('x', 'x_value'),
+        ('y', 'y_value'),
+    )),
+    ('lattice_constants', models.LatticeConstant, 'subset__dataset', (
+        ('subset', 'subset'),
+        ('a', 'a'),
+        ('b', 'b'),
+        ('c', 'c'),
+        ('alpha', 'alpha'),
+        ('beta', 'beta'),
+        ('gamma', 'gamma'),
+    )),
+    ('atomic_coordinates', models.AtomicCoordinate, 'subset__dataset', (
+        ('subset', 'subset'),
+        ('label', 'label'),
+        ('coord 1', 'coord_1'),
+        ('coord 2', 'coord_2'),
+        ('coord 3', 'coord_3'),
+        ('element', 'element'),
+    )),
+    ('bond_lengths', models.BondLength, 'subset__dataset', (
+        ('subset', 'subset'),
+        ('r label', 'r_label'),
+        ('bond id', 'bond_id'),
+        ('experimental R', 'experimental_r'),
+        ('averaged R', 'averaged_r'),
+        ('Shannon R', 'shannon_r'),
+    )),
+    ('tolerance_factors', models.ToleranceFactor, 'subset__dataset', (
+        ('subset', 'subset'),
+        ('data source', 'data_source'),
+        ('space group', 'space_group__name'),
+        ('t_I', 't_I'),
+        ('t_IV_V', 't_IV_V'),
+    )),
+)
+TABLE_NAMES = [table[0] for table in TABLES]
+
+
+class Echo:
+    """File-like object whose write method returns the written value.
+
+    Used for streaming the output of csv.writer.
+    """
+    def write(self, value):
+        return value
+
+
+class ZipStream:
+    """Unseekable output buffer for building a zip file on the fly.
+
+    zipfile.ZipFile writes into the buffer, and whatever has been
+    written so far is taken out with pop() and sent to the client.
+    """
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        """Return a list with the pending data, which may be empty."""
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return [data] if data else []
+
+
+def table_rows(table, datasets, chunk_size=2000):
+    """Yield the rows of the given table for the selected data sets.
+
+    datasets is a Dataset queryset. Each row is a dictionary keyed by
+    the column names of the table.
+    """
+    name, model, to_dataset, columns = table
+    queryset = model.objects.filter(
+        **{f'{to_dataset}__in': datasets.values('pk')})
+    names = [column[0] for column in columns]
+    lookups = [column[1] for column in columns]
+    for row in utils.iterate_in_chunks(queryset, lookups, chunk_size):
+        yield dict(zip(names, row[1:]))
+
+
+def get_table(name):
+    return TABLES[TABLE_NAMES.index(name)]
+
+
+def stream_csv(datasets, table_name):
+    """Yield the given table as lines of CSV."""
+    table = get_table(table_name)
+    writer = csv.writer(Echo())
+    yield writer.writerow([column[0] for column in table[3]])
+    for row in table_rows(table, datasets):
+        yield writer.writerow(row.values())
+
+
+def stream_ndjson(datasets):
+    """Yield all tables as newline-delimited JSON.
+
+    Each line is a JSON object with an additional key "table".
+    """
+    for table in TABLES:
+        for row in table_rows(table, datasets):
+            row['table'] = table[0]
+            yield json.dumps(row, default=str) + '\n'
+
+
+def stream_zip(datasets):
+    """Yield a zip file containing all tables and uploaded files.
+
+    Each table is stored as a CSV file. The data input files and the
+    additional files are stored under their original paths.
+    """
+    stream = ZipStream()
+    with zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for table in TABLES:
+            with archive.open(f'{table[0]}.csv', 'w',
+                              force_zip64=True) as entry:
+                for line in stream_csv(datasets, table[0]):
+                    entry.write(line.encode())
+                    yield from stream.pop()
+        file_lists = (
+            (models.Subset.objects.filter(dataset__in=datasets.values('pk')),
+             'input_data_file'),
+            (models.AdditionalFile.objects.filter(
+                subset__dataset__in=datasets.values('pk')),
+             'additional_file'),
+        )
+        for queryset, field in file_lists:
+            for pk, name in utils.iterate_in_chunks(
+                    queryset.exclude(**{field: ''}).exclude(
+                        **{f'{field}__isnull': True}), [field]):
+                storage = queryset.model._meta.get_field(field).storage
+                if not storage.exists(name):
+                    continue
+                with storage.open(name) as f_in, archive.open(
+                        name, 'w', force_zip64=True) as entry:
+                    for chunk in f_in.chunks():
+                        entry.write(chunk)
+                        yield from stream.pop()
+    yield from stream.pop()
+
+
+def select_subsets(compound=None, primary_property=None, formula=None,
+                   subsets=None):
+    """Return the subsets with atomic structures matching all criteria.
+
+    compound and primary_property are primary keys, formula is matched
+    against part of the formula of the compound as in the search, and
+    subsets is a list of primary keys, e.g., from a similarity search.
+    """
+    queryset = models.Subset.objects.filter(
+        pk__in=models.AtomicCoordinate.objects.values('subset'))
+    if compound is not None:
+        queryset = queryset.filter(dataset__compound=compound)
+    if primary_property is not None:
+        queryset = queryset.filter(dataset__primary_property=primary_property)
+    if formula:
+        queryset = queryset.filter(
+            dataset__compound__formula__icontains=formula)
+    if subsets is not None:
+        queryset = queryset.filter(pk__in=subsets)
+    return queryset
+
+
+def iterate_structures(subsets, batch_size=200):
+    """Yield the subset, data set, formula, and structure of each subset.
+
+    subsets is a Subset queryset. Subsets whose stored structure is
+    inconsistent are skipped.
+    """
+    rows = utils.iterate_in_chunks(
+        subsets, ['dataset', 'dataset__compound__formula'], batch_size)
+    while True:
+        batch = list(itertools.islice(rows, batch_size))
+        if not batch:
+            break
+        loaded = structures.load_many(row[0] for row in batch)
+        for pk, dataset, formula in batch:
+            if pk in loaded:
+                yield pk, dataset, formula, loaded[pk]
+
+
+def stream_extxyz(subsets, batch_size=200):
+    """Yield the structures as frames of an extended XYZ file."""
+    for pk, dataset, formula, structure in iterate_structures(
+            subsets, batch_size):
+        yield structures.to_xyz(structure, subset=pk, dataset=dataset,
+                                formula=re.sub(r'\s', '', formula))
+
+
+def stream_cif_zip(subsets, batch_size=200):
+    """Yield a zip file with a CIF file per structure.
+
+    Molecules, which have no unit cell, are stored as XYZ files.
+    """
+    stream = ZipStream()
+    with zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for pk, _, formula, structure in iterate_structures(
+                subsets, batch_size):
+            name = f'{UNSAFE_CHARACTERS.sub("_", formula)}_subset_{pk}'
+            if structure.lattice is None:
+                archive.writestr(f'{name}.xyz', structures.to_xyz(
+                    structure, subset=pk))
+            else:
+                archive.writestr(f'{name}.cif',
+                                 structures.to_cif(structure, name))
+            yield from stream.pop()
+    yield from stream.pop()
+
+
+def stream_structures(subsets, file_format, batch_size=200):
+    """Yield the structures in the given format (see STRUCTURE_FORMATS)."""
+    if file_format == 'extxyz':
+        return stream_extxyz(subsets, batch_size)
+    return stream_cif_zip(subsets, batch_size)
@@ -414,7 +414,10 @@ class AddDataForm(forms.Form):
             attrs={'class': 'form-control', 'rows': '10',
                    'placeholder': mark_safe(placeholder_)}),
         help_text=''
-        'Enter atomic structure data in any format accepted by JMol. Note: to '
+        'Enter atomic structure data in any format accepted by JMol. '
+        'Coordinates in the FHI-aims, CIF, VASP POSCAR, and (extended) XYZ '
+        'formats are also stored in the database, and lattice constants '
+        'left empty are then computed from the lattice vectors. Note: to '
         'resize this box, drag from the corner.')
     geometry_format = forms.CharField(
         required=False, initial='aims', widget=forms.HiddenInput())
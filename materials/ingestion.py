@@ -0,0 +1,577 @@
+# This file is covered by the BSD license. See LICENSE in the root directory.
+"""Functions for writing submitted data into the database.
+
+The same code path is used by submit_data, which processes the form
+within the HTTP request, and by the process_ingestion_jobs management
+command, which processes queued ingestion jobs in the background.
+
+"""
+import json
+import logging
+import math
+import os
+import re
+import requests
+
+from django.core.files import File
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.db import transaction
+from django.db.models import Avg
+from django.utils import timezone
+from django.utils.datastructures import MultiValueDict
+
+from . import caching
+from . import descriptors
+from . import forms
+from . import models
+from . import structures
+
+logger = logging.getLogger(__name__)
+
+
+class IngestionError(Exception):
+    """Raised when part of the submitted data could not be processed.
+
+    The data set that was being created when the error occurred, if
+    any, is attached so that the caller can decide what to do with it.
+
+    """
+    def __init__(self, message, dataset=None):
+        super().__init__(message)
+        self.dataset = dataset
+
+
+def skip_this_line(line):
+    """Test whether the line is empty or a comment."""
+    return re.match(r'\s*#', line) or not line or line == '\r'
+
+
+def create_input_file(subset, import_file_name, data_as_str, i_dataset,
+                      i_subset):
+    """Read data points from the input form and save as file.
+
+    If the name of the original file from which the data was imported
+    is on the form, use that name for creating the file. Otherwise,
+    the files are named data_<i_dataset>_<i_subset>.txt.
+
+    """
+    if data_as_str:
+        if import_file_name:
+            file_name = import_file_name
+        else:
+            file_name = f'data_{i_dataset}_{i_subset}.txt'
+        f = SimpleUploadedFile(file_name, data_as_str.encode())
+        subset.input_data_file = f
+
+
+def get_compound(form, user):
+    """Return the compound of the submission, creating it if needed."""
+    compound = models.Compound.objects.filter(
+        formula=form.cleaned_data['formula']).first()
+    if not compound:
+        compound = models.Compound.objects.create(
+            created_by=user, formula=form.cleaned_data['formula'])
+    return compound
+
+
+def save_data(form, files, user, progress=None):
+    """Write all data sets of a validated AddDataForm.
+
+    files is a MultiValueDict of the uploaded files (request.FILES
+    when called from a view). progress, if given, is called as
+    progress(i_dataset, i_subset, obj) each time a subset (obj is the
+    subset) or a whole data set (i_subset is None and obj is the data
+    set) has been written. Returns the list of created data sets.
+
+    """
+    compound = get_compound(form, user)
+    datasets = []
+    for i_dataset in range(
+            1, int(form.cleaned_data['number_of_datasets']) + 1):
+        datasets.append(save_dataset(
+            form, files, user, compound, i_dataset, progress))
+    return datasets
+
+
+def save_dataset(form, files, user, compound, i_dataset, progress=None):
+    """Write a single data set (and all its subsets) of the form."""
+    dataset = models.Dataset(created_by=user, compound=compound)
+    dataset.primary_property = form.cleaned_data[
+        f'primary_property_{i_dataset}']
+    dataset.is_experimental = (
+        form.cleaned_data[f'origin_of_data_{i_dataset}'] == 'is_experimental')
+    dataset.sample_type = form.cleaned_data[f'sample_type_{i_dataset}']
+    dataset.crystal_system = form.cleaned_data[f'crystal_system_{i_dataset}']
+    dataset.space_group = form.cleaned_data[f'space_group_{i_dataset}']
+    if f'update_comments_{i_dataset}' in form.cleaned_data:
+        dataset.update_comments = form.cleaned_data[
+            f'update_comments_{i_dataset}']
+    dataset.save()
+    logger.info(f'Create dataset #{dataset.pk}')
+    if form.cleaned_data[f'with_synthesis_details_{i_dataset}']:
+        synthesis = models.SynthesisMethod(created_by=user, dataset=dataset)
+        synthesis.starting_materials = form.cleaned_data[
+            f'starting_materials_{i_dataset}']
+        synthesis.product = form.cleaned_data[f'product_{i_dataset}']
+        synthesis.description = form.cleaned_data[
+            f'synthesis_description_{i_dataset}']
+        synthesis.save()
+        logger.info(f'Creating synthesis details #{synthesis.pk}')
+        if form.cleaned_data[f'synthesis_comment_{i_dataset}']:
+            models.Comment.objects.create(
+                synthesis_method=synthesis,
+                created_by=user,
+                text=form.cleaned_data[f'synthesis_comment_{i_dataset}'])
+    # Experimental details
+    if form.cleaned_data[f'with_experimental_details_{i_dataset}']:
+        experimental = models.ExperimentalDetails(created_by=user,
+                                                  dataset=dataset)
+        experimental.method = form.cleaned_data[
+            f'experimental_method_{i_dataset}']
+        experimental.description = form.cleaned_data[
+            f'experimental_description_{i_dataset}']
+        experimental.save()
+        logger.info(f'Creating experimental details #{experimental.pk}')
+        if form.cleaned_data[f'experimental_comment_{i_dataset}']:
+            models.Comment.objects.create(
+                experimental_details=experimental,
+                created_by=user,
+                text=form.cleaned_data[f'experimental_comment_{i_dataset}'])
+    # Computational details
+    if form.cleaned_data[f'with_computational_details_{i_dataset}']:
+        computational = models.ComputationalDetails(created_by=user,
+                                                    dataset=dataset)
+        computational.code = form.cleaned_data[f'code_{i_dataset}']
+        computational.level_of_theory = form.cleaned_data[
+            f'level_of_theory_{i_dataset}']
+        computational.xc_functional = form.cleaned_data[
+            f'xc_functional_{i_dataset}']
+        computational.k_point_grid = form.cleaned_data[
+            f'k_point_grid_{i_dataset}']
+        computational.level_of_relativity = form.cleaned_data[
+            f'level_of_relativity_{i_dataset}']
+        computational.basis_set_definition = form.cleaned_data[
+            f'basis_set_definition_{i_dataset}']
+        computational.numerical_accuracy = form.cleaned_data[
+            f'numerical_accuracy_{i_dataset}']
+        computational.save()
+        logger.info(f'Creating computational details #{computational.pk}')
+        if form.cleaned_data[f'computational_comment_{i_dataset}']:
+            models.Comment.objects.create(
+                computational_details=computational,
+                created_by=user,
+                text=form.cleaned_data[f'computational_comment_{i_dataset}'])
+        if form.cleaned_data[f'external_repositories_{i_dataset}']:
+            for url in form.cleaned_data[
+                    f'external_repositories_{i_dataset}'].split():
+                if not requests.head(url).ok:
+                    raise IngestionError(
+                        'Could not process url for the external '
+                        f'repository: "{url}"', dataset)
+                models.ExternalRepository.objects.create(
+                    computational_details=computational,
+                    created_by=user,
+                    url=url)
+    # For best performance, the main data should be inserted with
+    # calls to bulk_create. The following work arrays are are
+    # populated with data during the loop over subsets and then
+    # inserted into the database after the main loop.
+    datapoints = []
+    lattice_constants = []
+    atomic_coordinates = []
+    structure_subsets = []
+    for i_subset in range(
+            1, int(form.cleaned_data[f'number_of_subsets_{i_dataset}']) + 1):
+        suffix = str(i_dataset) + '_' + str(i_subset)
+        # Create data subset
+        subset = models.Subset(created_by=user, dataset=dataset)
+        subset.title = form.cleaned_data[f'sub_title_{suffix}']
+        subset.reference = form.cleaned_data[f'select_reference_{suffix}']
+        # Atomic structure data
+        if dataset.primary_property.name == 'atomic structure':
+            create_input_file(
+                subset,
+                form.cleaned_data[f'import_file_name_atomic_{suffix}'],
+                form.cleaned_data[f'atomic_coordinates_{suffix}'],
+                i_dataset,
+                i_subset
+            )
+            subset.save()
+            structure = None
+            text = form.cleaned_data[f'atomic_coordinates_{suffix}']
+            if text.strip():
+                # The format on the form is set by the browser, which
+                # only recognizes aims and CIF, so prefer detection
+                try:
+                    structure = structures.parse(
+                        text,
+                        structures.detect_format(
+                            text, form.cleaned_data[
+                                f'import_file_name_atomic_{suffix}']) or
+                        form.cleaned_data[f'geometry_format_{suffix}'])
+                except structures.StructureError as error:
+                    raise IngestionError(str(error), dataset)
+            # Store lattice constants into database. Empty fields are
+            # taken from the lattice vectors of the structure.
+            derived = structure.lattice_constants() if structure else None
+            lattice_constant = models.LatticeConstant(
+                created_by=user,
+                subset=subset)
+            for key in ['a', 'b', 'c', 'alpha', 'beta', 'gamma']:
+                value = form.cleaned_data[f'lattice_constant_{key}_{suffix}']
+                if not value and derived:
+                    value = derived[key]
+                try:
+                    setattr(lattice_constant, key, float(value))
+                except ValueError:
+                    raise IngestionError(
+                        f'Could not process lattice constant {key}.', dataset)
+            lattice_constants.append(lattice_constant)
+            structure_subsets.append(subset.pk)
+            # Store atomic coordinates into database
+            if structure:
+                atomic_coordinates.extend(structures.coordinate_objects(
+                    structure, created_by=user, subset=subset))
+        # Tolerance factor related parameters
+        elif (dataset.primary_property.name ==
+              'tolerance factor related parameters'):
+            subset.save()
+            save_tolerance_factor_data(
+                form, user, compound, dataset, subset, suffix)
+        # Normal properties data
+        else:
+            create_input_file(
+                subset,
+                form.cleaned_data[f'import_file_name_{suffix}'],
+                form.cleaned_data[f'datapoints_{suffix}'],
+                i_dataset,
+                i_subset
+            )
+            subset.save()
+            # Create chart objects
+            charts = []
+            for i_curve in range(
+                    1,
+                    int(form.cleaned_data[f'number_of_curves_{suffix}'])+1):
+                charts.append(models.Chart(
+                    created_by=user,
+                    subset=subset,
+                    x_title=form.cleaned_data[f'x_title_{suffix}'],
+                    x_unit=form.cleaned_data[f'x_unit_{suffix}'],
+                    y_title=form.cleaned_data[f'y_title_{suffix}'],
+                    y_unit=form.cleaned_data[f'y_unit_{suffix}'],
+                    legend=form.cleaned_data[f'legend_{suffix}_{i_curve}'],
+                    curve_counter=i_curve
+                ))
+            models.Chart.objects.bulk_create(charts)
+            charts_q = models.Chart.objects.filter(subset=subset)
+
+            # Create datapoint objects
+            try:
+                lines = form.cleaned_data[f'datapoints_{suffix}'].splitlines()
+                for i_line, line in enumerate(lines):
+                    if skip_this_line(line):
+                        continue
+                    for i_col, value in enumerate(line.split()):
+                        if i_col == 0:
+                            x_value = float(value)
+                        else:
+                            datapoints.append(models.Datapoint(
+                                created_by=user,
+                                chart=charts_q[i_col-1],
+                                x_value=x_value,
+                                y_value=float(value),
+                                point_counter=i_line + 1)
+                            )
+            except ValueError:
+                raise IngestionError(f'Could not process line: {line}',
+                                     dataset)
+
+            # Fixed properties
+            counter = 1
+            for key in form.cleaned_data:
+                if key.startswith(f'fixed_property_{i_dataset}_{i_subset}_'):
+                    suffix = key.split('fixed_property_')[1]
+                    value = float(form.cleaned_data['fixed_value_' + suffix])
+                    subset.fixed_values.create(
+                        created_by=user,
+                        fixed_property=form.cleaned_data[
+                            'fixed_property_' + suffix],
+                        value=value,
+                        value_type=form.cleaned_data['fixed_sign_' + suffix],
+                        unit=form.cleaned_data['fixed_unit_' + suffix],
+                        counter=counter)
+                    counter += 1
+
+        # Additional files
+        for f in files.getlist(f'additional_files_{i_dataset}_{i_subset}'):
+            subset.additional_files.create(
+                created_by=user,
+                additional_file=f)
+        if progress:
+            progress(i_dataset, i_subset, subset)
+
+    # Insert the main data into the database
+    models.Datapoint.objects.bulk_create(datapoints)
+    models.LatticeConstant.objects.bulk_create(lattice_constants)
+    models.AtomicCoordinate.objects.bulk_create(atomic_coordinates)
+    caching.bump(models.Chart, models.Datapoint, models.LatticeConstant,
+                 models.AtomicCoordinate)
+    if structure_subsets:
+        descriptors.update(structure_subsets)
+    if progress:
+        progress(i_dataset, None, dataset)
+    return dataset
+
+
+def save_tolerance_factor_data(form, user, compound, dataset, subset, suffix):
+    """Create Shannon radii, bond lengths, and tolerance factors."""
+    label_list = ['I', 'II', 'IV', 'X']
+    # Query for Shannon ionic radii
+    r_dict = {}
+    for i in range(4):
+        label = label_list[i]
+        shannon_r = models.ShannonIonicRadii(
+            created_by=user,
+            compound=compound,
+            subset=subset,
+            element_label=i)
+        shannon_r.element = form.cleaned_data[f'element_{label}_' + suffix]
+        shannon_r.charge = form.cleaned_data[f'charge_{label}_' + suffix]
+        shannon_r.coordination = form.cleaned_data[f'coord_{label}_' + suffix]
+        if f'spin_state_{label}_' + suffix in form.cleaned_data:
+            shannon_r.spin_state = form.cleaned_data[
+                f'spin_state_{label}_' + suffix]
+        try:
+            if (shannon_r.element and shannon_r.charge and
+                    shannon_r.coordination):
+                shannon_r.ionic_radius = (
+                    models.ShannonRadiiTable.objects.filter(
+                        element=shannon_r.element,
+                        charge=shannon_r.charge,
+                        coordination=shannon_r.coordination,
+                        spin_state=shannon_r.spin_state)[0].ionic_radius)
+                r_dict[f'r_{label}'] = shannon_r.ionic_radius
+            shannon_r.save()
+        except Exception:
+            raise IngestionError(
+                f'Query for Shannon ionic radii of element {label}: '
+                f'{shannon_r.element} failed.', dataset)
+
+    # Create bond length object for each bond
+    for i in range(3):
+        label = label_list[i]
+        # If element_a, element_b is not filled, pad it with shannon inputs.
+        if form.cleaned_data[f'element_{label}_X_a_' + suffix]:
+            element_a = form.cleaned_data[f'element_{label}_X_a_' + suffix]
+        else:
+            element_a = form.cleaned_data[f'element_{label}_' + suffix]
+        if form.cleaned_data[f'element_{label}_X_b_' + suffix]:
+            element_b = form.cleaned_data[f'element_{label}_X_b_' + suffix]
+        else:
+            element_b = form.cleaned_data['element_X_' + suffix]
+        bond_obj = models.BondLength(
+            created_by=user,
+            compound=compound,
+            subset=subset,
+            r_label=i,
+            element_a=element_a,
+            element_b=element_b,
+            bond_id=element_a + '-' + element_b)
+        if form.cleaned_data[f'R_{label}_X_{suffix}']:
+            try:
+                # Experimental R assignment
+                bond_obj.experimental_r = float(
+                    form.cleaned_data[f'R_{label}_X_{suffix}'])
+                bond_obj.save()
+                bond_objs = models.BondLength.objects.filter(
+                    bond_id=bond_obj.bond_id,
+                    experimental_r__isnull=False)
+                # Averaged R assignment
+                avg_r = bond_objs.aggregate(
+                    Avg('experimental_r'))['experimental_r__avg']
+                count_r = bond_objs.count()
+                bond_objs.update(averaged_r=avg_r, counter=count_r)
+            except Exception:
+                raise IngestionError(
+                    f'Can not process experimental_r of {bond_obj.bond_id}.',
+                    dataset)
+        elif models.BondLength.objects.filter(
+                bond_id=bond_obj.bond_id, experimental_r__isnull=False):
+            bond_objs = models.BondLength.objects.filter(
+                bond_id=bond_obj.bond_id,
+                experimental_r__isnull=False)
+            bond_obj.averaged_r = bond_objs[0].averaged_r
+            count_r = bond_objs.count()
+            count_r += 1
+            bond_objs.update(counter=count_r)
+            bond_obj.counter = count_r
+            bond_obj.save()
+        else:
+            bond_obj.save()
+
+    # Shannon R assignment
+    bond_obj_list = models.BondLength.objects.filter(
+        compound=compound, subset=subset).order_by('r_label')
+    if 'r_I' in r_dict and 'r_X' in r_dict:
+        bond_obj_list.filter(r_label=0).update(
+            shannon_r=r_dict['r_I']+r_dict['r_X'])
+    if 'r_II' in r_dict and 'r_X' in r_dict:
+        bond_obj_list.filter(r_label=1).update(
+            shannon_r=r_dict['r_II']+r_dict['r_X'])
+    if 'r_IV' in r_dict and 'r_X' in r_dict:
+        bond_obj_list.filter(r_label=2).update(
+            shannon_r=r_dict['r_IV']+r_dict['r_X'])
+
+    # Create tolerance factor objects
+    R_I_X_obj = models.BondLength.objects.filter(
+        compound=compound, subset=subset, r_label=0)[0]
+    R_II_X_obj = models.BondLength.objects.filter(
+        compound=compound, subset=subset, r_label=1)[0]
+    R_IV_X_obj = models.BondLength.objects.filter(
+        compound=compound, subset=subset, r_label=2)[0]
+    fields = ['shannon_r', 'experimental_r', 'averaged_r']
+    for i in range(3):
+        field = fields[i]
+        tf_obj = models.ToleranceFactor(
+            created_by=user,
+            compound=compound,
+            subset=subset,
+            data_source=i,
+            space_group=dataset.space_group)
+        if getattr(R_I_X_obj, field) and getattr(R_II_X_obj, field):
+            t_I = (math.sqrt((4 + math.sqrt(2)) / 3) *
+                   getattr(R_I_X_obj, field) / getattr(R_II_X_obj, field))
+            setattr(tf_obj, 't_I', t_I)
+        if getattr(R_IV_X_obj, field) and getattr(R_II_X_obj, field):
+            t_IV_V = (math.sqrt((4 + math.sqrt(2)) / 3) *
+                      getattr(R_IV_X_obj, field) / getattr(R_II_X_obj, field))
+            setattr(tf_obj, 't_IV_V', t_IV_V)
+        tf_obj.save()
+
+
+def queue_job(request):
+    """Store the submitted form and files as a new ingestion job."""
+    form_data = {key: request.POST.getlist(key) for key in request.POST}
+    job = models.IngestionJob.objects.create(
+        created_by=request.user, form_data=json.dumps(form_data))
+    for field_name in request.FILES:
+        for f in request.FILES.getlist(field_name):
+            job.files.create(field_name=field_name, uploaded_file=f)
+    logger.info(f'Queued ingestion job #{job.pk}')
+    return job
+
+
+def claim_job():
+    """Take the oldest queued job, or return None if there are none.
+
+    The row is locked while its state is changed so that several
+    workers can poll the same queue. With SKIP LOCKED, a worker simply
+    passes over the jobs that are being claimed by another worker.
+
+    """
+    skip_locked = connection.features.has_select_for_update_skip_locked
+    with transaction.atomic():
+        job = models.IngestionJob.objects.select_for_update(
+            skip_locked=skip_locked).filter(
+                state=models.IngestionJob.QUEUED).order_by('pk').first()
+        if job:
+            job.state = models.IngestionJob.PARSING
+            job.started = timezone.now()
+            job.save(update_fields=['state', 'started'])
+    return job
+
+
+def process_job(job):
+    """Validate and write the data of a claimed ingestion job.
+
+    Each data set is written in its own transaction and the progress
+    is saved only outside of it, so that the status endpoint reports
+    the data sets that have been committed and never holds a row lock
+    of the transaction. As with submit_data, the data sets written
+    before a failure are kept.
+
+    """
+    form = forms.AddDataForm(MultiValueDict(json.loads(job.form_data)))
+    if not form.is_valid():
+        return fail_job(job, form.errors.as_text())
+    files = MultiValueDict()
+    for job_file in job.files.all():
+        files.appendlist(job_file.field_name, File(
+            job_file.uploaded_file.open('rb'),
+            name=os.path.basename(job_file.uploaded_file.name)))
+    n_datasets = int(form.cleaned_data['number_of_datasets'])
+    progress = [{
+        'dataset': None,
+        'state': 'queued',
+        'subsets': [None]*int(
+            form.cleaned_data[f'number_of_subsets_{i_dataset}']),
+    } for i_dataset in range(1, n_datasets + 1)]
+    job.set_progress(progress)
+    job.state = models.IngestionJob.WRITING
+    job.save(update_fields=['state', 'progress'])
+
+    def report(i_dataset, i_subset, obj):
+        # Called within the transaction of the data set and only
+        # recorded in memory until it has been committed
+        entry = progress[i_dataset-1]
+        if i_subset is None:
+            entry['dataset'] = obj.pk
+            entry['state'] = 'done'
+        else:
+            entry['subsets'][i_subset-1] = obj.pk
+
+    def save_progress():
+        job.set_progress(progress)
+        job.save(update_fields=['progress'])
+
+    def discard(i_dataset):
+        # The rows of the failed data set were rolled back
+        if i_dataset is not None:
+            entry = progress[i_dataset-1]
+            entry['dataset'] = None
+            entry['state'] = 'failed'
+            entry['subsets'] = [None]*len(entry['subsets'])
+            job.set_progress(progress)
+
+    i_dataset = None
+    try:
+        with transaction.atomic():
+            compound = get_compound(form, job.created_by)
+        for i_dataset in range(1, n_datasets + 1):
+            progress[i_dataset-1]['state'] = 'writing'
+            save_progress()
+            with transaction.atomic():
+                save_dataset(form, files, job.created_by, compound, i_dataset,
+                             report)
+            save_progress()
+    except IngestionError as error:
+        discard(i_dataset)
+        return fail_job(job, str(error))
+    except Exception as error:
+        logger.exception(f'Ingestion job #{job.pk} failed')
+        discard(i_dataset)
+        return fail_job(job, repr(error))
+    finally:
+        for f_list in files.lists():
+            for f in f_list[1]:
+                f.close()
+    job.state = models.IngestionJob.DONE
+    job.finished = timezone.now()
+    job.save(update_fields=['state', 'finished', 'progress'])
+    for job_file in job.files.all():
+        job_file.uploaded_file.delete(save=False)
+    job.files.all().delete()
+    logger.info(f'Finished ingestion job #{job.pk}')
+    return job
+
+
+def fail_job(job, error):
+    """Mark the job as failed and record the reason."""
+    job.state = models.IngestionJob.FAILED
+    job.error = error
+    job.finished = timezone.now()
+    job.save(update_fields=['state', 'error', 'finished', 'progress'])
+    logger.warning(f'Ingestion job #{job.pk} failed: {error}')
+    return job
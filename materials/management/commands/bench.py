@@ -0,0 +1,85 @@
+# This file is covered by the BSD license. See LICENSE in the root directory.
+import json
+import os
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment
+from django.test.utils import teardown_test_environment
+from django.utils import timezone
+
+from materials import benchmark
+
+
+class Command(BaseCommand):
+    help = ('Time the main endpoints through the test client and write '
+            'p50/p95/p99 latencies, query counts, and peak memory use into '
+            'a JSON file. Use generate_synthetic first to get a database of '
+            'the desired size.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=20,
+                            help='Requests per endpoint (default: '
+                            '%(default)s)')
+        parser.add_argument('--endpoint', action='append',
+                            choices=benchmark.ENDPOINT_NAMES,
+                            help='Only time this endpoint (repeatable)')
+        parser.add_argument(
+            '--user', help='Staff user making the requests (default: first '
+            'superuser)')
+        parser.add_argument(
+            '--output', help='Results file (default: '
+            'bench-<date>-<time>.json)')
+        parser.add_argument(
+            '--compare', help='Results file of an earlier run to compare '
+            'the median latencies with')
+        parser.add_argument(
+            '--conn-max-age', type=int,
+            help='Override CONN_MAX_AGE, e.g., 0 to open a new database '
+            'connection for every request as without persistent '
+            'connections')
+
+    def handle(self, *args, **options):
+        User = get_user_model()
+        if options['user']:
+            user = User.objects.get(username=options['user'])
+        else:
+            user = User.objects.filter(is_superuser=True).first()
+            if not user:
+                raise CommandError('No superuser found; use --user.')
+        previous = {}
+        if options['compare']:
+            with open(options['compare']) as f:
+                previous = json.load(f)['endpoints']
+        if options['conn_max_age'] is not None:
+            connection.settings_dict['CONN_MAX_AGE'] = options[
+                'conn_max_age']
+            connection.close()
+        # Allows the test client's host name and keeps emails local
+        setup_test_environment()
+        try:
+            results = benchmark.run(user, options['repeat'],
+                                    options['endpoint'],
+                                    close_connections=True)
+        except ValueError as error:
+            raise CommandError(error)
+        finally:
+            teardown_test_environment()
+        output = options['output'] or (
+            f'bench-{timezone.now().strftime("%Y%m%d-%H%M%S")}.json')
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+        self.stdout.write(f'{"endpoint":16}{"p50":>10}{"p95":>10}'
+                          f'{"p99":>10}{"queries":>9}{"memory":>12}')
+        for name, result in results['endpoints'].items():
+            line = (f'{name:16}{result["p50_ms"]:>8.1f}ms'
+                    f'{result["p95_ms"]:>8.1f}ms{result["p99_ms"]:>8.1f}ms'
+                    f'{result["queries"]:>9}'
+                    f'{result["peak_memory_kib"]:>9.0f}KiB')
+            if name in previous:
+                change = result['p50_ms']/previous[name]['p50_ms'] - 1
+                line += f'  p50 {change:+.0%}'
+            self.stdout.write(line)
+        self.stdout.write(f'Results written to {os.path.abspath(output)}')
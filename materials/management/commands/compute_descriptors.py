@@ -0,0 +1,31 @@
+# This file is covered by the BSD license. See LICENSE in the root directory.
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from materials import descriptors
+from materials import models
+
+
+class Command(BaseCommand):
+    help = ('Compute the descriptors (volume, density, number of atoms, '
+            'and reduced formula) of all subsets with an atomic structure.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Number of subsets per transaction')
+        parser.add_argument('--missing', action='store_true',
+                            help='Only subsets without descriptors')
+
+    def handle(self, *args, **options):
+        subsets = models.Subset.objects.filter(
+            Q(lattice_constants__isnull=False) |
+            Q(atomic_coordinates__isnull=False))
+        if options['missing']:
+            subsets = subsets.filter(descriptor__isnull=True)
+        pks = list(subsets.values_list('pk', flat=True).distinct().order_by(
+            'pk'))
+        n_computed = 0
+        for start in range(0, len(pks), options['batch_size']):
+            n_computed += len(descriptors.update(
+                pks[start:start + options['batch_size']]))
+        self.stdout.write(f'{n_computed} descriptors computed')
@@ -0,0 +1,43 @@
+# This file is covered by the BSD license. See LICENSE in the root directory.
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from materials import snapshot
+
+
+class Command(BaseCommand):
+    help = ('Write a snapshot of compounds, data sets, subsets, curves, data '
+            'points, fixed values, and tolerance factors into compressed '
+            'columnar files, one per table. If the output directory '
+            'already contains a snapshot, only the data sets that have '
+            'changed since are read from the database.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory', help='Output directory')
+        parser.add_argument(
+            '--format', choices=snapshot.FORMATS, default='npz',
+            help='NumPy archives or Parquet files (requires pyarrow; '
+            'default: %(default)s)')
+        parser.add_argument(
+            '--full', action='store_true',
+            help='Read everything instead of refreshing the previous '
+            'snapshot.')
+        parser.add_argument('--chunk-size', type=int, default=2000,
+                            help='Number of rows read per query')
+
+    def handle(self, *args, **options):
+        try:
+            manifest = snapshot.write_snapshot(
+                options['directory'], options['format'], options['full'],
+                options['chunk_size'])
+        except ValueError as error:
+            raise CommandError(error)
+        if manifest['incremental']:
+            self.stdout.write(f'Refreshed {manifest["changed_datasets"]} '
+                              'changed data sets.')
+        elif manifest['mismatched_tables']:
+            self.stdout.write(
+                'Read everything again because the row counts of '
+                f'{", ".join(manifest["mismatched_tables"])} did not match.')
+        for name, n_rows in manifest['tables'].items():
+            self.stdout.write(f'{name}: {n_rows} rows')
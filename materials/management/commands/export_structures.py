@@ -0,0 +1,39 @@
+# This file is covered by the BSD license. See LICENSE in the root directory.
+from django.core.management.base import BaseCommand
+
+from materials import export
+
+
+class Command(BaseCommand):
+    help = ('Write the atomic structures of a compound, a property, or a '
+            'list of subsets into an extended XYZ file or a zip file of '
+            'CIF files. Without options, all structures are written.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', help='Output file')
+        parser.add_argument('--format', choices=export.STRUCTURE_FORMATS,
+                            default='extxyz',
+                            help='default: %(default)s')
+        parser.add_argument('--compound', type=int, help='Compound ID')
+        parser.add_argument('--property', type=int,
+                            help='Primary property ID')
+        parser.add_argument('--formula',
+                            help='Part of the formula of the compounds')
+        parser.add_argument('--subsets', type=int, nargs='+',
+                            help='Subset IDs')
+        parser.add_argument('--batch-size', type=int, default=200,
+                            help='Number of structures read at a time')
+
+    def handle(self, *args, **options):
+        subsets = export.select_subsets(
+            options['compound'], options['property'], options['formula'],
+            options['subsets'])
+        n_bytes = 0
+        with open(options['output'], 'wb') as f:
+            for chunk in export.stream_structures(
+                    subsets, options['format'], options['batch_size']):
+                if isinstance(chunk, str):
+                    chunk = chunk.encode()
+                f.write(chunk)
+                n_bytes += len(chunk)
+        self.stdout.write(f'{n_bytes} bytes written to {options["output"]}')
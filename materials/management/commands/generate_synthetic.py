@@ -0,0 +1,63 @@
+# This file is covered by the BSD license. See LICENSE in the root directory.
+import random
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.db import transaction
+
+from materials import models
+from materials import synthetic
+
+
+class Command(BaseCommand):
+    help = ('Fill the database with synthetic compounds for benchmarking. '
+            'Each compound gets data sets with curves, one with atomic '
+            'structures, and one with tolerance factors. Do not run this '
+            'on a production database.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--compounds', type=int, default=10,
+                            help='Number of compounds (default: %(default)s)')
+        parser.add_argument(
+            '--subsets', type=int, default=10,
+            help='Subsets per data set (default: %(default)s)')
+        parser.add_argument(
+            '--points', type=int, default=1000,
+            help='Data points per data set with curves (default: '
+            '%(default)s)')
+        parser.add_argument(
+            '--properties', type=int, default=3,
+            help='Data sets with curves per compound (default: '
+            '%(default)s)')
+        parser.add_argument(
+            '--space-groups', type=int, default=5,
+            help='Space groups of the tolerance factors (default: '
+            '%(default)s)')
+        parser.add_argument(
+            '--user', help='Creator of the data (default: first superuser)')
+        parser.add_argument('--seed', type=int,
+                            help='Seed of the random number generator')
+
+    def handle(self, *args, **options):
+        User = get_user_model()
+        if options['user']:
+            user = User.objects.get(username=options['user'])
+        else:
+            user = User.objects.filter(is_superuser=True).first()
+            if not user:
+                raise CommandError('No superuser found; use --user.')
+        random.seed(options['seed'])
+        existing = set(models.Compound.objects.values_list('formula',
+                                                           flat=True))
+        index = 0
+        for _ in range(options['compounds']):
+            while synthetic.formula(index) in existing:
+                index += 1
+            formula = synthetic.formula(index)
+            existing.add(formula)
+            with transaction.atomic():
+                synthetic.create_compound(
+                    user, formula, options['subsets'], options['points'],
+                    options['properties'], options['space_groups'])
+            self.stdout.write(f'Created {formula}')
@@ -0,0 +1,35 @@
+# This file is covered by the BSD license. See LICENSE in the root directory.
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from materials import models
+from materials import prerender
+
+
+class Command(BaseCommand):
+    help = ('Pre-render the compound pages and their JSON into '
+            'PRERENDER_ROOT for the web server to serve. Only compounds '
+            'whose data have changed since they were last rendered are '
+            'rendered again.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--compound', type=int, action='append',
+                            help='Only this compound (repeatable)')
+        parser.add_argument('--force', action='store_true',
+                            help='Render even if up to date')
+
+    def handle(self, *args, **options):
+        if not settings.PRERENDER_ROOT:
+            raise CommandError('Set PRERENDER_ROOT in .env first.')
+        pks = options['compound'] or models.Compound.objects.values_list(
+            'pk', flat=True).order_by('pk')
+        n_rendered = 0
+        for pk in pks:
+            if prerender.update_compound(pk, options['force']):
+                n_rendered += 1
+                self.stdout.write(f'Rendered compound {pk}')
+        if not options['compound']:
+            for pk in prerender.remove_deleted():
+                self.stdout.write(f'Removed deleted compound {pk}')
+        self.stdout.write(f'{n_rendered} compounds rendered')
@@ -0,0 +1,36 @@
+# This file is covered by the BSD license. See LICENSE in the root directory.
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from mainproject import settings
+from materials import ingestion
+
+
+class Command(BaseCommand):
+    help = ('Process queued ingestion jobs. Several workers may run at the '
+            'same time.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--once', action='store_true',
+            help='Exit when the queue is empty instead of polling for new '
+            'jobs.')
+        parser.add_argument(
+            '--sleep', type=float, default=settings.INGESTION_POLL_INTERVAL,
+            help='Seconds to wait between polls of an empty queue.')
+
+    def handle(self, *args, **options):
+        while True:
+            close_old_connections()
+            job = ingestion.claim_job()
+            if job:
+                self.stdout.write(f'Processing ingestion job #{job.pk}')
+                job = ingestion.process_job(job)
+                self.stdout.write(
+                    f'Ingestion job #{job.pk}: {job.get_state_display()}')
+            elif options['once']:
+                break
+            else:
+                time.sleep(options['sleep'])
@@ -0,0 +1,74 @@
+# This file is covered by the BSD license. See LICENSE in the root directory.
+import json
+import os
+import requests
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.db import transaction
+
+from mainproject import settings
+from materials import changes
+
+
+class Command(BaseCommand):
+    help = ('Mirror the contents of another MatD3 instance by applying its '
+            'change feed. The position in the feed is saved in a state '
+            'file, so that subsequent runs only fetch what has changed.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'url', help='Address of the other instance, e.g., '
+            'https://materials.hybrid3.duke.edu')
+        parser.add_argument(
+            '--user', help='User recorded as the creator of the mirrored '
+            'data (default: first superuser)')
+        parser.add_argument(
+            '--state-file',
+            default=os.path.join(settings.STATE_DIR, 'pull_changes.json'),
+            help='Where to store the cursor (default: %(default)s)')
+        parser.add_argument('--limit', type=int, default=500,
+                            help='Number of changes per request')
+
+    def handle(self, *args, **options):
+        User = get_user_model()
+        if options['user']:
+            user = User.objects.get(username=options['user'])
+        else:
+            user = User.objects.filter(is_superuser=True).first()
+            if not user:
+                raise CommandError('No superuser found; use --user.')
+        state = {'cursor': None, 'pending': []}
+        os.makedirs(os.path.dirname(os.path.abspath(options['state_file'])),
+                    exist_ok=True)
+        if os.path.isfile(options['state_file']):
+            with open(options['state_file']) as f:
+                state = json.load(f)
+        applier = changes.Applier(user)
+        applier.pending = state['pending']
+        feed_url = f'{options["url"].rstrip("/")}/materials/changes'
+        n_changes = 0
+        while True:
+            params = {'limit': options['limit']}
+            if state['cursor']:
+                params['cursor'] = state['cursor']
+            response = requests.get(feed_url, params=params)
+            if not response.ok:
+                raise CommandError(
+                    f'{feed_url} returned {response.status_code}: '
+                    f'{response.text}')
+            page = response.json()
+            with transaction.atomic():
+                applier.apply(page['changes'])
+            n_changes += len(page['changes'])
+            state = {'cursor': page['cursor'], 'pending': applier.pending}
+            with open(options['state_file'], 'w') as f:
+                json.dump(state, f)
+            if not page['has_more']:
+                break
+        self.stdout.write(f'Applied {n_changes} changes.')
+        if applier.pending:
+            self.stdout.write(
+                f'{len(applier.pending)} changes are waiting for objects '
+                'that are not in the feed yet.')
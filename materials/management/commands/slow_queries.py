@@ -0,0 +1,56 @@
+# This file is covered by the BSD license. See LICENSE in the root directory.
+import json
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+
+class Command(BaseCommand):
+    help = ('Summarize the slow query log: the call sites (or statements) '
+            'whose slow queries took the most time in total.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--file', default=settings.SLOW_QUERY_LOG,
+            help='Slow query log (default: %(default)s)')
+        parser.add_argument('--top', type=int, default=10,
+                            help='Number of entries to show')
+        parser.add_argument(
+            '--group-by', choices=('site', 'sql', 'path'), default='site',
+            help='Group by the code that issued the queries, by the SQL '
+            'statement, or by the request path (default: %(default)s)')
+
+    def handle(self, *args, **options):
+        if not options['file']:
+            raise CommandError('SLOW_QUERY_LOG is not set; use --file.')
+        if not os.path.isfile(options['file']):
+            raise CommandError(f'{options["file"]} does not exist.')
+        groups = {}
+        with open(options['file']) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                group = groups.setdefault(record[options['group_by']], {
+                    'count': 0, 'total': 0.0, 'max': 0.0,
+                    'example': record})
+                group['count'] += 1
+                group['total'] += record['ms']
+                if record['ms'] > group['max']:
+                    group['max'] = record['ms']
+                    group['example'] = record
+        worst = sorted(groups.items(), key=lambda item: -item[1]['total'])
+        for key, group in worst[:options['top']]:
+            example = group['example']
+            self.stdout.write(
+                f'{group["total"]:.0f} ms in {group["count"]} queries '
+                f'(max {group["max"]:.0f} ms): {key or "<unknown>"}')
+            if options['group_by'] != 'site':
+                self.stdout.write(f'  site: {example["site"]}')
+            if options['group_by'] != 'path':
+                self.stdout.write(f'  path: {example["path"]}')
+            if options['group_by'] != 'sql':
+                self.stdout.write(f'  sql:  {example["sql"][:200]}')
@@ -0,0 +1,48 @@
+# Generated by Django 3.0.7 on 2026-10-19 07:08
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('materials', '0032_ingestionjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Deletion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', models.CharField(max_length=20)),
+                ('object_pk', models.PositiveIntegerField()),
+                ('updated', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='reference',
+            name='updated',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddIndex(
+            model_name='chart',
+            index=models.Index(fields=['updated', 'id'], name='materials_c_updated_b2b0ae_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='dataset',
+            index=models.Index(fields=['updated', 'id'], name='materials_d_updated_168542_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='reference',
+            index=models.Index(fields=['updated', 'id'], name='materials_r_updated_1ac2c1_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='subset',
+            index=models.Index(fields=['updated', 'id'], name='materials_s_updated_4b6840_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='deletion',
+            index=models.Index(fields=['updated', 'id'], name='materials_d_updated_ee6264_idx'),
+        ),
+    ]
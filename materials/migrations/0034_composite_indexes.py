@@ -0,0 +1,29 @@
+# Generated by Django 3.0.7 on 2026-10-19 07:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('materials', '0033_change_feed'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='bondlength',
+            index=models.Index(fields=['bond_id', 'experimental_r'], name='bondlength_bond_experimental'),
+        ),
+        migrations.AddIndex(
+            model_name='datapoint',
+            index=models.Index(fields=['chart', 'point_counter'], name='datapoint_chart_counter'),
+        ),
+        migrations.AddIndex(
+            model_name='dataset',
+            index=models.Index(fields=['compound', 'primary_property', 'updated'], name='dataset_compound_property'),
+        ),
+        migrations.AddIndex(
+            model_name='tolerancefactor',
+            index=models.Index(fields=['data_source', 'space_group', 'compound'], name='tolerance_source_group'),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 3.0.7 on 2026-10-19 07:49
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('materials', '0034_composite_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StructureDescriptor',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('volume', models.FloatField(blank=True, null=True)),
+                ('density', models.FloatField(blank=True, null=True)),
+                ('n_atoms', models.PositiveIntegerField(blank=True, null=True)),
+                ('reduced_formula', models.CharField(blank=True, max_length=200)),
+                ('subset', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='descriptor', to='materials.Subset')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='structuredescriptor',
+            index=models.Index(fields=['volume'], name='descriptor_volume'),
+        ),
+        migrations.AddIndex(
+            model_name='structuredescriptor',
+            index=models.Index(fields=['density'], name='descriptor_density'),
+        ),
+        migrations.AddIndex(
+            model_name='structuredescriptor',
+            index=models.Index(fields=['n_atoms'], name='descriptor_n_atoms'),
+        ),
+        migrations.AddIndex(
+            model_name='structuredescriptor',
+            index=models.Index(fields=['reduced_formula'], name='descriptor_formula'),
+        ),
+    ]
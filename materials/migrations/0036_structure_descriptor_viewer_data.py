@@ -0,0 +1,18 @@
+# Generated by Django 3.0.7 on 2026-10-19 07:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('materials', '0035_structure_descriptors'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='structuredescriptor',
+            name='viewer_data',
+            field=models.TextField(blank=True),
+        ),
+    ]
@@ -0,0 +1,88 @@
+# Generated by Django 3.0.7 on 2026-10-19 08:30
+
+from django.db import migrations, models
+from django.db.models import F
+import django.utils.timezone
+
+
+def copy_updated(apps, schema_editor):
+    """Start the change feed from the existing update times."""
+    for name in ('Dataset', 'Subset', 'Chart'):
+        apps.get_model('materials', name).objects.update(
+            modified=F('updated'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('materials', '0036_structure_descriptor_viewer_data'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='chart',
+            name='materials_c_updated_b2b0ae_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='dataset',
+            name='materials_d_updated_168542_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='deletion',
+            name='materials_d_updated_ee6264_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='reference',
+            name='materials_r_updated_1ac2c1_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='subset',
+            name='materials_s_updated_4b6840_idx',
+        ),
+        migrations.RenameField(
+            model_name='deletion',
+            old_name='updated',
+            new_name='modified',
+        ),
+        migrations.RenameField(
+            model_name='reference',
+            old_name='updated',
+            new_name='modified',
+        ),
+        migrations.AddField(
+            model_name='chart',
+            name='modified',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='dataset',
+            name='modified',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='subset',
+            name='modified',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.RunPython(copy_updated, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='chart',
+            index=models.Index(fields=['modified', 'id'], name='materials_c_modifie_40e4ea_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='dataset',
+            index=models.Index(fields=['modified', 'id'], name='materials_d_modifie_a1fa5c_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='deletion',
+            index=models.Index(fields=['modified', 'id'], name='materials_d_modifie_2fcb25_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='reference',
+            index=models.Index(fields=['modified', 'id'], name='materials_r_modifie_199708_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='subset',
+            index=models.Index(fields=['modified', 'id'], name='materials_s_modifie_c12129_idx'),
+        ),
+    ]
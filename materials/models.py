@@ -1,4 +1,5 @@
 # This file is covered by the BSD license. See LICENSE in the root directory.
+import json
 import logging
 import os
 import shutil
@@ -71,6 +72,11 @@ class Reference(models.Model):
     pages_end = models.CharField(max_length=10)
     year = models.CharField(max_length=4)
     doi_isbn = models.CharField(max_length=100, blank=True)
+    # Time of the last change of any kind, for the change feed
+    modified = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [models.Index(fields=['modified', 'id'])]
 
     def __str__(self):
         text = (f'{self.year} {"- " if self.year else ""} '
@@ -163,7 +169,18 @@ class Dataset(Base):
         SpaceGroup, on_delete=models.PROTECT, related_name='datasets')
     update_comments = models.CharField(blank=True, max_length=300) # reason for updating
     verified_by = models.ManyToManyField(get_user_model())
+    # Time of the last change of any kind, including the details and
+    # contents of the data set, for the change feed. Unlike updated,
+    # this is not the version time shown to users.
+    modified = models.DateTimeField(default=timezone.now)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['modified', 'id']),
+            # Latest version of a property of a compound
+            models.Index(fields=['compound', 'primary_property', 'updated'],
+                         name='dataset_compound_property'),
+        ]
 
     def __str__(self):
         return f'{self.compound}: {self.primary_property}'
@@ -271,6 +288,11 @@ class Subset(Base):
     input_data_file = models.FileField(upload_to=data_file_path, null=True, blank=True)
     reference = models.ForeignKey(
         Reference, on_delete=models.PROTECT, related_name='subsets', null=True, blank=True)
+    # See Dataset.modified
+    modified = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [models.Index(fields=['modified', 'id'])]
 
     def __str__(self):
         return f'Subset: {self.pk} {self.title if self.title else ""}'
@@ -303,7 +325,8 @@ class Subset(Base):
     def get_lattice_constants(self):
         """Return lattice constants and angles."""
         symbols = ['a', 'b', 'c', 'α', 'β', 'γ']
-        obj = self.lattice_constants.first()
+        # Indexing uses the prefetched lattice constants if there are any
+        obj = self.lattice_constants.all()[0]
         values_float = [obj.a, obj.b, obj.c, obj.alpha, obj.beta, obj.gamma]
         units = [' ', ' ', ' ', '°', '°', '°']
         values = []
@@ -404,6 +427,11 @@ class Chart(Base):
     y_unit = models.CharField(max_length=20, blank=True)
     legend = models.CharField(max_length=100, blank=True)
     curve_counter = models.PositiveSmallIntegerField(default=0)
+    # See Dataset.modified
+    modified = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [models.Index(fields=['modified', 'id'])]
 
     def __str__(self):
         return f'{self.y_title} - {self.x_title} (legend: {self.legend})'
@@ -418,6 +446,10 @@ class Datapoint(Base):
     y_value = models.FloatField()
     point_counter = models.PositiveSmallIntegerField(default=0)
 
+    class Meta:
+        indexes = [models.Index(fields=['chart', 'point_counter'],
+                                name='datapoint_chart_counter')]
+
 
 class LatticeConstant(Base):
     """Store lattice constants of atomic structure.
@@ -443,6 +475,32 @@ class AtomicCoordinate(Base):
     element = models.CharField(max_length=20, blank=True)
 
 
+class StructureDescriptor(models.Model):
+    """Quantities derived from an atomic structure (see descriptors.py).
+
+    Volume is in Å³ and density in g/cm³, assuming that the structure
+    is given in Å. viewer_data is what JSmol loads (see
+    structures.viewer_data).
+    """
+    subset = models.OneToOneField(
+        Subset, on_delete=models.CASCADE, related_name='descriptor')
+    volume = models.FloatField(null=True, blank=True)
+    density = models.FloatField(null=True, blank=True)
+    n_atoms = models.PositiveIntegerField(null=True, blank=True)
+    reduced_formula = models.CharField(max_length=200, blank=True)
+    # CIF or XYZ file of the structure for the 3D viewer
+    viewer_data = models.TextField(blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['volume'], name='descriptor_volume'),
+            models.Index(fields=['density'], name='descriptor_density'),
+            models.Index(fields=['n_atoms'], name='descriptor_n_atoms'),
+            models.Index(fields=['reduced_formula'],
+                         name='descriptor_formula'),
+        ]
+
+
 class ShannonIonicRadii(Base):
     # Define element labels
     I = 0
@@ -527,6 +585,11 @@ class BondLength(Base):
     shannon_r = models.FloatField(null=True, blank=True)
     counter = models.PositiveSmallIntegerField(default=0)
 
+    class Meta:
+        # Averaging of the experimental bond lengths of a given bond
+        indexes = [models.Index(fields=['bond_id', 'experimental_r'],
+                                name='bondlength_bond_experimental')]
+
     def __str__(self):
         return f'{self.compound} - {self.subset} - {self.R_LABELS[self.r_label][1]}'
 
@@ -551,5 +614,72 @@ class ToleranceFactor(Base):
     t_I = models.FloatField(null=True, blank=True)
     t_IV_V = models.FloatField(null=True, blank=True)
 
+    class Meta:
+        indexes = [models.Index(fields=['data_source', 'space_group',
+                                        'compound'],
+                                name='tolerance_source_group')]
+
+    def __str__(self):
+        return f'{self.compound} - {self.subset} - {self.DATA_SOURCES[self.data_source][1]}'
+
+
+def ingestion_file_path(instance, filename):
+    return os.path.join('ingestion', f'job_{instance.job.pk}', filename)
+
+
+class IngestionJob(Base):
+    """Submitted data waiting to be written into the database.
+
+    The contents of the submitted form are stored as JSON and the job
+    is processed by the process_ingestion_jobs management command.
+    """
+    QUEUED = 0
+    PARSING = 1
+    WRITING = 2
+    DONE = 3
+    FAILED = 4
+    STATES = (
+        (QUEUED, 'queued'),
+        (PARSING, 'parsing'),
+        (WRITING, 'writing'),
+        (DONE, 'done'),
+        (FAILED, 'failed'),
+    )
+    state = models.PositiveSmallIntegerField(
+        default=QUEUED, choices=STATES, db_index=True)
+    form_data = models.TextField()
+    # JSON list with an entry for each data set
+    progress = models.TextField(blank=True)
+    error = models.TextField(blank=True)
+    started = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f'Ingestion job {self.pk}: {self.STATES[self.state][1]}'
+
+    def get_progress(self):
+        return json.loads(self.progress) if self.progress else []
+
+    def set_progress(self, progress):
+        self.progress = json.dumps(progress)
+
+
+class IngestionFile(models.Model):
+    """File uploaded together with the form of an ingestion job."""
+    job = models.ForeignKey(
+        IngestionJob, on_delete=models.CASCADE, related_name='files')
+    field_name = models.CharField(max_length=100)
+    uploaded_file = models.FileField(upload_to=ingestion_file_path)
+
+
+class Deletion(models.Model):
+    """Record of a deleted object, used by the change feed."""
+    model = models.CharField(max_length=20)
+    object_pk = models.PositiveIntegerField()
+    modified = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [models.Index(fields=['modified', 'id'])]
+
     def __str__(self):
-        return f'{self.compound} - {self.subset} - {self.DATA_SOURCES[self.data_source][1]}'
\ No newline at end of file
+        return f'{self.model} {self.object_pk} deleted on {self.modified}'
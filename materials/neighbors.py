@@ -0,0 +1,140 @@
+# This file is covered by the BSD license. See LICENSE in the root directory.
+"""Periodic neighbor lists and bond lengths of atomic structures.
+
+neighbor_list finds all pairs of atoms closer than a cutoff with a
+cell list: the unit cell is divided into bins at least as wide as the
+cutoff, so that the neighbors of an atom can only be in the adjacent
+bins (or their periodic images). All atoms are processed at once for
+each of the (usually 27) bin offsets, which makes the cost linear in
+the number of atoms.
+
+propose_bond_lengths uses the neighbor lists to suggest the I-X, II-X,
+and IV-X bond lengths of the tolerance factor workflow from a stored
+structure (see views.bond_lengths).
+
+"""
+import itertools
+
+import numpy
+
+# Initial cutoff in the unit of the coordinates (usually Å). It is
+# doubled until every atom has a neighbor or MAX_CUTOFF is reached.
+DEFAULT_CUTOFF = 5.0
+MAX_CUTOFF = 20.0
+# Keys of the proposals, named after the fields of the form
+BOND_LABELS = (('I', 'R_I_X'), ('II', 'R_II_X'), ('IV', 'R_IV_X'))
+
+
+def periodic_cell(structure, cutoff):
+    """Return a lattice and the fractional positions of the atoms.
+
+    Molecules are put into a box that is larger than the molecule by
+    the cutoff, so that no periodic image is within the cutoff.
+    """
+    if structure.lattice is not None:
+        lattice = structure.lattice
+        positions = structure.fractional_positions()
+    else:
+        positions = structure.positions
+        lower = positions.min(axis=0)
+        lattice = numpy.diag(positions.max(axis=0) - lower + cutoff + 1)
+        positions = (positions - lower) / lattice.diagonal()
+    return lattice, positions % 1.0
+
+
+def neighbor_list(lattice, positions, cutoff):
+    """Return indices i, j and distances of pairs closer than cutoff.
+
+    positions are fractional. Each pair is listed in both directions,
+    and an atom can be paired with its own periodic images.
+    """
+    n_atoms = len(positions)
+    empty = (numpy.zeros(0, dtype=int), numpy.zeros(0, dtype=int),
+             numpy.zeros(0))
+    if not n_atoms:
+        return empty
+    # Distances between opposite faces of the cell
+    widths = abs(numpy.linalg.det(lattice)) / numpy.linalg.norm(
+        numpy.cross(lattice[[1, 2, 0]], lattice[[2, 0, 1]]), axis=1)
+    max_bins = max(1, int(numpy.ceil(n_atoms**(1/3))))
+    n_bins = numpy.clip((widths/cutoff).astype(int), 1, max_bins)
+    # Number of adjacent bins to search along each axis
+    reach = numpy.ceil(cutoff/(widths/n_bins)).astype(int)
+    bins = numpy.minimum((positions*n_bins).astype(int), n_bins - 1)
+    bin_ids = numpy.ravel_multi_index(bins.T, n_bins)
+    order = numpy.argsort(bin_ids, kind='stable')
+    counts = numpy.bincount(bin_ids, minlength=n_bins.prod())
+    starts = numpy.cumsum(counts) - counts
+    cartesian = positions @ lattice
+    all_i, all_j, all_d = [], [], []
+    for offset in itertools.product(*(range(-r, r + 1) for r in reach)):
+        target = bins + offset
+        shifts = numpy.floor_divide(target, n_bins)
+        target -= shifts*n_bins
+        target_ids = numpy.ravel_multi_index(target.T, n_bins)
+        n_candidates = counts[target_ids]
+        total = n_candidates.sum()
+        if not total:
+            continue
+        i = numpy.repeat(numpy.arange(n_atoms), n_candidates)
+        first = numpy.cumsum(n_candidates) - n_candidates
+        j = order[numpy.repeat(starts[target_ids], n_candidates) +
+                  numpy.arange(total) - numpy.repeat(first, n_candidates)]
+        distances = numpy.linalg.norm(
+            cartesian[j] + shifts[i] @ lattice - cartesian[i], axis=1)
+        # Distance zero is the atom itself
+        mask = (distances < cutoff) & (distances > 1e-8)
+        all_i.append(i[mask])
+        all_j.append(j[mask])
+        all_d.append(distances[mask])
+    if not all_i:
+        return empty
+    return (numpy.concatenate(all_i), numpy.concatenate(all_j),
+            numpy.concatenate(all_d))
+
+
+def nearest_distances(structure, element_a, element_b,
+                      cutoff=DEFAULT_CUTOFF):
+    """Return the distance of each atom of element_a to element_b.
+
+    The distance is to the nearest atom of element_b or any of its
+    periodic images, and infinite if none is within MAX_CUTOFF.
+    """
+    elements = numpy.array(structure.elements)
+    selected = numpy.flatnonzero((elements == element_a) |
+                                 (elements == element_b))
+    is_a = elements[selected] == element_a
+    is_b = elements[selected] == element_b
+    nearest = numpy.full(is_a.sum(), numpy.inf)
+    if not is_a.any() or not is_b.any():
+        return nearest
+    # Index of each atom of element_a among the atoms of element_a
+    a_index = numpy.cumsum(is_a) - 1
+    while True:
+        lattice, positions = periodic_cell(structure, cutoff)
+        i, j, distances = neighbor_list(lattice, positions[selected], cutoff)
+        mask = is_a[i] & is_b[j]
+        numpy.minimum.at(nearest, a_index[i[mask]], distances[mask])
+        if numpy.isfinite(nearest).all() or cutoff >= MAX_CUTOFF:
+            return nearest
+        cutoff = min(2*cutoff, MAX_CUTOFF)
+
+
+def propose_bond_lengths(structure, elements):
+    """Return proposed bond lengths keyed by the form fields.
+
+    elements maps "I", "II", "IV", and "X" to chemical symbols (those
+    that are missing are skipped). Each bond length is the average over
+    the atoms of the cation of the distance to the nearest anion.
+    """
+    proposals = {}
+    if not elements.get('X'):
+        return proposals
+    for label, key in BOND_LABELS:
+        if not elements.get(label):
+            continue
+        distances = nearest_distances(structure, elements[label],
+                                      elements['X'])
+        if len(distances) and numpy.isfinite(distances).all():
+            proposals[key] = float(distances.mean())
+    return proposals
@@ -0,0 +1,162 @@
+# This file is covered by the BSD license. See LICENSE in the root directory.
+"""Pre-render compound pages into static files for the web server.
+
+For each compound, the compound page and the JSON it loads (data set
+details, data set versions, and curves) are rendered as seen by an
+anonymous visitor and written into PRERENDER_ROOT under their URL
+paths, with .html or .json appended. The web server can then serve
+them without reaching gunicorn (see doc/matd3.conf). The files are
+rendered without query parameters, so requests with a query string
+(e.g., data-for-chart with ?x_unit=) must never be answered from
+PRERENDER_ROOT; the nginx configuration sends them to gunicorn. Next
+to the files of each compound, a manifest records the data version of
+the compound (see caching.py) that the files were rendered from, so
+that only compounds whose data have changed are rendered again.
+
+Files are rendered by ./manage.py prerender and, whenever a compound
+changes, right after the transaction is committed (see signals.py).
+
+"""
+import json
+import logging
+import os
+import tempfile
+
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.shortcuts import reverse
+from django.test import RequestFactory
+from django.urls import resolve
+
+from . import caching
+from . import models
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_DIRECTORY = 'manifests'
+
+
+def manifest_path(pk):
+    return os.path.join(settings.PRERENDER_ROOT, MANIFEST_DIRECTORY,
+                        f'{pk}.json')
+
+
+def read_manifest(pk):
+    try:
+        with open(manifest_path(pk)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def write_file(path, content):
+    """Write the file atomically so that it is never served half-written."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    descriptor, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                            prefix='.', suffix='.tmp')
+    with os.fdopen(descriptor, 'wb') as f:
+        f.write(content)
+    os.chmod(tmp_path, 0o644)
+    os.replace(tmp_path, path)
+
+
+def get_urls(compound):
+    """Return the URLs of the pages and JSON of a compound."""
+    urls = [reverse('materials:compound', kwargs={'pk': compound.pk})]
+    properties = set()
+    for dataset_pk, property_pk in compound.datasets.values_list(
+            'pk', 'primary_property'):
+        urls.append(reverse('materials:dataset_details',
+                            kwargs={'pk': dataset_pk}))
+        properties.add(property_pk)
+    for property_pk in sorted(properties):
+        urls.append(reverse('materials:dataset_versions', kwargs={
+            'compound_pk': compound.pk, 'property_pk': property_pk}))
+    for subset_pk in models.Subset.objects.filter(
+            dataset__compound=compound, curves__isnull=False).distinct(
+            ).values_list('pk', flat=True):
+        urls.append(reverse('materials:data_for_chart',
+                            kwargs={'pk': subset_pk}))
+    return urls
+
+
+def render(url):
+    """Return the response of an anonymous GET request to url."""
+    request = RequestFactory().get(url)
+    request.user = AnonymousUser()
+    request.resolver_match = match = resolve(url)
+    response = match.func(request, *match.args, **match.kwargs)
+    if callable(getattr(response, 'render', None)):
+        response.render()
+    return response
+
+
+def remove_file(name):
+    path = os.path.join(settings.PRERENDER_ROOT, name)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def remove_files(pk):
+    for name in read_manifest(pk).get('files', []):
+        remove_file(name)
+    if os.path.exists(manifest_path(pk)):
+        os.remove(manifest_path(pk))
+
+
+def update_compound(pk, force=False):
+    """Render the files of a compound unless they are up to date.
+
+    Return whether the files were rendered. The files of deleted
+    compounds are removed.
+    """
+    version = caching.get_compound_version(pk)
+    manifest = read_manifest(pk)
+    if manifest.get('version') == version and not force:
+        return False
+    compound = models.Compound.objects.filter(pk=pk).first()
+    if compound is None:
+        remove_files(pk)
+        return False
+    files = []
+    for url in get_urls(compound):
+        response = render(url)
+        if response.status_code != 200:
+            continue
+        extension = 'json' if 'json' in response['Content-Type'] else 'html'
+        name = f'{url.lstrip("/")}.{extension}'
+        write_file(os.path.join(settings.PRERENDER_ROOT, name),
+                   response.content)
+        files.append(name)
+    for name in set(manifest.get('files', [])) - set(files):
+        remove_file(name)
+    write_file(manifest_path(pk), json.dumps(
+        {'version': version, 'files': files}).encode())
+    return True
+
+
+def update_compounds(pks):
+    """Render the changed compounds and remove the files of failures.
+
+    Called after commit, so errors are logged rather than raised.
+    """
+    for pk in pks:
+        try:
+            update_compound(pk)
+        except Exception:
+            logger.exception(f'Could not pre-render compound {pk}')
+            remove_files(pk)
+
+
+def remove_deleted():
+    """Remove the files of compounds that no longer exist."""
+    directory = os.path.join(settings.PRERENDER_ROOT, MANIFEST_DIRECTORY)
+    if not os.path.isdir(directory):
+        return []
+    pks = {int(filename[:-len('.json')])
+           for filename in os.listdir(directory) if filename.endswith('.json')}
+    deleted = pks - set(models.Compound.objects.filter(
+        pk__in=pks).values_list('pk', flat=True))
+    for pk in deleted:
+        remove_files(pk)
+    return sorted(deleted)
@@ -2,6 +2,7 @@
 from rest_framework import serializers
 
 from . import models
+from . import units
 
 
 class BaseSerializer(serializers.ModelSerializer):
@@ -63,9 +64,14 @@ class PropertySerializer(serializers.ModelSerializer):
 
 
 class UnitSerializer(serializers.ModelSerializer):
+    definition = serializers.SerializerMethodField()
+
     class Meta:
         model = models.Unit
-        fields = ('pk', 'label')
+        fields = ('pk', 'label', 'definition')
+
+    def get_definition(self, obj):
+        return units.describe(obj.label)
 
 
 class SpaceGroupSerializer(serializers.ModelSerializer):
@@ -74,6 +80,12 @@ class SpaceGroupSerializer(serializers.ModelSerializer):
         fields = ('pk', 'name')
 
 
+class StructureDescriptorSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = models.StructureDescriptor
+        fields = ('subset', 'volume', 'density', 'n_atoms', 'reduced_formula')
+
+
 class DatasetSerializerInfo(serializers.ModelSerializer):
     sample_type = serializers.CharField(source='get_sample_type_display')
 
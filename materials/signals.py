@@ -1,8 +1,19 @@
 # This file is covered by the BSD license. See LICENSE in the root directory.
-from django.dispatch import receiver
+from django.apps import apps
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
 from django.db.models.signals import m2m_changed
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_save
+from django.db.models.signals import pre_delete
+from django.db.models.signals import pre_save
+from django.dispatch import receiver
+from django.utils import timezone
 
+from . import caching
 from . import models
+from . import prerender
 
 
 # @receiver(m2m_changed, sender=models.Dataset.linked_to.through)
@@ -25,3 +36,130 @@ from . import models
 #                 dataset_j = all_datasets[j]
 #                 if dataset_j not in dataset_i.linked_to.all():
 #                     dataset_i.linked_to.add(dataset_j)
+
+
+def set_modified(sender, instance, raw=False, **kwargs):
+    """Record the time of the last change for the change feed.
+
+    This is set however the object is saved, unlike "updated", which is
+    the version time shown to users. Objects loaded from fixtures keep
+    their timestamps.
+    """
+    if not raw:
+        instance.modified = timezone.now()
+
+
+for model in apps.get_app_config('materials').get_models():
+    if any(field.name == 'modified' for field in model._meta.fields):
+        pre_save.connect(set_modified, sender=model)
+
+
+@receiver(post_delete, sender=models.Reference)
+@receiver(post_delete, sender=models.Dataset)
+@receiver(post_delete, sender=models.Subset)
+@receiver(post_delete, sender=models.Chart)
+def record_deletion(sender, instance, **kwargs):
+    """Let the change feed know that an object has been deleted."""
+    models.Deletion.objects.create(model=sender._meta.model_name,
+                                   object_pk=instance.pk)
+
+
+@receiver(post_save, sender=models.Datapoint)
+def touch_chart(sender, instance, **kwargs):
+    """Mark the curve as modified when one of its points is edited."""
+    models.Chart.objects.filter(pk=instance.chart_id).update(
+        modified=timezone.now())
+
+
+@receiver(post_save, sender=models.SynthesisMethod)
+@receiver(post_save, sender=models.ExperimentalDetails)
+@receiver(post_save, sender=models.ComputationalDetails)
+@receiver(post_delete, sender=models.SynthesisMethod)
+@receiver(post_delete, sender=models.ExperimentalDetails)
+@receiver(post_delete, sender=models.ComputationalDetails)
+def touch_dataset(sender, instance, **kwargs):
+    """Mark the data set as modified when its details are edited."""
+    models.Dataset.objects.filter(pk=instance.dataset_id).update(
+        modified=timezone.now())
+
+
+@receiver(post_save, sender=models.Comment)
+@receiver(post_save, sender=models.ExternalRepository)
+@receiver(post_delete, sender=models.Comment)
+@receiver(post_delete, sender=models.ExternalRepository)
+def touch_dataset_of_details(sender, instance, **kwargs):
+    """Mark the data set as modified when a comment or link is edited."""
+    details = Q()
+    for field, related_name in (('synthesis_method', 'synthesis'),
+                                ('experimental_details', 'experimental'),
+                                ('computational_details', 'computational')):
+        pk = getattr(instance, f'{field}_id', None)
+        if pk is not None:
+            details |= Q(**{related_name: pk})
+    if details:
+        models.Dataset.objects.filter(details).update(modified=timezone.now())
+
+
+@receiver(post_save, sender=models.FixedPropertyValue)
+@receiver(post_save, sender=models.LatticeConstant)
+@receiver(post_save, sender=models.AtomicCoordinate)
+@receiver(post_save, sender=models.ShannonIonicRadii)
+@receiver(post_save, sender=models.BondLength)
+@receiver(post_save, sender=models.ToleranceFactor)
+def touch_subset(sender, instance, **kwargs):
+    """Mark the subset as modified when its contents are edited."""
+    models.Subset.objects.filter(pk=instance.subset_id).update(
+        modified=timezone.now())
+
+
+def bump_version(sender, **kwargs):
+    """Invalidate the values cached for this model (see caching.py)."""
+    caching.bump(sender)
+
+
+def bump_compound_versions(sender, instance, **kwargs):
+    """Invalidate the values cached for the compound of this object.
+
+    This is done before deleting because afterwards the compound can no
+    longer be looked up.
+    """
+    if sender is models.Dataset:
+        caching.bump_compounds([instance.compound_id])
+    else:
+        caching.bump_compounds(caching.get_compound_pks(sender, [instance.pk]))
+
+
+def bump_m2m_versions(sender, instance, action, model, pk_set, **kwargs):
+    if not action.startswith('post_'):
+        return
+    for changed_model in type(instance), model:
+        if changed_model._meta.app_label in caching.VERSIONED_APPS:
+            caching.bump(changed_model)
+    if type(instance) in caching.COMPOUND_LOOKUPS:
+        caching.bump_compounds(caching.get_compound_pks(type(instance),
+                                                        [instance.pk]))
+    if model in caching.COMPOUND_LOOKUPS and pk_set:
+        caching.bump_compounds(caching.get_compound_pks(model, pk_set))
+
+
+# The receivers above are only connected to the models that have
+# version counters so that saving other objects (sessions, log entries,
+# ...) costs nothing extra.
+for model in apps.get_models():
+    if model._meta.app_label not in caching.VERSIONED_APPS:
+        continue
+    post_save.connect(bump_version, sender=model)
+    post_delete.connect(bump_version, sender=model)
+    for field in model._meta.local_many_to_many:
+        m2m_changed.connect(bump_m2m_versions,
+                            sender=field.remote_field.through)
+for model in caching.COMPOUND_LOOKUPS:
+    post_save.connect(bump_compound_versions, sender=model)
+    pre_delete.connect(bump_compound_versions, sender=model)
+
+
+@receiver(caching.compounds_changed)
+def prerender_compounds(sender, pks, **kwargs):
+    """Update the pre-rendered files of the compounds after commit."""
+    if settings.PRERENDER_ROOT:
+        transaction.on_commit(lambda: prerender.update_compounds(pks))
@@ -0,0 +1,315 @@
+# This file is covered by the BSD license. See LICENSE in the root directory.
+"""In-memory index for finding structures with similar unit cells.
+
+Each worker keeps the lattice constants of all subsets in a KD-tree
+over normalized cell parameters: the logarithms of the lengths in
+units of LENGTH_SCALE and the angles in units of ANGLE_SCALE, so that
+a 5% difference in a length weighs as much as 5° in an angle. The
+lengths are sorted together with their opposite angles, so that the
+same cell with permuted axes is found too. Optionally, the distance
+between the compositions (fractions of each element) of the compounds
+is added with the weight COMPOSITION_WEIGHT.
+
+The index is brought up to date before each search if the version
+counters of the lattice constants or compounds have changed (see
+caching.py). New and changed rows go into a small buffer that is
+searched by brute force, and the tree is rebuilt once the buffer
+grows beyond the square root of the size of the index.
+
+"""
+import heapq
+import math
+import re
+import threading
+
+import numpy
+from django.utils import timezone
+
+from . import caching
+from . import models
+
+LENGTH_SCALE = 0.05
+ANGLE_SCALE = 5.0
+COMPOSITION_WEIGHT = 10.0
+LEAF_SIZE = 16
+CELL_FIELDS = ('a', 'b', 'c', 'alpha', 'beta', 'gamma')
+
+_lock = threading.RLock()
+_index = None
+
+
+def count_elements(formula):
+    """Return the number of atoms of each element, e.g., of "(CH3NH3)PbI3".
+
+    The elements are in the order of their first appearance.
+    """
+    stack = [{}]
+    for match in re.finditer(
+            r'([A-Z][a-z]?)(\d*\.?\d*)|(\()|\)(\d*\.?\d*)', formula):
+        element, count, opening, group_count = match.groups()
+        if element:
+            stack[-1][element] = (stack[-1].get(element, 0) +
+                                  float(count or 1))
+        elif opening:
+            stack.append({})
+        elif len(stack) > 1:
+            group = stack.pop()
+            for element, count in group.items():
+                stack[-1][element] = (stack[-1].get(element, 0) +
+                                      count*float(group_count or 1))
+    return stack[0]
+
+
+def parse_formula(formula):
+    """Return the fraction of each element in the formula."""
+    counts = count_elements(formula)
+    total = sum(counts.values())
+    if not total:
+        return {}
+    return {element: count/total for element, count in counts.items()}
+
+
+def composition_distance(first, second):
+    return math.sqrt(sum((first.get(element, 0) - second.get(element, 0))**2
+                         for element in set(first) | set(second)))
+
+
+def normalize(cells):
+    """Return the features of an array of (a, b, c, alpha, beta, gamma)."""
+    cells = numpy.asarray(cells, dtype=float).reshape(-1, 6)
+    order = numpy.argsort(cells[:, :3], axis=1, kind='stable')
+    lengths = numpy.take_along_axis(cells[:, :3], order, axis=1)
+    angles = numpy.take_along_axis(cells[:, 3:], order, axis=1)
+    return numpy.hstack((numpy.log(numpy.maximum(lengths, 1e-9)) /
+                         LENGTH_SCALE, angles/ANGLE_SCALE))
+
+
+class KDTree:
+    """Static KD-tree whose leaves hold at most LEAF_SIZE points.
+
+    The points are permuted so that each node covers a contiguous
+    range of them, and each node stores the bounding box of its points.
+    """
+    def __init__(self, points, dimensions=6):
+        self.points = numpy.asarray(points, dtype=float).reshape(
+            -1, dimensions)
+        self.indices = numpy.arange(len(self.points))
+        # Per node: start, end, left child, right child (-1 for leaves)
+        self.nodes = []
+        self.lower = []
+        self.upper = []
+        if len(self.points):
+            self.build(0, len(self.points))
+        self.lower = numpy.array(self.lower)
+        self.upper = numpy.array(self.upper)
+
+    def build(self, start, end):
+        node = len(self.nodes)
+        points = self.points[self.indices[start:end]]
+        self.nodes.append([start, end, -1, -1])
+        self.lower.append(points.min(axis=0))
+        self.upper.append(points.max(axis=0))
+        if end - start > LEAF_SIZE:
+            dim = numpy.argmax(self.upper[node] - self.lower[node])
+            middle = (end - start)//2
+            indices = self.indices[start:end]
+            self.indices[start:end] = indices[numpy.argpartition(
+                points[:, dim], middle)]
+            self.nodes[node][2] = self.build(start, start + middle)
+            self.nodes[node][3] = self.build(start + middle, end)
+        return node
+
+    def bound(self, node, query):
+        """Return the distance from query to the box of the node."""
+        return numpy.linalg.norm(numpy.maximum(
+            0, numpy.maximum(self.lower[node] - query,
+                             query - self.upper[node])))
+
+    def search(self, query, k, distances):
+        """Return the k nearest (distance, index) pairs.
+
+        distances(indices) returns the distances of the points to the
+        query. They may be larger but never smaller than the Euclidean
+        distances, which are used to prune the tree.
+        """
+        best = []  # Max-heap of (-distance, index)
+        if not self.nodes:
+            return []
+        queue = [(self.bound(0, query), 0)]
+        while queue:
+            bound, node = heapq.heappop(queue)
+            if len(best) == k and bound >= -best[0][0]:
+                break
+            start, end, left, right = self.nodes[node]
+            if left < 0:
+                indices = self.indices[start:end]
+                for distance, index in zip(distances(indices), indices):
+                    if len(best) < k:
+                        heapq.heappush(best, (-distance, index))
+                    elif distance < -best[0][0]:
+                        heapq.heapreplace(best, (-distance, index))
+            else:
+                for child in (left, right):
+                    heapq.heappush(queue, (self.bound(child, query), child))
+        return sorted((-distance, index) for distance, index in best)
+
+
+class IncrementalIndex:
+    """Rows of a model that are kept in memory and synced incrementally.
+
+    Subclasses set model, the labels of the version counters that
+    trigger a sync (see caching.py), and the fields that are read, and
+    implement make_row, which turns the values of the fields (after the
+    pk) into the stored row, and rebuild, which builds the tree(s) from
+    self.rows. Rows that are not yet in a tree are in self.pending, and
+    rows whose old values may still be in a tree are in self.removed.
+    """
+    model = None
+    labels = ()
+    fields = ()
+
+    def __init__(self):
+        self.version = None
+        self.synced = None
+        self.rows = {}
+        self.pending = set()
+        self.removed = set()
+
+    def get_queryset(self):
+        return self.model.objects.all()
+
+    def make_row(self, values):
+        raise NotImplementedError
+
+    def refresh(self):
+        """Update any data other than the rows during a sync."""
+
+    def sync(self):
+        """Apply the changes since the last sync."""
+        version = caching.get_versions(*self.labels)
+        if version == self.version:
+            return
+        now = timezone.now()
+        queryset = self.get_queryset()
+        pks = set(queryset.values_list('pk', flat=True))
+        changed = pks - set(self.rows)
+        if self.synced:
+            changed |= set(queryset.filter(
+                updated__gte=self.synced).values_list('pk', flat=True))
+        for pk in set(self.rows) - pks | changed:
+            self.rows.pop(pk, None)
+            self.removed.add(pk)
+            self.pending.discard(pk)
+        if len(changed) < len(pks):
+            queryset = queryset.filter(pk__in=changed)
+        for pk, *values in queryset.values_list(
+                'pk', *self.fields).iterator():
+            self.rows[pk] = self.make_row(values)
+            self.pending.add(pk)
+        self.refresh()
+        if len(self.pending) > max(LEAF_SIZE, math.sqrt(len(self.rows))):
+            self.rebuild()
+            self.pending = set()
+            self.removed = set()
+        self.version = version
+        self.synced = now
+
+    def rebuild(self):
+        raise NotImplementedError
+
+
+class Index(IncrementalIndex):
+    """Lattice constants of all subsets and a KD-tree over them.
+
+    The rows are (subset, compound, normalized cell).
+    """
+    model = models.LatticeConstant
+    labels = (models.LatticeConstant, models.Compound)
+    fields = ('subset', 'subset__dataset__compound', *CELL_FIELDS)
+
+    def __init__(self):
+        super().__init__()
+        self.compositions = {}
+        self.tree_pks = numpy.zeros(0, dtype=int)
+        self.tree = KDTree([])
+
+    def make_row(self, values):
+        subset, compound, *cell = values
+        return subset, compound, normalize(cell)[0]
+
+    def refresh(self):
+        self.compositions = {
+            pk: parse_formula(formula) for pk, formula in
+            models.Compound.objects.values_list('pk', 'formula')}
+
+    def rebuild(self):
+        self.tree_pks = numpy.array(sorted(self.rows), dtype=int)
+        self.tree = KDTree([self.rows[pk][2] for pk in self.tree_pks])
+
+    def search(self, cell, k=10, composition=None, exclude=None):
+        """Return the k most similar (distance, LatticeConstant pk).
+
+        composition is a dict as returned by parse_formula. Subsets
+        listed in exclude are skipped.
+        """
+        query = normalize(cell)[0]
+        exclude = set(exclude or ())
+
+        def distances(pks, in_tree=True):
+            result = []
+            for pk in pks:
+                # Changed rows are in the tree with their old values
+                if in_tree and pk in self.removed or pk not in self.rows:
+                    result.append(math.inf)
+                    continue
+                subset, compound, features = self.rows[pk]
+                if subset in exclude:
+                    result.append(math.inf)
+                    continue
+                distance = numpy.linalg.norm(features - query)
+                if composition is not None:
+                    distance = math.hypot(
+                        distance, COMPOSITION_WEIGHT*composition_distance(
+                            composition, self.compositions.get(compound, {})))
+                result.append(distance)
+            return result
+        results = [(distance, int(self.tree_pks[i])) for distance, i in
+                   self.tree.search(query, k,
+                                    lambda i: distances(self.tree_pks[i]))]
+        pending = list(self.pending)
+        results += zip(distances(pending, in_tree=False), pending)
+        return [result for result in sorted(results)[:k]
+                if math.isfinite(result[0])]
+
+
+def get_index():
+    """Return the index of this worker, brought up to date."""
+    global _index
+    with _lock:
+        if _index is None:
+            _index = Index()
+        _index.sync()
+        return _index
+
+
+def search(cell, k=10, formula=None, exclude=None):
+    """Return the subsets with the most similar cells.
+
+    Each result is a dict with the subset, its compound, the lattice
+    constants, and the distance.
+    """
+    composition = parse_formula(formula) if formula else None
+    with _lock:
+        results = get_index().search(cell, k, composition, exclude)
+    distances = dict((pk, distance) for distance, pk in results)
+    rows = models.LatticeConstant.objects.filter(pk__in=distances).values(
+        'pk', 'subset', 'subset__dataset', 'subset__dataset__compound',
+        'subset__dataset__compound__formula', *CELL_FIELDS)
+    return sorted(({
+        'subset': row['subset'],
+        'dataset': row['subset__dataset'],
+        'compound': row['subset__dataset__compound'],
+        'formula': row['subset__dataset__compound__formula'],
+        **{field: row[field] for field in CELL_FIELDS},
+        'distance': distances[row['pk']],
+    } for row in rows), key=lambda result: result['distance'])
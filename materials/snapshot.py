@@ -0,0 +1,305 @@
+# This file is covered by the BSD license. See LICENSE in the root directory.
+"""Columnar snapshots of the database for offline analysis.
+
+Each table is written into its own compressed file, either a NumPy
+.npz archive with one array per column or, if pyarrow is installed, a
+Parquet file. Missing values are stored as NaN for floats, -1 for
+integers, and an empty string for text.
+
+The whole snapshot is read within a single transaction, which gives a
+consistent view of the database without locking any tables (on MySQL,
+InnoDB serves plain selects from a consistent read view). A manifest
+file records when the snapshot was taken so that the next run can
+refresh only the data sets that have changed since.
+
+"""
+import json
+import os
+from datetime import timedelta
+
+import numpy
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from . import models
+from . import utils
+
+try:
+    import pyarrow
+    from pyarrow import parquet
+except ImportError:
+    pyarrow = None
+
+FORMATS = ('npz', 'parquet')
+MANIFEST = 'manifest.json'
+# Each table is given as (name, model, lookup from the model to its data
+# set, columns), where the columns are (name, field lookup, dtype). The
+# tables of data set contents all have a "dataset" column, which is
+# used for the incremental refresh.
+TABLES = (
+    ('compounds', models.Compound, None, (
+        ('compound', 'pk', 'i8'),
+        ('formula', 'formula', 'U'),
+    )),
+    ('datasets', models.Dataset, 'pk', (
+        ('dataset', 'pk', 'i8'),
+        ('compound', 'compound', 'i8'),
+        ('primary_property', 'primary_property__name', 'U'),
+        ('is_experimental', 'is_experimental', '?'),
+        ('sample_type', 'sample_type', 'i8'),
+        ('crystal_system', 'crystal_system', 'i8'),
+        ('space_group', 'space_group__name', 'U'),
+        ('updated', 'updated', 'M8[us]'),
+    )),
+    ('subsets', models.Subset, 'dataset', (
+        ('subset', 'pk', 'i8'),
+        ('dataset', 'dataset', 'i8'),
+        ('title', 'title', 'U'),
+        ('reference', 'reference', 'i8'),
+    )),
+    ('curves', models.Chart, 'subset__dataset', (
+        ('curve', 'pk', 'i8'),
+        ('subset', 'subset', 'i8'),
+        ('dataset', 'subset__dataset', 'i8'),
+        ('x_title', 'x_title', 'U'),
+        ('x_unit', 'x_unit', 'U'),
+        ('y_title', 'y_title', 'U'),
+        ('y_unit', 'y_unit', 'U'),
+        ('legend', 'legend', 'U'),
+    )),
+    ('datapoints', models.Datapoint, 'chart__subset__dataset', (
+        ('curve', 'chart', 'i8'),
+        ('dataset', 'chart__subset__dataset', 'i8'),
+        ('point', 'point_counter', 'i8'),
+        ('x', 'x_value', 'f8'),
+        ('y', 'y_value', 'f8'),
+    )),
+    ('fixed_values', models.FixedPropertyValue, 'subset__dataset', (
+        ('subset', 'subset', 'i8'),
+        ('dataset', 'subset__dataset', 'i8'),
+        ('fixed_property', 'fixed_property__name', 'U'),
+        ('value_type', 'value_type', 'i8'),
+        ('value', 'value', 'f8'),
+        ('unit', 'unit__label', 'U'),
+    )),
+    ('tolerance_factors', models.ToleranceFactor, 'subset__dataset', (
+        ('subset', 'subset', 'i8'),
+        ('dataset', 'subset__dataset', 'i8'),
+        ('compound', 'compound', 'i8'),
+        ('data_source', 'data_source', 'i8'),
+        ('space_group', 'space_group__name', 'U'),
+        ('t_I', 't_I', 'f8'),
+        ('t_IV_V', 't_IV_V', 'f8'),
+    )),
+)
+MISSING = {'i8': -1, 'f8': numpy.nan, 'U': '', '?': False}
+
+
+def to_utc(value):
+    """Return the datetime in UTC without time zone.
+
+    Naive values, e.g., those read back from Parquet files, are already
+    in UTC.
+    """
+    if value is not None and value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def to_array(values, dtype):
+    """Convert a list of values from the database to a NumPy array."""
+    if dtype.startswith('M8'):
+        return numpy.array([to_utc(value) for value in values], dtype=dtype)
+    missing = MISSING[dtype]
+    return numpy.array([missing if value is None else value
+                        for value in values], dtype=dtype)
+
+
+def read_table(table, queryset, chunk_size=2000):
+    """Return the table as a dictionary of column arrays.
+
+    The rows are read in chunks and converted to arrays one chunk at a
+    time, so that only the arrays are held in memory in full.
+    """
+    columns = table[3]
+    parts = [[] for _ in columns]
+    rows = []
+
+    def flush():
+        for i_column, (_, _, dtype) in enumerate(columns):
+            parts[i_column].append(
+                to_array([row[i_column + 1] for row in rows], dtype))
+        rows.clear()
+    for row in utils.iterate_in_chunks(
+            queryset, [column[1] for column in columns], chunk_size):
+        rows.append(row)
+        if len(rows) == chunk_size:
+            flush()
+    flush()
+    return {name: numpy.concatenate(parts[i_column])
+            for i_column, (name, _, _) in enumerate(columns)}
+
+
+def table_path(directory, name, file_format):
+    return os.path.join(directory, f'{name}.{file_format}')
+
+
+def save_table(path, columns, file_format):
+    """Write the columns atomically (to a temporary file first)."""
+    tmp_path = f'{path}.tmp'
+    if file_format == 'npz':
+        with open(tmp_path, 'wb') as f:
+            numpy.savez_compressed(f, **columns)
+    else:
+        parquet.write_table(
+            pyarrow.Table.from_arrays(
+                [pyarrow.array(array) for array in columns.values()],
+                names=list(columns)),
+            tmp_path, compression='zstd')
+    os.replace(tmp_path, path)
+
+
+def load_table(path, table, file_format):
+    """Return the columns of a previously saved table."""
+    if file_format == 'npz':
+        with numpy.load(path) as archive:
+            return {name: archive[name] for name, _, _ in table[3]}
+    data = parquet.read_table(path)
+    return {name: to_array(data.column(name).to_pylist(), dtype)
+            for name, _, dtype in table[3]}
+
+
+def read_manifest(directory):
+    path = os.path.join(directory, MANIFEST)
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def changed_datasets(since, previous):
+    """Return pks of the data sets that have changed after since.
+
+    A data set has changed if it, one of its subsets, or one of its
+    curves has been modified, or if a subset or curve has been deleted.
+    Saving any of their rows also marks them as modified (see
+    signals.py). The data sets of deleted objects are looked up in the
+    previous snapshot. Rows deleted or bulk created without updating
+    anything else are not found here; see mismatched_tables.
+    """
+    pks = set(models.Dataset.objects.filter(
+        modified__gte=since).values_list('pk', flat=True))
+    pks.update(models.Subset.objects.filter(
+        modified__gte=since).values_list('dataset', flat=True))
+    pks.update(models.Chart.objects.filter(
+        modified__gte=since).values_list('subset__dataset', flat=True))
+    for model_name, table_name, key in (('subset', 'subsets', 'subset'),
+                                        ('chart', 'curves', 'curve')):
+        deleted = list(models.Deletion.objects.filter(
+            model=model_name, modified__gte=since).values_list(
+                'object_pk', flat=True))
+        columns = previous[table_name]
+        pks.update(columns['dataset'][
+            numpy.isin(columns[key], deleted)].tolist())
+    return pks
+
+
+def read_tables(chunk_size, previous=None, changed=(), dataset_pks=()):
+    """Return all tables as dictionaries of column arrays.
+
+    If the previous tables are given, only the rows of the changed
+    data sets are read from the database.
+    """
+    tables = {}
+    for table in TABLES:
+        name, model, to_dataset, _ = table
+        if previous is None or to_dataset is None:
+            tables[name] = read_table(table, model.objects.all(), chunk_size)
+            continue
+        old = previous[name]
+        keep = (numpy.isin(old['dataset'], dataset_pks) &
+                ~numpy.isin(old['dataset'], changed))
+        parts = [{column: old[column][keep] for column in old}]
+        # Limit the number of query parameters (SQLite allows 999)
+        for i in range(0, len(changed), 500):
+            parts.append(read_table(table, model.objects.filter(
+                **{f'{to_dataset}__in': changed[i:i+500]}), chunk_size))
+        tables[name] = {column: numpy.concatenate(
+            [part[column] for part in parts]) for column in old}
+    return tables
+
+
+def mismatched_tables(tables):
+    """Return the names of the tables whose length differs from the
+    number of rows in the database.
+
+    This catches the changes that changed_datasets cannot see, such as
+    data points deleted on their own.
+    """
+    return [name for name, model, _, _ in TABLES
+            if len(next(iter(tables[name].values()))) !=
+            model.objects.count()]
+
+
+def write_snapshot(directory, file_format='npz', full=False,
+                   chunk_size=2000):
+    """Write a snapshot of the database into the given directory.
+
+    Unless full is True and if a snapshot in the same format already
+    exists in the directory, only the data sets that have changed
+    since the previous snapshot are read from the database and the
+    rest is taken over from the previous files. If the row counts of
+    the result do not match the database, everything is read again.
+    Returns the manifest.
+
+    """
+    if file_format not in FORMATS:
+        raise ValueError(f'Unknown format: {file_format}')
+    if file_format == 'parquet' and pyarrow is None:
+        raise ValueError('Writing Parquet files requires pyarrow.')
+    os.makedirs(directory, exist_ok=True)
+    manifest = read_manifest(directory)
+    incremental = (
+        not full and manifest is not None and
+        manifest['format'] == file_format and
+        all(os.path.isfile(table_path(directory, table[0], file_format))
+            for table in TABLES))
+    mismatched = []
+    with transaction.atomic():
+        started = timezone.now()
+        dataset_pks = numpy.array(
+            models.Dataset.objects.values_list('pk', flat=True), dtype='i8')
+        if incremental:
+            previous = {
+                table[0]: load_table(
+                    table_path(directory, table[0], file_format), table,
+                    file_format)
+                for table in TABLES}
+            # Overlap with the previous run by the settle window of the
+            # change feed in case of transactions that were still open.
+            since = (parse_datetime(manifest['started']) -
+                     timedelta(seconds=settings.CHANGE_FEED_DELAY))
+            changed = sorted(changed_datasets(since, previous))
+            tables = read_tables(chunk_size, previous, changed, dataset_pks)
+            mismatched = mismatched_tables(tables)
+            if mismatched:
+                incremental = False
+        if not incremental:
+            tables = read_tables(chunk_size)
+    for name, columns in tables.items():
+        save_table(table_path(directory, name, file_format), columns,
+                   file_format)
+    manifest = {
+        'started': started.isoformat(),
+        'format': file_format,
+        'incremental': incremental,
+        'changed_datasets': len(changed) if incremental else None,
+        'mismatched_tables': mismatched,
+        'tables': {name: len(next(iter(columns.values())))
+                   for name, columns in tables.items()},
+    }
+    with open(os.path.join(directory, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
@@ -0,0 +1,566 @@
+# This file is covered by the BSD license. See LICENSE in the root directory.
+"""Parse atomic structures into NumPy arrays.
+
+The formats are FHI-aims geometry.in, CIF, VASP POSCAR, and (extended)
+XYZ. Each parser converts all coordinates of a file at once into a
+Structure, whose rows are then written with bulk_create as
+AtomicCoordinate and LatticeConstant objects. The labels of the stored
+coordinates follow geometry.in: "lattice_vector", "atom" (Cartesian),
+and "atom_frac" (fractional).
+
+Submitted forms (ingestion.py) and the structure API of a subset
+(views.subset_structure) use the same functions.
+
+"""
+import itertools
+import operator
+import re
+import shlex
+
+import numpy
+
+from . import caching
+from . import descriptors
+from . import models
+
+FORMATS = ('aims', 'cif', 'poscar', 'xyz')
+
+# Uncertainties such as 1.234(5), which are common in CIF
+UNCERTAINTY = re.compile(r'\((?:\d+(?:\.\d+)?)\)')
+ELEMENT = re.compile(r'[A-Z][a-z]?')
+# geometry.in keywords that do not affect the coordinates
+AIMS_IGNORED = ('initial_moment', 'initial_charge', 'constrain_relaxation',
+                'velocity', 'hessian_block', 'hessian_block_lv',
+                'trust_radius', 'symmetry_n_params', 'symmetry_params',
+                'symmetry_lv', 'symmetry_frac', 'homogeneous_field')
+CELL_KEYS = ('a', 'b', 'c', 'alpha', 'beta', 'gamma')
+# Positions closer than this (in fractional coordinates) are the same
+# atom when CIF symmetry operations are applied
+SYMMETRY_TOLERANCE = 1e-4
+
+
+class StructureError(ValueError):
+    pass
+
+
+class Structure:
+    """Atomic structure as NumPy arrays.
+
+    lattice is a 3x3 array with the lattice vectors as rows, or None
+    for molecules. positions is an Nx3 array, elements a list of N
+    chemical symbols, and fractional an array of N booleans telling
+    which positions are given in fractional coordinates.
+    """
+    def __init__(self, lattice, positions, elements, fractional):
+        self.lattice = lattice
+        self.positions = positions
+        self.elements = list(elements)
+        self.fractional = numpy.broadcast_to(
+            numpy.asarray(fractional, dtype=bool), (len(self.elements),))
+        if self.positions.shape != (len(self.elements), 3):
+            raise StructureError('Inconsistent number of atoms.')
+        if self.lattice is None and self.fractional.any():
+            raise StructureError(
+                'Fractional coordinates require lattice vectors.')
+
+    def __len__(self):
+        return len(self.elements)
+
+    def cartesian_positions(self):
+        positions = self.positions.copy()
+        if self.fractional.any():
+            positions[self.fractional] = (
+                self.positions[self.fractional] @ self.lattice)
+        return positions
+
+    def fractional_positions(self):
+        return self.cartesian_positions() @ numpy.linalg.inv(self.lattice)
+
+    def lattice_constants(self):
+        """Return a, b, c, alpha, beta, and gamma or None."""
+        if self.lattice is None:
+            return None
+        lengths = numpy.linalg.norm(self.lattice, axis=1)
+        angles = []
+        for i, j in ((1, 2), (0, 2), (0, 1)):
+            cosine = (self.lattice[i] @ self.lattice[j] /
+                      (lengths[i]*lengths[j]))
+            angles.append(float(numpy.degrees(numpy.arccos(
+                numpy.clip(cosine, -1, 1)))))
+        return dict(zip(CELL_KEYS, (*lengths.tolist(), *angles)))
+
+
+def to_floats(rows, what):
+    """Convert a list of rows of strings into a float array at once."""
+    try:
+        return numpy.array(rows, dtype=float)
+    except ValueError:
+        raise StructureError(f'Could not process {what}.')
+
+
+def split_lines(text):
+    """Return the tokens of each line without uncertainties."""
+    return [line.split() for line in UNCERTAINTY.sub('', text).splitlines()]
+
+
+def cell_to_lattice(a, b, c, alpha, beta, gamma):
+    """Return lattice vectors with a along x and b in the xy plane."""
+    alpha, beta, gamma = numpy.radians([alpha, beta, gamma])
+    c_x = c*numpy.cos(beta)
+    c_y = c*(numpy.cos(alpha) - numpy.cos(beta)*numpy.cos(gamma)) / \
+        numpy.sin(gamma)
+    c_z = numpy.sqrt(max(c**2 - c_x**2 - c_y**2, 0))
+    return numpy.array([[a, 0, 0],
+                        [b*numpy.cos(gamma), b*numpy.sin(gamma), 0],
+                        [c_x, c_y, c_z]])
+
+
+def parse_aims(text):
+    rows = [row for row in split_lines(text)
+            if row and not row[0].startswith(('#', '//'))]
+    vectors = [row[1:4] for row in rows if row[0] == 'lattice_vector']
+    atoms = [row for row in rows if row[0] in ('atom', 'atom_frac')]
+    for row in rows:
+        if row[0] == 'lattice_vector' and len(row) < 4 or (
+                row[0] in ('atom', 'atom_frac') and len(row) < 5) or (
+                    row[0] not in ('lattice_vector', 'atom', 'atom_frac',
+                                   *AIMS_IGNORED)):
+            raise StructureError(f'Could not process line: {" ".join(row)}')
+    if len(vectors) not in (0, 3):
+        raise StructureError('Expected three lattice vectors.')
+    return Structure(
+        to_floats(vectors, 'lattice vectors') if vectors else None,
+        to_floats([row[1:4] for row in atoms], 'atomic coordinates').reshape(
+            -1, 3),
+        [row[4] for row in atoms],
+        [row[0] == 'atom_frac' for row in atoms])
+
+
+def parse_poscar(text):
+    rows = [row for row in split_lines(text) if row]
+    try:
+        scale = float(rows[1][0])
+        lattice = to_floats([row[:3] for row in rows[2:5]], 'lattice vectors')
+        i_row = 5
+        if rows[i_row][0].isdigit():
+            # VASP 4 lists the species on the comment line
+            species = rows[0]
+        else:
+            species = rows[i_row]
+            i_row += 1
+        counts = [int(count) for count in rows[i_row]]
+        i_row += 1
+        if rows[i_row][0][0] in 'sS':  # Selective dynamics
+            i_row += 1
+        cartesian = rows[i_row][0][0] in 'cCkK'
+        i_row += 1
+    except (IndexError, ValueError):
+        raise StructureError('Could not process the POSCAR header.')
+    if len(species) < len(counts) or lattice.shape != (3, 3):
+        raise StructureError('Could not process the POSCAR header.')
+    n_atoms = sum(counts)
+    positions = to_floats([row[:3] for row in rows[i_row:i_row+n_atoms]],
+                          'atomic coordinates').reshape(-1, 3)
+    if len(positions) != n_atoms:
+        raise StructureError(f'Expected {n_atoms} atomic positions.')
+    if scale < 0:
+        # A negative scaling factor is the volume of the cell
+        scale = (-scale/abs(numpy.linalg.det(lattice)))**(1/3)
+    lattice *= scale
+    if cartesian:
+        positions *= scale
+    return Structure(lattice, positions,
+                     numpy.repeat(species[:len(counts)], counts).tolist(),
+                     not cartesian)
+
+
+def parse_xyz(text):
+    lines = text.splitlines()
+    try:
+        n_atoms = int(lines[0])
+        comment = lines[1]
+    except (IndexError, ValueError):
+        raise StructureError('Could not process the XYZ header.')
+    lattice = None
+    match = re.search(r'Lattice="([^"]*)"', comment)
+    if match:
+        lattice = to_floats(match.group(1).split(),
+                            'lattice vectors').reshape(-1, 3)
+        if lattice.shape != (3, 3):
+            raise StructureError('Expected three lattice vectors.')
+    # The columns are given by Properties=name:type:count:...
+    i_species, i_pos = 0, 1
+    match = re.search(r'Properties=(\S+)', comment)
+    if match:
+        fields = match.group(1).split(':')
+        i_column = 0
+        for name, _, count in zip(fields[::3], fields[1::3], fields[2::3]):
+            if name == 'species':
+                i_species = i_column
+            elif name == 'pos':
+                i_pos = i_column
+            i_column += int(count)
+    rows = split_lines('\n'.join(lines[2:2+n_atoms]))
+    if len(rows) != n_atoms:
+        raise StructureError(f'Expected {n_atoms} atoms.')
+    return Structure(
+        lattice,
+        to_floats([row[i_pos:i_pos+3] for row in rows],
+                  'atomic coordinates').reshape(-1, 3),
+        [row[i_species] for row in rows], False)
+
+
+def read_cif(text):
+    """Return the tags and loops of the first data block of a CIF file.
+
+    The tags are a dict of values and each loop a dict that maps the
+    tags of the loop to lists of values.
+    """
+    tags = {}
+    loops = []
+    loop = None
+    tokens = []
+    in_text_field = False
+    lines = text.splitlines()
+    lines.append('data_')  # Finishes the last loop
+    n_blocks = 0
+    for line in lines:
+        if line.startswith(';'):
+            in_text_field = not in_text_field
+            continue
+        if in_text_field or not line.strip() or line.lstrip()[0] == '#':
+            continue
+        first = line.split()[0]
+        if loop is not None and (first[0] == '_' and tokens or
+                                 first == 'loop_' or
+                                 first.startswith('data_')):
+            names = list(loop)
+            for i_name, name in enumerate(names):
+                loop[name] = tokens[i_name::len(names)]
+            loops.append(loop)
+            loop, tokens = None, []
+        if first.startswith('data_'):
+            n_blocks += 1
+            if n_blocks > 1:
+                break
+        elif first == 'loop_':
+            loop = {}
+        elif first[0] == '_' and loop is not None and not tokens:
+            loop[first.lower()] = []
+        elif first[0] == '_':
+            try:
+                values = shlex.split(line, posix=True)[1:]
+            except ValueError:
+                values = line.split()[1:]
+            tags[first.lower()] = values[0] if values else None
+        elif loop is not None:
+            try:
+                tokens.extend(shlex.split(line, posix=True))
+            except ValueError:
+                tokens.extend(line.split())
+    return tags, loops
+
+
+def parse_symmetry_operation(operation):
+    """Return the rotation and translation of, e.g., "-y,x-y,z+1/2"."""
+    rotation = numpy.zeros((3, 3))
+    translation = numpy.zeros(3)
+    parts = operation.replace(' ', '').lower().split(',')
+    if len(parts) != 3:
+        raise StructureError(
+            f'Could not process symmetry operation {operation}.')
+    for i, part in enumerate(parts):
+        for sign, number, axis in re.findall(
+                r'([+-]?)(\d*\.?\d*(?:/\d+)?)\*?([xyz]?)', part):
+            if not number and not axis:
+                continue
+            try:
+                numerator, _, denominator = number.partition('/')
+                value = (float(numerator) / float(denominator or 1)
+                         if numerator else 1.0)
+            except ValueError:
+                raise StructureError(
+                    f'Could not process symmetry operation {operation}.')
+            if sign == '-':
+                value = -value
+            if axis:
+                rotation[i, 'xyz'.index(axis)] += value
+            else:
+                translation[i] += value
+    return rotation, translation
+
+
+def apply_symmetry(positions, elements, operations):
+    """Expand the asymmetric unit into all atoms of the unit cell."""
+    rotations, translations = zip(*map(parse_symmetry_operation, operations))
+    # Shape (atoms, operations, 3)
+    images = (numpy.einsum('oij,nj->noi', numpy.array(rotations),
+                           positions) + numpy.array(translations)) % 1
+    images = images.reshape(-1, 3)
+    rounded = numpy.round(images/SYMMETRY_TOLERANCE).astype(int) % \
+        int(round(1/SYMMETRY_TOLERANCE))
+    _, indices = numpy.unique(rounded, axis=0, return_index=True)
+    indices.sort()
+    return (images[indices],
+            numpy.repeat(elements, len(operations))[indices].tolist())
+
+
+def parse_cif(text):
+    tags, loops = read_cif(UNCERTAINTY.sub('', text))
+    try:
+        lattice = cell_to_lattice(*(float(tags[f'_cell_length_{key}'])
+                                    for key in ('a', 'b', 'c')),
+                                  *(float(tags[f'_cell_angle_{key}'])
+                                    for key in ('alpha', 'beta', 'gamma')))
+    except (KeyError, TypeError, ValueError):
+        raise StructureError('Could not process the cell parameters.')
+    sites = next((loop for loop in loops if '_atom_site_fract_x' in loop or
+                  '_atom_site_cartn_x' in loop), None)
+    if sites is None:
+        raise StructureError('No atomic sites found.')
+    fractional = '_atom_site_fract_x' in sites
+    prefix = '_atom_site_fract_' if fractional else '_atom_site_cartn_'
+    positions = to_floats(
+        [sites[prefix + axis] for axis in 'xyz'], 'atomic coordinates').T
+    symbols = sites.get('_atom_site_type_symbol',
+                        sites.get('_atom_site_label', []))
+    elements = []
+    for symbol in symbols:
+        match = ELEMENT.match(symbol)
+        if not match:
+            raise StructureError(f'Could not process element {symbol}.')
+        elements.append(match.group())
+    if len(elements) != len(positions):
+        raise StructureError('No element given for some atomic sites.')
+    operations = next((loop[tag] for loop in loops for tag in (
+        '_space_group_symop_operation_xyz', '_symmetry_equiv_pos_as_xyz')
+                       if tag in loop), None)
+    if operations and fractional:
+        positions, elements = apply_symmetry(positions, elements, operations)
+    return Structure(lattice, positions, elements, fractional)
+
+
+PARSERS = {
+    'aims': parse_aims,
+    'cif': parse_cif,
+    'poscar': parse_poscar,
+    'xyz': parse_xyz,
+}
+
+
+def detect_format(text, file_name=''):
+    """Guess the format from the file name or the contents, or None."""
+    name = (file_name or '').lower()
+    if name.endswith('.cif'):
+        return 'cif'
+    if name.endswith(('.xyz', '.extxyz')):
+        return 'xyz'
+    if name.endswith(('.vasp', '.poscar')) or name.startswith(
+            ('poscar', 'contcar')):
+        return 'poscar'
+    if name.endswith('geometry.in'):
+        return 'aims'
+    if re.search(r'^\s*(?:atom|atom_frac|lattice_vector)\s', text, re.M):
+        return 'aims'
+    if re.search(r'^\s*(?:data_|loop_|_cell_length_a\b)', text, re.M):
+        return 'cif'
+    rows = [row for row in split_lines(text) if row]
+    if rows and len(rows[0]) == 1 and rows[0][0].isdigit():
+        return 'xyz'
+    try:
+        float(rows[1][0])
+        if to_floats([row[:3] for row in rows[2:5]], '').shape == (3, 3):
+            return 'poscar'
+    except (IndexError, ValueError):
+        pass
+    return None
+
+
+def parse(text, fmt=None, file_name=''):
+    """Parse a structure in the given or else the detected format."""
+    fmt = fmt or detect_format(text, file_name)
+    if fmt not in PARSERS:
+        raise StructureError('Unknown format of the atomic structure.')
+    try:
+        return PARSERS[fmt](text)
+    except StructureError:
+        raise
+    except (IndexError, ValueError) as error:
+        raise StructureError(f'Could not process the structure: {error}')
+
+
+def coordinate_objects(structure, **kwargs):
+    """Return unsaved AtomicCoordinate objects of the structure.
+
+    The lattice vectors come first. kwargs (created_by, subset) are
+    passed to each object.
+    """
+    objects = []
+    if structure.lattice is not None:
+        for vector in structure.lattice.tolist():
+            objects.append(models.AtomicCoordinate(
+                label='lattice_vector', coord_1=vector[0], coord_2=vector[1],
+                coord_3=vector[2], **kwargs))
+    for position, element, fractional in zip(
+            structure.positions.tolist(), structure.elements,
+            structure.fractional.tolist()):
+        objects.append(models.AtomicCoordinate(
+            label='atom_frac' if fractional else 'atom',
+            coord_1=position[0], coord_2=position[1], coord_3=position[2],
+            element=element, **kwargs))
+    return objects
+
+
+def build(rows, constants=None):
+    """Return the structure of the stored coordinates of a subset.
+
+    rows are (label, coord_1, coord_2, coord_3, element) tuples and
+    constants, if given, are the lattice constants, from which the
+    lattice is built if there are no lattice vectors (with a along x
+    and b in the xy plane). Returns None if there are no atoms.
+    """
+    vectors = [row[1:4] for row in rows if row[0] == 'lattice_vector']
+    atoms = [row for row in rows if row[0] in ('atom', 'atom_frac')]
+    if not atoms:
+        return None
+    lattice = None
+    if len(vectors) == 3:
+        lattice = numpy.array(vectors, dtype=float)
+    elif constants:
+        lattice = cell_to_lattice(*constants)
+    return Structure(lattice,
+                     numpy.array([row[1:4] for row in atoms], dtype=float),
+                     [row[4] for row in atoms],
+                     [row[0] == 'atom_frac' for row in atoms])
+
+
+def load_many(subset_pks):
+    """Return a dict of the stored structures of the subsets.
+
+    Subsets without atoms or with inconsistent structures are left out.
+    """
+    subset_pks = list(subset_pks)
+    constants = {row[0]: row[1:] for row in
+                 models.LatticeConstant.objects.filter(
+                     subset__in=subset_pks).values_list('subset', *CELL_KEYS)}
+    rows = models.AtomicCoordinate.objects.filter(
+        subset__in=subset_pks).order_by('subset', 'pk').values_list(
+            'subset', 'label', 'coord_1', 'coord_2', 'coord_3', 'element')
+    structures = {}
+    for pk, group in itertools.groupby(rows.iterator(),
+                                       key=operator.itemgetter(0)):
+        try:
+            structure = build([row[1:] for row in group], constants.get(pk))
+        except StructureError:
+            continue
+        if structure:
+            structures[pk] = structure
+    return structures
+
+
+def load(subset):
+    """Return the stored structure of the subset or None."""
+    return load_many([subset.pk]).get(subset.pk)
+
+
+def format_rows(labels, values, fmt='%.8f', suffixes=None):
+    """Return lines of the labels followed by the formatted values.
+
+    The values (one row per label) are formatted column by column.
+    suffixes, if given, are appended to the lines.
+    """
+    lines = numpy.asarray(labels, dtype=str)
+    fields = [numpy.char.mod(fmt, column) for column in numpy.asarray(
+        values, dtype=float).reshape(len(lines), -1).T]
+    if suffixes is not None:
+        fields.append(numpy.asarray(suffixes, dtype=str))
+    for field in fields:
+        lines = numpy.char.add(numpy.char.add(lines, ' '), field)
+    return '\n'.join(lines.tolist())
+
+
+def to_cif(structure, name='structure'):
+    """Return a CIF file of a periodic structure in space group P1."""
+    constants = structure.lattice_constants()
+    lines = [f'data_{name}']
+    for key, tag in zip(CELL_KEYS, ('length_a', 'length_b', 'length_c',
+                                    'angle_alpha', 'angle_beta',
+                                    'angle_gamma')):
+        lines.append(f'_cell_{tag} {constants[key]:.6f}')
+    lines += ["_symmetry_space_group_name_H-M 'P 1'",
+              'loop_', '_symmetry_equiv_pos_as_xyz', "'x, y, z'",
+              'loop_', '_atom_site_label', '_atom_site_type_symbol',
+              '_atom_site_fract_x', '_atom_site_fract_y',
+              '_atom_site_fract_z']
+    elements = numpy.array(structure.elements, dtype=str)
+    labels = numpy.char.add(numpy.char.add(elements, numpy.char.mod(
+        '%d', numpy.arange(1, len(elements) + 1))), ' ')
+    lines.append(format_rows(numpy.char.add(labels, elements),
+                             structure.fractional_positions()))
+    return '\n'.join(lines) + '\n'
+
+
+def to_xyz(structure, **info):
+    """Return an extended XYZ file with Cartesian positions.
+
+    The lattice and the key=value pairs of info are written into the
+    comment line.
+    """
+    comment = []
+    if structure.lattice is not None:
+        lattice = ' '.join(f'{x:.8f}' for x in structure.lattice.flat)
+        comment.append(f'Lattice="{lattice}"')
+    comment.append('Properties=species:S:1:pos:R:3')
+    if structure.lattice is not None:
+        comment.append('pbc="T T T"')
+    comment += [f'{key}={value}' for key, value in info.items()]
+    return (f'{len(structure)}\n{" ".join(comment)}\n' +
+            format_rows(structure.elements,
+                        structure.cartesian_positions()) + '\n')
+
+
+def to_aims(structure):
+    """Return a geometry.in file of the structure.
+
+    Positions are written in the coordinates they are stored in.
+    """
+    lines = []
+    if structure.lattice is not None:
+        lines.append(format_rows(['lattice_vector']*3, structure.lattice,
+                                 '%.15g'))
+    lines.append(format_rows(
+        numpy.where(structure.fractional, 'atom_frac', 'atom'),
+        structure.positions, '%.15g', structure.elements))
+    return '\n'.join(lines) + '\n'
+
+
+def viewer_data(structure, name='structure'):
+    """Return the file that the 3D viewer loads for the structure.
+
+    Periodic structures are written as CIF, so that JSmol draws the
+    unit cell, and molecules as XYZ.
+    """
+    if structure.lattice is None:
+        return to_xyz(structure)
+    return to_cif(structure, name)
+
+
+def jsmol_script(data):
+    """Return a JSmol script that loads the output of viewer_data."""
+    unit_cell = ' {1 1 1}' if data.startswith('data_') else ''
+    return f'load data "model"\n{data}end "model"{unit_cell}'
+
+
+def save(subset, user, structure):
+    """Replace the lattice constants and coordinates of the subset."""
+    subset.atomic_coordinates.all().delete()
+    subset.lattice_constants.all().delete()
+    constants = structure.lattice_constants()
+    if constants:
+        models.LatticeConstant.objects.create(
+            created_by=user, subset=subset, **constants)
+    models.AtomicCoordinate.objects.bulk_create(
+        coordinate_objects(structure, created_by=user, subset=subset))
+    caching.bump(models.AtomicCoordinate)
+    caching.bump_compounds([subset.dataset.compound_id])
+    descriptors.update([subset.pk])
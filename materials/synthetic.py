@@ -0,0 +1,239 @@
+# This file is covered by the BSD license. See LICENSE in the root directory.
+"""Generate synthetic data for tests and benchmarks.
+
+create_compound fills the database with a compound that has a data set
+for each of the three kinds of primary properties that the views
+distinguish: curves with fixed properties, atomic structures, and
+tolerance factor related parameters. The leaf rows (data points,
+coordinates, etc.) are bulk created, so even large compounds are
+generated quickly.
+
+"""
+import math
+import random
+
+from . import caching
+from . import descriptors
+from . import models
+
+STRUCTURE_PROPERTY = 'atomic structure'
+TOLERANCE_PROPERTY = 'tolerance factor related parameters'
+CURVE_PROPERTIES = ('band gap', 'absorption coefficient',
+                    'photoluminescence', 'exciton binding energy',
+                    'dielectric constant', 'effective mass')
+ELEMENTS = ('Cs', 'Pb', 'I', 'Br', 'Cl', 'Sn', 'Ge', 'Rb', 'K', 'Na')
+A_SITES = ('Cs', 'Rb', 'K', 'CH3NH3', 'CH(NH2)2')
+B_SITES = ('Pb', 'Sn', 'Ge')
+X_SITES = ('I', 'Br', 'Cl')
+
+
+def formula(index):
+    """Return a unique, perovskite-like formula for each index."""
+    a_site = A_SITES[index % len(A_SITES)]
+    index //= len(A_SITES)
+    b_site = B_SITES[index % len(B_SITES)]
+    index //= len(B_SITES)
+    x_site = X_SITES[index % len(X_SITES)]
+    index //= len(X_SITES)
+    if index:
+        # Mixed halides beyond the 45 simple ones
+        x_other = X_SITES[(X_SITES.index(x_site) + 1) % len(X_SITES)]
+        return f'{a_site}{b_site}{x_site}{3 - index % 3}{x_other}{index}'
+    return f'{a_site}{b_site}{x_site}3'
+
+
+def get_or_create(model, user, **kwargs):
+    return model.objects.get_or_create(
+        **kwargs, defaults={'created_by': user, 'updated_by': user})[0]
+
+
+def create_reference(user, title, n_authors=2):
+    reference = models.Reference.objects.create(
+        title=title, journal='Journal of Synthetic Data', vol='1',
+        pages_start='1', pages_end='10', year='2020')
+    for i_author in range(n_authors):
+        author = models.Author.objects.create(
+            first_name=f'First{i_author}', last_name=f'Last{i_author}',
+            institution='Synthetic University')
+        author.references.add(reference)
+    return reference
+
+
+def create_dataset(user, compound, primary_property, space_group, reference,
+                   n_subsets):
+    """Create a data set with details, comments, and empty subsets."""
+    dataset = models.Dataset.objects.create(
+        created_by=user, compound=compound,
+        primary_property=primary_property,
+        is_experimental=random.random() < 0.5,
+        sample_type=models.Dataset.UNKNOWN,
+        crystal_system=models.Dataset.CUBIC, space_group=space_group)
+    synthesis = models.SynthesisMethod.objects.create(
+        created_by=user, dataset=dataset, starting_materials='CsI, PbI2',
+        product=compound.formula, description='Solution growth')
+    experimental = models.ExperimentalDetails.objects.create(
+        created_by=user, dataset=dataset, method='Photoluminescence',
+        description='Room temperature')
+    computational = models.ComputationalDetails.objects.create(
+        created_by=user, dataset=dataset, code='FHI-aims',
+        level_of_theory='DFT', xc_functional='PBE', k_point_grid='4x4x4')
+    models.ExternalRepository.objects.create(
+        created_by=user, computational_details=computational,
+        url='https://example.org/calculation')
+    models.Comment.objects.bulk_create([
+        models.Comment(created_by=user, synthesis_method=synthesis,
+                       text='Synthesis comment'),
+        models.Comment(created_by=user, experimental_details=experimental,
+                       text='Experimental comment'),
+        models.Comment(created_by=user, computational_details=computational,
+                       text='Computational comment'),
+    ])
+    subsets = []
+    for i_subset in range(n_subsets):
+        subsets.append(models.Subset.objects.create(
+            created_by=user, dataset=dataset, title=f'Subset {i_subset}',
+            reference=reference))
+    models.AdditionalFile.objects.bulk_create([
+        models.AdditionalFile(
+            created_by=user, subset=subset,
+            additional_file=f'uploads/synthetic_{subset.pk}.txt')
+        for subset in subsets])
+    return dataset, subsets
+
+
+def add_curves(user, subsets, n_points, n_curves=2):
+    """Add curves with a total of about n_points data points."""
+    unit = get_or_create(models.Unit, user, label='K')
+    fixed_property = get_or_create(models.Property, user, name='temperature')
+    points_per_curve = max(1, n_points//(len(subsets)*n_curves))
+    fixed_values = []
+    datapoints = []
+    for subset in subsets:
+        fixed_values.append(models.FixedPropertyValue(
+            created_by=user, subset=subset, fixed_property=fixed_property,
+            value=random.uniform(4, 300), unit=unit))
+        for i_curve in range(n_curves):
+            chart = models.Chart.objects.create(
+                created_by=user, subset=subset, x_title='Energy',
+                x_unit='eV', y_title='Absorption', y_unit='a.u.',
+                legend=f'Curve {i_curve}', curve_counter=i_curve + 1)
+            for i_point in range(points_per_curve):
+                x = i_point/points_per_curve
+                datapoints.append(models.Datapoint(
+                    created_by=user, chart=chart, x_value=x,
+                    y_value=math.exp(-(x - 0.5)**2) + random.gauss(0, 0.01),
+                    point_counter=i_point + 1))
+    models.FixedPropertyValue.objects.bulk_create(fixed_values)
+    models.Datapoint.objects.bulk_create(datapoints)
+
+
+def add_structures(user, subsets, n_atoms=5):
+    """Add a cubic cell with randomly placed atoms to each subset."""
+    lattice_constants = []
+    coordinates = []
+    for subset in subsets:
+        a = random.uniform(5.5, 6.5)
+        lattice_constants.append(models.LatticeConstant(
+            created_by=user, subset=subset, a=a, b=a, c=a, alpha=90,
+            beta=90, gamma=90))
+        for i_atom in range(n_atoms):
+            coordinates.append(models.AtomicCoordinate(
+                created_by=user, subset=subset, label='atom_frac',
+                coord_1=random.random(), coord_2=random.random(),
+                coord_3=random.random(),
+                element=ELEMENTS[i_atom % len(ELEMENTS)]))
+    models.LatticeConstant.objects.bulk_create(lattice_constants)
+    models.AtomicCoordinate.objects.bulk_create(coordinates)
+    descriptors.update(subset.pk for subset in subsets)
+
+
+def add_tolerance_factors(user, compound, subsets, space_groups):
+    """Add bond lengths and tolerance factors to each subset."""
+    bond_lengths = []
+    tolerance_factors = []
+    for i_subset, subset in enumerate(subsets):
+        for element_a, element_b in (('Cs', 'I'), ('Pb', 'I')):
+            experimental_r = random.uniform(2.5, 4.0)
+            bond_lengths.append(models.BondLength(
+                created_by=user, compound=compound, subset=subset,
+                element_a=element_a, element_b=element_b,
+                bond_id=f'{element_a}-{element_b}',
+                experimental_r=experimental_r, averaged_r=experimental_r,
+                shannon_r=experimental_r + random.gauss(0, 0.1)))
+        for data_source, _ in models.ToleranceFactor.DATA_SOURCES:
+            tolerance_factors.append(models.ToleranceFactor(
+                created_by=user, compound=compound, subset=subset,
+                data_source=data_source,
+                space_group=space_groups[i_subset % len(space_groups)],
+                t_I=random.uniform(0.8, 1.1), t_IV_V=random.uniform(0.8, 1.1)))
+    models.BondLength.objects.bulk_create(bond_lengths)
+    models.ToleranceFactor.objects.bulk_create(tolerance_factors)
+
+
+def create_compound(user, formula, n_subsets=1, n_points=10,
+                    n_properties=1, n_space_groups=1):
+    """Create a compound with synthetic data sets.
+
+    There are n_properties data sets with curves (n_points data points
+    in total per data set), one data set with atomic structures, and
+    one with tolerance factors spread over n_space_groups space
+    groups. Each data set has n_subsets subsets.
+    """
+    compound = get_or_create(models.Compound, user, formula=formula)
+    space_groups = [get_or_create(models.SpaceGroup, user, name=f'P{i + 1}')
+                    for i in range(n_space_groups)]
+    reference = create_reference(user, f'Properties of {formula}')
+    for i_property in range(n_properties):
+        name = CURVE_PROPERTIES[i_property % len(CURVE_PROPERTIES)]
+        if i_property >= len(CURVE_PROPERTIES):
+            name += f' {i_property//len(CURVE_PROPERTIES)}'
+        primary_property = get_or_create(models.Property, user, name=name)
+        _, subsets = create_dataset(user, compound, primary_property,
+                                    space_groups[0], reference, n_subsets)
+        add_curves(user, subsets, n_points)
+    _, subsets = create_dataset(
+        user, compound,
+        get_or_create(models.Property, user, name=STRUCTURE_PROPERTY),
+        space_groups[0], reference, n_subsets)
+    add_structures(user, subsets)
+    _, subsets = create_dataset(
+        user, compound,
+        get_or_create(models.Property, user, name=TOLERANCE_PROPERTY),
+        space_groups[0], reference, n_subsets)
+    add_tolerance_factors(user, compound, subsets, space_groups)
+    # Most rows were created with bulk_create, which sends no signals
+    caching.bump(models.Comment, models.AdditionalFile,
+                 models.FixedPropertyValue, models.Datapoint,
+                 models.LatticeConstant, models.AtomicCoordinate,
+                 models.BondLength, models.ToleranceFactor)
+    return compound
+
+
+def submission(formula='CsPbI3', datapoints='1 2\n3 4\n5 6'):
+    """Return the POST data of a submission with a single curve.
+
+    The property "band gap" and at least one space group must exist.
+    """
+    return {
+        'formula': formula,
+        'number_of_datasets': '1',
+        'primary_property_1': models.Property.objects.get(name='band gap').pk,
+        'origin_of_data_1': 'is_experimental',
+        'sample_type_1': models.Dataset.SINGLE_CRYSTAL,
+        'crystal_system_1': models.Dataset.CUBIC,
+        'space_group_1': models.SpaceGroup.objects.first().pk,
+        'with_synthesis_details_1': '',
+        'with_experimental_details_1': '',
+        'with_computational_details_1': '',
+        'number_of_subsets_1': '1',
+        'sub_title_1_1': 'subset',
+        'select_reference_1_1': '',
+        'x_title_1_1': 'pressure',
+        'x_unit_1_1': 'GPa',
+        'y_title_1_1': 'band gap',
+        'y_unit_1_1': 'eV',
+        'number_of_curves_1_1': '1',
+        'legend_1_1_1': '',
+        'import_file_name_1_1': '',
+        'datapoints_1_1': datapoints,
+    }
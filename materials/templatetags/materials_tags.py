@@ -3,6 +3,8 @@ from django import template
 from django.utils.html import escape
 from django.utils.safestring import mark_safe
 
+from materials import caching
+
 register = template.Library()
 
 
@@ -16,3 +18,14 @@ def tooltip(value):
 @register.inclusion_tag('materials/input_field.html')
 def input_field(field, inline=False):
     return {'field': field, 'inline': inline}
+
+
+@register.simple_tag
+def data_version(*models):
+    """Return the versions of the models for use in {% cache %}.
+
+    Example:
+      {% data_version 'materials.Dataset' 'materials.Subset' as version %}
+      {% cache 3600 datasets compound.pk version %}...{% endcache %}
+    """
+    return caching.get_versions(*models)
@@ -2,25 +2,68 @@
 from selenium import webdriver
 from selenium.webdriver.common.keys import Keys
 from time import sleep
+import io
+import itertools
+import json
 import os
+import re
 import shutil
+import sqlite3
+import tempfile
+import zipfile
+from contextlib import ExitStack
+from unittest import mock
+
+import numpy
 
 from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.sessions.backends.db import SessionStore
+from django import db
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
+from django.http import HttpResponse
 from django.shortcuts import reverse
 from django.test import LiveServerTestCase
+from django.test import RequestFactory
 from django.test import TestCase
+from django.test import override_settings
+from django.utils import timezone
 
+from . import benchmark
+from . import caching
+from . import changes
+from . import descriptors
+from . import ingestion
 from . import models
+from . import neighbors
+from . import prerender
+from . import similarity
+from . import snapshot
+from . import structures
+from . import synthetic
+from . import tolerance_chart
+from . import tolerance_search
+from . import units
 from accounts.tests import USERNAME
 from accounts.tests import PASSWORD
 
+from mainproject import connections
+from mainproject import replicas
 from mainproject import settings
+from mainproject import slowqueries
+from mainproject import timing
 
 settings.MEDIA_ROOT += '_tests'
 
 User = get_user_model()
 dataset_template = models.Dataset(is_experimental=True,
                                   sample_type=models.Dataset.SINGLE_CRYSTAL)
+LOCMEM_CACHE = {'default': {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+DUMMY_CACHE = {'default': {
+    'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}}
 
 
 class ModelsTestCase(TestCase):
@@ -446,3 +489,1398 @@ class SeleniumTestCase(LiveServerTestCase):
         pt_instance = models.PhaseTransition.objects.last()
         self.assertEqual(pt_instance.value, 300)
         self.assertEqual(pt_instance.upper_bound, 301)
+
+
+@override_settings(MEDIA_ROOT=settings.MEDIA_ROOT)
+class SubmissionTestCase(TestCase):
+    """Base class for tests that submit data with synthetic.submission.
+
+    The uploaded files are removed after each test.
+    """
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username=USERNAME, is_staff=True)
+        models.Property.objects.create(name='band gap', created_by=cls.user)
+        models.SpaceGroup.objects.create(name='Pm-3m', created_by=cls.user)
+
+    def tearDown(self):
+        if os.path.isdir(settings.MEDIA_ROOT):
+            shutil.rmtree(settings.MEDIA_ROOT)
+
+
+class IngestionJobTestCase(SubmissionTestCase):
+    def test_synchronous(self):
+        self.client.force_login(self.user)
+        self.client.post(reverse('materials:submit_data'),
+                         synthetic.submission())
+        self.assertEqual(models.Datapoint.objects.count(), 3)
+        self.assertEqual(models.IngestionJob.objects.count(), 0)
+
+    def test_invalid_form(self):
+        self.client.force_login(self.user)
+        data = synthetic.submission()
+        data['asynchronous'] = 'true'
+        data['number_of_datasets'] = 'x'
+        response = self.client.post(reverse('materials:submit_data'), data)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('number_of_datasets',
+                      response.context['main_form'].errors)
+        self.assertEqual(models.IngestionJob.objects.count(), 0)
+
+    def test_queued_job(self):
+        self.client.force_login(self.user)
+        data = synthetic.submission()
+        data['asynchronous'] = 'true'
+        response = self.client.post(reverse('materials:submit_data'), data,
+                                    HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(response.status_code, 202)
+        status_url = response.json()['status_url']
+        self.assertEqual(self.client.get(status_url).json()['state'],
+                         'queued')
+        self.assertEqual(models.Dataset.objects.count(), 0)
+        job = ingestion.claim_job()
+        self.assertIsNone(ingestion.claim_job())
+        ingestion.process_job(job)
+        status = self.client.get(status_url).json()
+        self.assertEqual(status['state'], 'done')
+        dataset = models.Dataset.objects.get()
+        self.assertEqual(status['datasets'], [{
+            'dataset': dataset.pk,
+            'state': 'done',
+            'subsets': [dataset.subsets.get().pk],
+        }])
+        self.assertEqual(models.Datapoint.objects.count(), 3)
+
+    def test_status_page(self):
+        self.client.force_login(self.user)
+        data = synthetic.submission()
+        data['asynchronous'] = 'true'
+        response = self.client.post(reverse('materials:submit_data'), data)
+        job = models.IngestionJob.objects.get()
+        page_url = reverse('materials:ingestion_job_page',
+                           kwargs={'pk': job.pk})
+        self.assertRedirects(response, page_url)
+        response = self.client.get(page_url)
+        self.assertContains(response, 'queued')
+        self.assertContains(response, reverse('materials:ingestion_job',
+                                              kwargs={'pk': job.pk}))
+        ingestion.process_job(ingestion.claim_job())
+        compound = models.Compound.objects.get()
+        self.assertContains(self.client.get(page_url), reverse(
+            'materials:compound', kwargs={'pk': compound.pk}))
+
+    def test_failed_job(self):
+        self.client.force_login(self.user)
+        data = synthetic.submission(datapoints='1 2\n3 x')
+        data['asynchronous'] = 'true'
+        self.client.post(reverse('materials:submit_data'), data)
+        job = ingestion.process_job(ingestion.claim_job())
+        self.assertEqual(job.state, models.IngestionJob.FAILED)
+        self.assertIn('Could not process line', job.error)
+        self.assertEqual(job.get_progress()[0]['state'], 'failed')
+        self.assertEqual(models.Dataset.objects.count(), 0)
+
+    def test_partly_failed_job(self):
+        self.client.force_login(self.user)
+        data = synthetic.submission()
+        for key, value in synthetic.submission(datapoints='1 x').items():
+            if re.search(r'_1(_\d+)*$', key):
+                data[re.sub(r'_1((_\d+)*)$', r'_2\1', key)] = value
+        data['number_of_datasets'] = '2'
+        data['asynchronous'] = 'true'
+        self.client.post(reverse('materials:submit_data'), data)
+        job = ingestion.process_job(ingestion.claim_job())
+        self.assertEqual(job.state, models.IngestionJob.FAILED)
+        # Only the committed data set is reported
+        dataset = models.Dataset.objects.get()
+        self.assertEqual(models.IngestionJob.objects.get().get_progress(), [{
+            'dataset': dataset.pk,
+            'state': 'done',
+            'subsets': [dataset.subsets.get().pk],
+        }, {
+            'dataset': None,
+            'state': 'failed',
+            'subsets': [None],
+        }])
+
+
+class ExportTestCase(SubmissionTestCase):
+    def setUp(self):
+        self.client.force_login(self.user)
+        self.client.post(reverse('materials:submit_data'),
+                         synthetic.submission())
+        self.dataset = models.Dataset.objects.get()
+
+    def test_csv(self):
+        response = self.client.get(reverse('materials:export_dataset', kwargs={
+            'dataset_pk': self.dataset.pk, 'file_format': 'csv'}))
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0], 'curve,point,x,y')
+        self.assertEqual(len(lines), 4)
+        self.assertTrue(lines[3].endswith(',3,5.0,6.0'))
+
+    def test_ndjson(self):
+        response = self.client.get(reverse('materials:export_all', kwargs={
+            'file_format': 'ndjson'}))
+        rows = [json.loads(line) for line in
+                b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual(rows[0]['compound'], 'CsPbI3')
+        self.assertEqual(
+            [row['y'] for row in rows if row['table'] == 'datapoints'],
+            [2, 4, 6])
+
+    def test_zip(self):
+        response = self.client.get(reverse(
+            'materials:export_compound', kwargs={
+                'compound_pk': self.dataset.compound.pk,
+                'file_format': 'zip'}))
+        archive = zipfile.ZipFile(
+            io.BytesIO(b''.join(response.streaming_content)))
+        self.assertIn('datapoints.csv', archive.namelist())
+        input_file = self.dataset.subsets.get().input_data_file.name
+        self.assertEqual(archive.read(input_file), b'1 2\n3 4\n5 6')
+
+
+class StructureExportTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username=USERNAME, is_staff=True)
+        cls.compounds = [synthetic.create_compound(cls.user, formula,
+                                                   n_subsets=3)
+                         for formula in ('CsPbI3', 'MAPbBr3')]
+
+    def structure_subsets(self, compound):
+        return list(models.Subset.objects.filter(
+            dataset__compound=compound,
+            atomic_coordinates__isnull=False).distinct().values_list(
+                'pk', flat=True))
+
+    def test_extxyz(self):
+        compound = self.compounds[1]
+        response = self.client.get(
+            reverse('materials:export_structures',
+                    kwargs={'file_format': 'extxyz'}),
+            {'compound': compound.pk})
+        text = b''.join(response.streaming_content).decode()
+        self.assertEqual(
+            [int(pk) for pk in re.findall(r'subset=(\d+)', text)],
+            sorted(self.structure_subsets(compound)))
+        self.assertIn('formula=MAPbBr3', text)
+        frame = text.split('\n')
+        n_atoms = int(frame[0])
+        structure = structures.parse('\n'.join(frame[:n_atoms + 2]), 'xyz')
+        self.assertEqual(len(structure), n_atoms)
+        self.assertEqual(self.client.get(
+            reverse('materials:export_structures',
+                    kwargs={'file_format': 'extxyz'}),
+            {'subsets': 'x'}).status_code, 400)
+
+    def test_cif_zip(self):
+        pks = self.structure_subsets(self.compounds[0])[:2]
+        response = self.client.get(
+            reverse('materials:export_structures',
+                    kwargs={'file_format': 'zip'}),
+            {'subsets': ','.join(map(str, pks))})
+        archive = zipfile.ZipFile(
+            io.BytesIO(b''.join(response.streaming_content)))
+        self.assertEqual(sorted(archive.namelist()),
+                         sorted(f'CsPbI3_subset_{pk}.cif' for pk in pks))
+        for name in archive.namelist():
+            structure = structures.parse(archive.read(name).decode(), 'cif')
+            self.assertEqual(
+                len(structure), len(structures.load(
+                    models.Subset.objects.get(pk=name.split('_')[-1][:-4]))))
+
+    def test_command(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'structures.extxyz')
+            call_command('export_structures', path, formula='Pb',
+                         batch_size=2, stdout=io.StringIO())
+            with open(path) as f:
+                self.assertEqual(f.read().count('subset='), 6)
+
+
+@override_settings(CHANGE_FEED_DELAY=0)
+class ChangeFeedTestCase(SubmissionTestCase):
+    def read_feed(self, cursor=None):
+        """Read the feed two changes at a time, return changes and cursor."""
+        feed = []
+        while True:
+            params = {'limit': 2}
+            if cursor:
+                params['cursor'] = cursor
+            page = self.client.get(reverse('materials:change_feed'),
+                                   params).json()
+            feed.extend(page['changes'])
+            cursor = page['cursor']
+            if not page['has_more']:
+                return feed, cursor
+
+    def test_mirror(self):
+        self.client.force_login(self.user)
+        self.client.post(reverse('materials:submit_data'),
+                         synthetic.submission())
+        self.client.post(reverse('materials:submit_data'),
+                         synthetic.submission(formula='CsPbBr3'))
+        feed, cursor = self.read_feed()
+        self.assertEqual([change['model'] for change in feed],
+                         ['dataset', 'subset', 'chart'] * 2)
+        values = list(models.Datapoint.objects.values_list(
+            'chart', 'x_value', 'y_value'))
+        # Applying the feed to an empty database recreates the data
+        models.Dataset.objects.all().delete()
+        models.Compound.objects.all().delete()
+        changes.Applier(self.user).apply(feed)
+        self.assertEqual(list(models.Datapoint.objects.values_list(
+            'chart', 'x_value', 'y_value')), values)
+        self.assertEqual(
+            list(models.Compound.objects.order_by('pk').values_list(
+                'formula', flat=True)),
+            ['CsPbI3', 'CsPbBr3'])
+        # Only new changes are listed after the cursor. Skip the
+        # deletions made above in order to mirror into the same database.
+        cursor = self.read_feed(cursor)[1]
+        dataset_pk = models.Dataset.objects.first().pk
+        models.Dataset.objects.get(pk=dataset_pk).delete()
+        feed, cursor = self.read_feed(cursor)
+        self.assertIn({'model': 'dataset', 'object_pk': dataset_pk},
+                      [change['data'] for change in feed])
+        changes.Applier(self.user).apply(feed)
+        self.assertEqual(models.Dataset.objects.count(), 1)
+        self.assertEqual(self.read_feed(cursor)[0], [])
+
+    def test_pending(self):
+        self.client.force_login(self.user)
+        self.client.post(reverse('materials:submit_data'),
+                         synthetic.submission())
+        feed, _ = self.read_feed()
+        models.Dataset.objects.all().delete()
+        applier = changes.Applier(self.user)
+        # Subset and curve cannot be created before the data set
+        applier.apply(feed[1:])
+        self.assertEqual(len(applier.pending), 2)
+        applier.apply(feed[:1])
+        self.assertEqual(applier.pending, [])
+        self.assertEqual(models.Datapoint.objects.count(), 3)
+
+    def test_details(self):
+        self.client.force_login(self.user)
+        self.client.post(reverse('materials:submit_data'),
+                         synthetic.submission())
+        dataset = models.Dataset.objects.get()
+        synthesis = models.SynthesisMethod.objects.create(
+            created_by=self.user, dataset=dataset, product='crystal')
+        models.Comment.objects.create(created_by=self.user,
+                                      synthesis_method=synthesis, text='a')
+        models.ExperimentalDetails.objects.create(
+            created_by=self.user, dataset=dataset, method='XRD')
+        computational = models.ComputationalDetails.objects.create(
+            created_by=self.user, dataset=dataset, code='FHI-aims')
+        models.Comment.objects.create(
+            created_by=self.user, computational_details=computational,
+            text='b')
+        models.ExternalRepository.objects.create(
+            created_by=self.user, computational_details=computational,
+            url='https://example.org')
+        feed, cursor = self.read_feed()
+        models.Dataset.objects.all().delete()
+        changes.Applier(self.user).apply(feed)
+        dataset = models.Dataset.objects.get()
+        self.assertEqual(dataset.synthesis.get().product, 'crystal')
+        self.assertEqual(dataset.synthesis.get().comment.text, 'a')
+        self.assertEqual(dataset.experimental.get().method, 'XRD')
+        computational = dataset.computational.get()
+        self.assertEqual(computational.code, 'FHI-aims')
+        self.assertEqual(computational.comment.text, 'b')
+        self.assertEqual(computational.repositories.get().url,
+                         'https://example.org')
+        # Editing a comment lists its data set again
+        cursor = self.read_feed(cursor)[1]
+        comment = computational.comment
+        comment.text = 'c'
+        comment.save()
+        # The version time shown to users stays the same
+        self.assertEqual(models.Dataset.objects.get().updated,
+                         dataset.updated)
+        self.assertGreater(models.Dataset.objects.get().modified,
+                           dataset.modified)
+        feed = self.read_feed(cursor)[0]
+        self.assertEqual([change['pk'] for change in feed
+                          if change['model'] == 'dataset'], [dataset.pk])
+        self.assertEqual(feed[0]['data']['computational'][0]['comment'][0][
+            'text'], 'c')
+
+    def test_api_edit(self):
+        reference = models.Reference.objects.create(
+            title='old', vol='1', pages_start='1', pages_end='2',
+            year='2020')
+        cursor = self.read_feed()[1]
+        self.client.force_login(self.user)
+        response = self.client.patch(
+            reverse('materials:reference-detail', kwargs={'pk': reference.pk}),
+            {'title': 'new'}, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        feed = self.read_feed(cursor)[0]
+        self.assertEqual([(change['model'], change['data']['title'])
+                          for change in feed], [('reference', 'new')])
+
+
+@override_settings(CHANGE_FEED_DELAY=0)
+class SnapshotTestCase(SubmissionTestCase):
+    def setUp(self):
+        self.client.force_login(self.user)
+        self.client.post(reverse('materials:submit_data'),
+                         synthetic.submission())
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def load(self, name):
+        return snapshot.load_table(
+            os.path.join(self.directory, f'{name}.npz'),
+            snapshot.TABLES[[table[0] for table in snapshot.TABLES].index(
+                name)], 'npz')
+
+    def test_snapshot(self):
+        manifest = snapshot.write_snapshot(self.directory)
+        self.assertFalse(manifest['incremental'])
+        self.assertEqual(manifest['tables']['datapoints'], 3)
+        datapoints = self.load('datapoints')
+        self.assertEqual(datapoints['x'].tolist(), [1, 3, 5])
+        self.assertEqual(datapoints['y'].tolist(), [2, 4, 6])
+        self.assertEqual(self.load('compounds')['formula'].tolist(),
+                         ['CsPbI3'])
+
+    def test_incremental(self):
+        snapshot.write_snapshot(self.directory)
+        first = models.Dataset.objects.get()
+        self.client.post(
+            reverse('materials:submit_data'),
+            synthetic.submission(formula='CsPbBr3', datapoints='7 8'))
+        manifest = snapshot.write_snapshot(self.directory)
+        self.assertTrue(manifest['incremental'])
+        self.assertEqual(manifest['changed_datasets'], 1)
+        self.assertEqual(self.load('datapoints')['x'].tolist(), [1, 3, 5, 7])
+        # Deleting a curve or a data set removes its rows
+        models.Chart.objects.filter(subset__dataset=first).delete()
+        manifest = snapshot.write_snapshot(self.directory)
+        self.assertEqual(manifest['changed_datasets'], 1)
+        self.assertEqual(self.load('datapoints')['x'].tolist(), [7])
+        first.delete()
+        manifest = snapshot.write_snapshot(self.directory)
+        self.assertEqual(manifest['tables']['datasets'], 1)
+        self.assertEqual(manifest['tables']['subsets'], 1)
+
+    def test_unnoticed_changes(self):
+        snapshot.write_snapshot(self.directory)
+        # Editing a data point marks its curve and thus its data set
+        point = models.Datapoint.objects.first()
+        point.y_value = 10
+        point.save()
+        manifest = snapshot.write_snapshot(self.directory)
+        self.assertEqual(manifest['changed_datasets'], 1)
+        self.assertIn(10, self.load('datapoints')['y'].tolist())
+        # Deleting one is only seen in the row counts
+        models.Datapoint.objects.filter(pk=point.pk).delete()
+        manifest = snapshot.write_snapshot(self.directory)
+        self.assertFalse(manifest['incremental'])
+        self.assertEqual(manifest['mismatched_tables'], ['datapoints'])
+        self.assertEqual(manifest['tables']['datapoints'], 2)
+
+    def test_naive_timestamps(self):
+        updated = timezone.now()
+        self.assertEqual(
+            snapshot.to_array([updated, updated.replace(tzinfo=None)],
+                              'M8[us]').tolist(),
+            [updated.replace(tzinfo=None)]*2)
+
+
+class QueryPlanTestCase(TestCase):
+    """Check that the frequent queries use the composite indexes."""
+    def assertUsesIndex(self, queryset, index_name):
+        self.assertIn(index_name, queryset.explain())
+
+    def test_dataset_versions(self):
+        datasets = models.Dataset.objects.filter(
+            compound__pk=1, primary_property__pk=1)
+        self.assertUsesIndex(datasets, 'dataset_compound_property')
+        self.assertUsesIndex(datasets.filter(updated=timezone.now()),
+                             'dataset_compound_property')
+
+    def test_bond_lengths(self):
+        bond_lengths = models.BondLength.objects.filter(
+            bond_id='Pb-I', experimental_r__isnull=False)
+        self.assertUsesIndex(bond_lengths, 'bondlength_bond_experimental')
+
+    def test_tolerance_factors(self):
+        tolerance_factors = models.ToleranceFactor.objects.filter(
+            data_source=models.ToleranceFactor.SHANNON, space_group=1)
+        self.assertUsesIndex(tolerance_factors, 'tolerance_source_group')
+        self.assertUsesIndex(tolerance_factors.filter(compound__pk=1),
+                             'tolerance_source_group')
+
+    def test_datapoints(self):
+        self.assertUsesIndex(models.Datapoint.objects.filter(
+            chart=1).order_by('point_counter'), 'datapoint_chart_counter')
+
+    def test_descriptors(self):
+        self.assertUsesIndex(models.StructureDescriptor.objects.filter(
+            volume__gte=200, volume__lte=300), 'descriptor_volume')
+
+
+class RequestTimingTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username=USERNAME)
+
+    def setUp(self):
+        timing.reset_histograms()
+
+    def test_header(self):
+        response = self.client.get(reverse('materials:search'))
+        header = response['Server-Timing']
+        self.assertRegex(header, r'^sql;desc="\d+ queries";dur=[\d.]+, '
+                         r'template;dur=[\d.]+, total;dur=[\d.]+$')
+        histogram = timing.get_histograms()['materials:search']
+        self.assertEqual(histogram['count'], 1)
+        self.assertEqual(sum(histogram['buckets'].values()), 1)
+
+    def test_staff_only(self):
+        url = reverse('request_timing')
+        self.assertEqual(self.client.get(url).status_code, 302)
+        self.user.is_staff = True
+        self.user.save()
+        self.client.force_login(self.user)
+        self.client.get(reverse('materials:search'))
+        response = self.client.get(url, {'format': 'json'})
+        self.assertIn('materials:search', response.json())
+        self.assertContains(self.client.get(url), 'materials:search')
+
+
+@override_settings(CACHES=DUMMY_CACHE)
+class QueryBudgetTestCase(TestCase):
+    """The number of queries of the public views must not grow with data.
+
+    Each view is requested for compounds of increasing size and the
+    query counts are compared to that of the smallest compound. The
+    export views are not included because they read in chunks by
+    design. Caching is disabled so that all queries are counted.
+    """
+    # (subsets per data set, data points per data set, number of data
+    # sets with curves, number of space groups)
+    SIZES = ((1, 10, 1, 1), (10, 1000, 2, 3), (100, 10000, 3, 10))
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username=USERNAME)
+        cls.compounds = [
+            synthetic.create_compound(cls.user, f'Cs{i}PbI3', *size)
+            for i, size in enumerate(cls.SIZES)]
+
+    def assertConstantQueries(self, get_url, method='get', data=None):
+        """Request get_url(compound) for each compound and count queries.
+
+        On failure, show the queries made for the largest compound.
+        """
+        counts = []
+        for compound in self.compounds:
+            queries = []
+
+            def record(execute, sql, params, many, context):
+                queries.append(sql)
+                return execute(sql, params, many, context)
+            with connection.execute_wrapper(record):
+                response = getattr(self.client, method)(
+                    get_url(compound), data(compound) if data else None)
+            self.assertEqual(response.status_code, 200)
+            counts.append(len(queries))
+        if len(set(counts)) > 1:
+            self.fail(f'Query counts {counts} grow with the data. Queries '
+                      'for the largest compound:\n' + '\n'.join(queries))
+
+    def datasets(self, compound):
+        return compound.datasets.order_by('pk')
+
+    def test_search(self):
+        for search_term in 'formula', 'primary_property', 'author':
+            self.assertConstantQueries(
+                lambda compound: reverse('materials:search'), 'post',
+                lambda compound: {
+                    'search_term': search_term,
+                    'search_text': {
+                        'formula': compound.formula,
+                        'primary_property': 'band gap',
+                        'author': 'Last0'}[search_term]})
+
+    def test_compound(self):
+        self.assertConstantQueries(lambda compound: reverse(
+            'materials:compound', kwargs={'pk': compound.pk}))
+
+    def test_dataset_versions(self):
+        self.assertConstantQueries(lambda compound: reverse(
+            'materials:dataset_versions', kwargs={
+                'compound_pk': compound.pk,
+                'property_pk': self.datasets(compound)[0].primary_property.pk,
+            }))
+
+    def test_dataset_details(self):
+        for i_dataset in 0, -1, -2:
+            self.assertConstantQueries(lambda compound: reverse(
+                'materials:dataset_details', kwargs={
+                    'pk': list(self.datasets(compound))[i_dataset].pk}))
+
+    def test_data_for_chart(self):
+        self.assertConstantQueries(lambda compound: reverse(
+            'materials:data_for_chart', kwargs={
+                'pk': self.datasets(compound)[0].subsets.first().pk}))
+
+    def test_data_for_tf(self):
+        for data_source, _ in models.ToleranceFactor.DATA_SOURCES:
+            self.assertConstantQueries(lambda compound: reverse(
+                'materials:tolerance_factor_chart', kwargs={
+                    'data_source': data_source, 'compound_pk': compound.pk}))
+
+    def test_jsmol_input(self):
+        self.assertConstantQueries(lambda compound: reverse(
+            'materials:get_jsmol_input', kwargs={
+                'pk': list(self.datasets(compound))[-2].subsets.first().pk}))
+
+    def test_compound_structures(self):
+        self.assertConstantQueries(lambda compound: reverse(
+            'materials:compound_structures', kwargs={'pk': compound.pk}))
+
+
+class BenchmarkTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username=USERNAME, is_staff=True)
+
+    def test_generate_synthetic(self):
+        call_command('generate_synthetic', compounds=2, subsets=2, points=20,
+                     user=USERNAME, stdout=io.StringIO())
+        self.assertEqual(models.Compound.objects.count(), 2)
+        # 3 data sets with curves, one with structures, one with
+        # tolerance factors per compound
+        self.assertEqual(models.Dataset.objects.count(), 10)
+        self.assertEqual(models.Datapoint.objects.count(), 2*3*20)
+
+    def test_run(self):
+        synthetic.create_compound(self.user, 'CsPbI3', n_subsets=2)
+        results = benchmark.run(self.user, repeat=2)
+        self.assertEqual(list(results['endpoints']),
+                         list(benchmark.ENDPOINT_NAMES))
+        for result in results['endpoints'].values():
+            self.assertLessEqual(result['p50_ms'], result['p99_ms'])
+            self.assertGreater(result['peak_memory_kib'], 0)
+        # The submitted data sets are rolled back
+        self.assertEqual(models.Compound.objects.count(), 1)
+
+
+class ProfilingTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username=USERNAME, is_staff=True)
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.profile_dir = directory.name
+        profile_dir = override_settings(PROFILE_DIR=self.profile_dir)
+        profile_dir.enable()
+        self.addCleanup(profile_dir.disable)
+
+    def test_anonymous(self):
+        response = self.client.get(reverse('materials:search'),
+                                   {'profile': 1})
+        self.assertNotIn('X-Profile', response)
+
+    def test_profile(self):
+        self.client.force_login(self.user)
+        response = self.client.get(
+            reverse('materials:compound', kwargs={'pk': 1}),
+            HTTP_X_PROFILE='1')
+        name = response['X-Profile']
+        self.assertTrue(name.endswith('materials_compound'))
+        self.assertContains(self.client.get(reverse('profiles')), name)
+        response = self.client.get(reverse('profile_detail',
+                                           kwargs={'name': name}),
+                                   {'sort': 'tottime'})
+        self.assertContains(response, 'function calls')
+        self.assertContains(response, 'SELECT')
+        response = self.client.get(reverse('profile_download',
+                                           kwargs={'name': name}))
+        self.assertIn('attachment', response['Content-Disposition'])
+        self.assertEqual(self.client.get(reverse(
+            'profile_detail', kwargs={'name': '..'})).status_code, 404)
+        # Not among the files served under MEDIA_URL
+        self.assertTrue(os.path.isfile(
+            os.path.join(self.profile_dir, f'{name}.prof')))
+        self.assertFalse(os.path.isdir(
+            os.path.join(settings.MEDIA_ROOT, 'profiles')))
+
+
+@override_settings(SLOW_QUERY_THRESHOLD=0, CACHES=DUMMY_CACHE)
+class SlowQueryTestCase(TestCase):
+    def test_call_site(self):
+        url = reverse('materials:compound', kwargs={'pk': 1})
+        with self.assertLogs('mainproject.slowqueries', 'WARNING') as logs:
+            self.client.get(url)
+        records = [json.loads(line.split(':', 2)[2]) for line in logs.output]
+        self.assertTrue(any(record['site'].startswith('materials/views.py:')
+                            for record in records))
+        self.assertEqual(records[0]['path'], url)
+        self.assertEqual(slowqueries.recent[-1], records[-1])
+        with tempfile.NamedTemporaryFile('w', suffix='.jsonl') as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+            f.flush()
+            output = io.StringIO()
+            call_command('slow_queries', file=f.name, top=1, stdout=output)
+        self.assertIn(f'in {len(records)} queries', output.getvalue())
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class CachingTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username=USERNAME)
+
+    def test_versions(self):
+        version = caching.get_versions(models.Compound)
+        self.assertEqual(caching.get_versions('materials.Compound'), version)
+        compound = models.Compound.objects.create(created_by=self.user,
+                                                  formula='CsPbI3')
+        self.assertGreater(int(caching.get_versions(models.Compound)),
+                           int(version))
+        version = caching.get_versions(models.Compound)
+        compound.delete()
+        self.assertNotEqual(caching.get_versions(models.Compound), version)
+        # Only the models of the versioned apps have counters
+        with mock.patch.object(caching, 'bump') as bump:
+            SessionStore().create()
+        bump.assert_not_called()
+        version = caching.get_versions(models.Dataset)
+        dataset = synthetic.create_compound(
+            self.user, 'CsPbI3', n_subsets=1).datasets.first()
+        dataset.verified_by.add(self.user)
+        self.assertNotEqual(caching.get_versions(models.Dataset), version)
+
+    def test_get_or_set(self):
+        def count():
+            return models.Compound.objects.count()
+        self.assertEqual(caching.get_or_set(
+            'count', [models.Compound], [], count), 0)
+        models.Compound.objects.create(created_by=self.user, formula='CsPbI3')
+        with self.assertNumQueries(1):
+            self.assertEqual(caching.get_or_set(
+                'count', [models.Compound], [], count), 1)
+        with self.assertNumQueries(0):
+            self.assertEqual(caching.get_or_set(
+                'count', [models.Compound], [], count), 1)
+
+    def test_cache_response(self):
+        calls = []
+
+        @caching.cache_response(models.Compound)
+        def view(request):
+            calls.append(request)
+            return HttpResponse(str(models.Compound.objects.count()))
+        request = RequestFactory().get('/compounds')
+        request.user = AnonymousUser()
+        self.assertEqual(view(request).content, b'0')
+        self.assertEqual(view(request).content, b'0')
+        self.assertEqual(len(calls), 1)
+        models.Compound.objects.create(created_by=self.user, formula='CsPbI3')
+        self.assertEqual(view(request).content, b'1')
+        request.user = self.user
+        view(request)
+        self.assertEqual(len(calls), 3)
+
+    def test_compound_page(self):
+        compound = synthetic.create_compound(self.user, 'CsPbI3')
+        url = reverse('materials:compound', kwargs={'pk': compound.pk})
+        response = self.client.get(url)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(url).content, response.content)
+        reference = models.Reference.objects.first()
+        reference.title = 'New title'
+        reference.save()
+        with self.assertNumQueries(1):
+            self.client.get(url)
+        self.client.force_login(self.user)
+        self.assertContains(self.client.get(url), 'Logout')
+
+    def test_search_and_contributors(self):
+        synthetic.create_compound(self.user, 'CsPbI3')
+        data = {'search_term': 'formula', 'search_text': 'Pb'}
+        self.assertContains(self.client.post(reverse('materials:search'),
+                                             data), 'CsPbI3')
+        with self.assertNumQueries(0):
+            self.client.post(reverse('materials:search'), data)
+        synthetic.create_compound(self.user, 'CsPbBr3')
+        self.assertContains(self.client.post(reverse('materials:search'),
+                                             data), 'CsPbBr3')
+        self.client.get(reverse('contributors'))
+        with self.assertNumQueries(0):
+            self.client.get(reverse('contributors'))
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class PrerenderTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username=USERNAME)
+        cls.compound = synthetic.create_compound(cls.user, 'CsPbI3')
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.root = directory.name
+        prerender_root = override_settings(PRERENDER_ROOT=self.root)
+        prerender_root.enable()
+        self.addCleanup(prerender_root.disable)
+
+    def test_prerender(self):
+        output = io.StringIO()
+        call_command('prerender', stdout=output)
+        self.assertIn('1 compounds rendered', output.getvalue())
+        page = os.path.join(self.root, 'materials', f'{self.compound.pk}.html')
+        with open(page) as f:
+            self.assertIn('CsPbI3', f.read())
+        dataset = self.compound.datasets.first()
+        with open(os.path.join(self.root, 'materials', 'dataset-details',
+                               f'{dataset.pk}.json')) as f:
+            self.assertIn('Space group', json.load(f)['general'])
+        self.assertFalse(prerender.update_compound(self.compound.pk))
+        subset = dataset.subsets.first()
+        subset.title = 'New title'
+        subset.save()
+        self.assertTrue(prerender.update_compound(self.compound.pk))
+        dataset.delete()
+        prerender.update_compound(self.compound.pk)
+        self.assertFalse(os.path.exists(os.path.join(
+            self.root, 'materials', 'dataset-details', f'{dataset.pk}.json')))
+        self.compound.delete()
+        call_command('prerender', stdout=output)
+        self.assertFalse(os.path.exists(page))
+
+
+class ConnectionsTestCase(TestCase):
+    def test_pool(self):
+        pool = connections.ConnectionPool(size=1)
+        self.assertIsNone(pool.acquire())
+        first = sqlite3.connect(':memory:')
+        second = sqlite3.connect(':memory:')
+        pool.release(first)
+        pool.release(second)
+        self.assertIs(pool.acquire(), first)
+        self.assertIsNone(pool.acquire())
+        first.close()
+        pool.release(first)
+        # Connections that no longer work are not handed out
+        self.assertIsNone(pool.acquire())
+
+    def test_health_check(self):
+        middleware = connections.ConnectionHealthMiddleware(
+            lambda request: HttpResponse())
+        request = RequestFactory().get('/')
+        self.addCleanup(connection.settings_dict.__setitem__,
+                        'CONN_HEALTH_CHECKS',
+                        connection.settings_dict['CONN_HEALTH_CHECKS'])
+        with mock.patch.object(connection, 'is_usable', return_value=False), \
+                mock.patch.object(connection, 'close') as close:
+            connection.settings_dict['CONN_HEALTH_CHECKS'] = False
+            middleware(request)
+            close.assert_not_called()
+            connection.settings_dict['CONN_HEALTH_CHECKS'] = True
+            middleware(request)
+            close.assert_called_once()
+
+
+@override_settings(DATABASE_REPLICAS=['replica'], CACHES=LOCMEM_CACHE)
+class ReplicaTestCase(TestCase):
+    """Reads of safe requests go to a second SQLite database."""
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.replica_directory = tempfile.mkdtemp()
+        db.connections.databases['replica'] = {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.path.join(cls.replica_directory, 'replica.db'),
+        }
+        with override_settings(DATABASE_REPLICAS=[]):
+            call_command('migrate', database='replica', verbosity=0)
+
+    @classmethod
+    def tearDownClass(cls):
+        db.connections['replica'].close()
+        del db.connections['replica']
+        del db.connections.databases['replica']
+        shutil.rmtree(cls.replica_directory)
+        super().tearDownClass()
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username=USERNAME, is_staff=True)
+        cls.compound = synthetic.create_compound(cls.user, 'CsPbI3')
+
+    def count_queries(self, request):
+        """Return the number of queries to the primary and the replica."""
+        counts = {'default': 0, 'replica': 0}
+        with ExitStack() as stack:
+            for alias in counts:
+                def record(execute, sql, params, many, context,
+                           alias=alias):
+                    counts[alias] += 1
+                    return execute(sql, params, many, context)
+                stack.enter_context(
+                    db.connections[alias].execute_wrapper(record))
+            request()
+        return counts['default'], counts['replica']
+
+    def test_routing(self):
+        url = reverse('materials:compound', kwargs={'pk': self.compound.pk})
+        primary, replica = self.count_queries(lambda: self.client.get(url))
+        self.assertEqual(primary, 0)
+        self.assertGreater(replica, 0)
+        # The replica is empty, so the compound page has no data sets
+        self.assertNotContains(self.client.get(url), 'CsPbI3')
+        primary, replica = self.count_queries(lambda: self.client.post(
+            reverse('materials:search'),
+            {'search_term': 'formula', 'search_text': 'Pb'}))
+        self.assertEqual(replica, 0)
+        # Read-your-writes after the POST
+        self.assertIn(replicas.PIN_COOKIE, self.client.cookies)
+        self.assertContains(self.client.get(url), 'CsPbI3')
+
+    def test_use_primary(self):
+        job = models.IngestionJob.objects.create(created_by=self.user)
+        self.client.force_login(self.user)
+        self.client.cookies.pop(replicas.PIN_COOKIE, None)
+        response = self.client.get(reverse('materials:ingestion_job',
+                                           kwargs={'pk': job.pk}))
+        self.assertEqual(response.status_code, 200)
+
+    @override_settings(DATABASE_REPLICAS=['replica', 'replica2'])
+    def test_one_replica_per_request(self):
+        router = replicas.ReplicaRouter()
+        aliases = []
+
+        def view(request):
+            aliases.append({router.db_for_read(models.Dataset)
+                            for _ in range(20)})
+            return HttpResponse()
+        middleware = replicas.ReplicaMiddleware(view)
+        for _ in range(10):
+            middleware(RequestFactory().get('/'))
+        for request_aliases in aliases:
+            self.assertEqual(len(request_aliases), 1)
+            self.assertIn(request_aliases.pop(), ['replica', 'replica2'])
+        self.assertEqual(router.db_for_read(models.Dataset), 'default')
+
+
+POSCAR = """CsPbI3
+1.0
+6.3 0 0
+0 6.3 0
+0 0 6.3
+Cs Pb I
+1 1 3
+Direct
+0.5 0.5 0.5
+0 0 0
+0.5 0 0
+0 0.5 0
+0 0 0.5
+"""
+
+
+class StructuresTestCase(SubmissionTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        models.Property.objects.create(name='atomic structure',
+                                       created_by=cls.user)
+
+    def test_formats(self):
+        aims = structures.parse(
+            'lattice_vector 5 0 0\nlattice_vector 0 5 0\n'
+            'lattice_vector 0 0 5\n# comment\natom_frac 0 0 0 Al\n'
+            'atom 2.5 2.5(1) 2.5 Ga\ninitial_moment 1\n')
+        self.assertEqual(aims.elements, ['Al', 'Ga'])
+        self.assertEqual(aims.fractional.tolist(), [True, False])
+        self.assertEqual(aims.lattice_constants()['alpha'], 90)
+        poscar = structures.parse(POSCAR)
+        self.assertEqual(poscar.elements, ['Cs', 'Pb', 'I', 'I', 'I'])
+        self.assertEqual(poscar.cartesian_positions()[0].tolist(),
+                         [3.15, 3.15, 3.15])
+        xyz = structures.parse(
+            '2\nLattice="4 0 0 0 4 0 0 0 4" '
+            'Properties=species:S:1:pos:R:3\nNa 0 0 0\nCl 2 2 2\n')
+        self.assertEqual(xyz.lattice_constants()['b'], 4)
+        self.assertEqual(xyz.positions[1].tolist(), [2, 2, 2])
+        # Rock salt from its asymmetric unit and the face centering
+        cif = structures.parse(
+            'data_NaCl\n'
+            '_cell_length_a 5.64(1)\n_cell_length_b 5.64\n'
+            '_cell_length_c 5.64\n_cell_angle_alpha 90\n'
+            '_cell_angle_beta 90\n_cell_angle_gamma 90\n'
+            'loop_\n_symmetry_equiv_pos_as_xyz\n'
+            "'x, y, z'\n'x, y+1/2, z+1/2'\n'x+1/2, y, z+1/2'\n"
+            "'x+1/2, y+1/2, z'\n'-x, -y, -z'\n"
+            'loop_\n_atom_site_label\n_atom_site_type_symbol\n'
+            '_atom_site_fract_x\n_atom_site_fract_y\n_atom_site_fract_z\n'
+            'Na1 Na+ 0 0 0\nCl1 Cl- 0.5 0.5 0.5\n')
+        self.assertEqual(cif.elements, ['Na']*4 + ['Cl']*4)
+        self.assertAlmostEqual(cif.lattice_constants()['c'], 5.64)
+        with self.assertRaises(structures.StructureError):
+            structures.parse('atom 1 2 Ga')
+        with self.assertRaises(structures.StructureError):
+            structures.parse('not a structure')
+
+    def test_submission(self):
+        data = synthetic.submission()
+        data['primary_property_1'] = models.Property.objects.get(
+            name='atomic structure').pk
+        data.update({
+            'import_file_name_atomic_1_1': 'POSCAR',
+            'atomic_coordinates_1_1': POSCAR,
+            'geometry_format_1_1': 'aims',
+        })
+        for key in structures.CELL_KEYS:
+            data[f'lattice_constant_{key}_1_1'] = ''
+        self.client.force_login(self.user)
+        self.client.post(reverse('materials:submit_data'), data)
+        lattice_constant = models.LatticeConstant.objects.get()
+        self.assertEqual(lattice_constant.a, 6.3)
+        self.assertEqual(lattice_constant.gamma, 90)
+        self.assertEqual(
+            list(models.AtomicCoordinate.objects.order_by('pk').values_list(
+                'label', flat=True)),
+            ['lattice_vector']*3 + ['atom_frac']*5)
+
+    def test_api(self):
+        compound = synthetic.create_compound(self.user, 'CsPbI3')
+        subset = models.Subset.objects.filter(
+            dataset__compound=compound,
+            atomic_coordinates__isnull=False).first()
+        url = reverse('materials:subset_structure', kwargs={'pk': subset.pk})
+        self.client.force_login(self.user)
+        response = self.client.post(url, {
+            'file': SimpleUploadedFile('POSCAR', POSCAR.encode())})
+        self.assertEqual(response.json()['atoms'], 5)
+        self.assertEqual(subset.atomic_coordinates.count(), 8)
+        self.assertEqual(subset.lattice_constants.get().b, 6.3)
+        response = self.client.post(url, {'structure': 'atom 1 2 Ga',
+                                          'format': 'aims'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(subset.atomic_coordinates.count(), 8)
+        response = self.client.post(url, {
+            'file': SimpleUploadedFile('POSCAR', b'\xff\xfe\x00')})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('UTF-8', response.json()['error'])
+
+
+@override_settings(CACHES=DUMMY_CACHE)
+class NeighborsTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username=USERNAME, is_staff=True)
+        cls.structure = structures.parse(POSCAR)
+
+    def test_neighbor_list(self):
+        lattice = numpy.array([[5, 0, 0], [1.5, 4.5, 0], [0.7, 0.3, 3.9]])
+        positions = numpy.random.RandomState(0).rand(10, 3)
+        expected = []
+        for i, j in itertools.product(range(10), repeat=2):
+            for shift in itertools.product(range(-3, 4), repeat=3):
+                distance = numpy.linalg.norm(
+                    (positions[j] + shift - positions[i]) @ lattice)
+                if 0 < distance < 6:
+                    expected.append(round(distance, 9))
+        _, _, distances = neighbors.neighbor_list(lattice, positions, 6)
+        self.assertEqual(sorted(numpy.round(distances, 9).tolist()),
+                         sorted(expected))
+
+    def test_supercell(self):
+        n = 8
+        shifts = numpy.array(list(itertools.product(range(n), repeat=3)))
+        supercell = structures.Structure(
+            self.structure.lattice*n,
+            ((self.structure.positions + shifts[:, None]) / n).reshape(
+                -1, 3),
+            self.structure.elements*len(shifts), True)
+        elements = {'I': 'Cs', 'II': 'Pb', 'X': 'I'}
+        proposals = neighbors.propose_bond_lengths(supercell, elements)
+        self.assertAlmostEqual(proposals['R_I_X'], 6.3/2**0.5)
+        self.assertAlmostEqual(proposals['R_II_X'], 3.15)
+        for key, value in neighbors.propose_bond_lengths(
+                self.structure, elements).items():
+            self.assertAlmostEqual(proposals[key], value)
+
+    def test_endpoint(self):
+        compound = synthetic.create_compound(self.user, 'CsPbI3')
+        subset = models.Subset.objects.filter(
+            dataset__compound=compound,
+            atomic_coordinates__isnull=False).first()
+        structures.save(subset, self.user, self.structure)
+        response = self.client.get(
+            reverse('materials:bond_lengths', kwargs={'pk': subset.pk}),
+            {'I': 'Cs', 'II': 'Pb', 'X': 'I'})
+        self.assertEqual(set(response.json()['bond_lengths']),
+                         {'R_I_X', 'R_II_X'})
+        response = self.client.get(
+            reverse('materials:bond_lengths', kwargs={'pk': 0}))
+        self.assertEqual(response.status_code, 404)
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class SimilarityTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username=USERNAME, is_staff=True)
+        cls.compound = synthetic.create_compound(cls.user, 'CsPbI3',
+                                                 n_subsets=3)
+
+    def setUp(self):
+        similarity._index = None
+
+    def test_formula(self):
+        self.assertEqual(similarity.parse_formula('(CH3NH3)PbI3'), {
+            'C': 1/12, 'H': 6/12, 'N': 1/12, 'Pb': 1/12, 'I': 3/12})
+
+    def test_tree(self):
+        points = numpy.random.RandomState(0).rand(500, 6)
+        query = numpy.full(6, 0.5)
+        tree = similarity.KDTree(points)
+        found = tree.search(query, 5, lambda indices: numpy.linalg.norm(
+            points[indices] - query, axis=1))
+        expected = numpy.argsort(numpy.linalg.norm(points - query, axis=1))
+        self.assertEqual([index for _, index in found], expected[:5].tolist())
+
+    def test_search(self):
+        url = reverse('materials:similar_structures')
+        results = self.client.get(url, {
+            'a': 6, 'b': 6, 'c': 6, 'alpha': 90, 'beta': 90, 'gamma': 90,
+            'k': 2}).json()['results']
+        self.assertEqual(len(results), 2)
+        self.assertEqual(results[0]['formula'], 'CsPbI3')
+        # A newly saved structure is found without restarting
+        subset = models.Subset.objects.filter(
+            dataset__compound=self.compound,
+            lattice_constants__isnull=False).first()
+        structures.save(subset, self.user, structures.parse(POSCAR))
+        results = self.client.get(url, {
+            'a': 6.3, 'b': 6.3, 'c': 6.3, 'alpha': 90, 'beta': 90,
+            'gamma': 90, 'formula': 'CsPbI3'}).json()['results']
+        self.assertEqual(results[0]['subset'], subset.pk)
+        self.assertAlmostEqual(results[0]['distance'], 0)
+        self.assertEqual(len(results), 3)
+        results = self.client.get(
+            url, {'subset': subset.pk}).json()['results']
+        self.assertNotIn(subset.pk, [result['subset'] for result in results])
+        self.assertEqual(self.client.get(url, {'a': 1}).status_code, 400)
+
+
+class DescriptorsTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username=USERNAME, is_staff=True)
+        cls.compound = synthetic.create_compound(cls.user, 'CsPbI3',
+                                                 n_subsets=2)
+        cls.subset = models.Subset.objects.filter(
+            dataset__compound=cls.compound,
+            lattice_constants__isnull=False).first()
+
+    def test_compute(self):
+        self.assertAlmostEqual(descriptors.cell_volumes(
+            [[2, 3, 4, 90, 90, 90], [1, 1, 1, 60, 60, 60]])[0], 24)
+        self.assertAlmostEqual(descriptors.cell_volumes(
+            [1, 1, 1, 60, 60, 60])[0], 0.5**0.5)
+        self.assertEqual(descriptors.reduced_formula({'Cs': 2, 'Pb': 2,
+                                                      'I': 6}), 'CsPbI3')
+        structures.save(self.subset, self.user, structures.parse(POSCAR))
+        descriptor = self.subset.descriptor
+        self.assertAlmostEqual(descriptor.volume, 6.3**3)
+        self.assertEqual(descriptor.n_atoms, 5)
+        self.assertEqual(descriptor.reduced_formula, 'CsPbI3')
+        # 720.81 amu in 250.047 Å³
+        self.assertAlmostEqual(descriptor.density, 4.7868, places=3)
+
+    def test_backfill_and_filter(self):
+        models.StructureDescriptor.objects.all().delete()
+        out = io.StringIO()
+        call_command('compute_descriptors', stdout=out)
+        self.assertIn('2 descriptors computed', out.getvalue())
+        url = reverse('materials:structuredescriptor-list')
+        volumes = [row['volume'] for row in self.client.get(
+            url, {'volume_min': 100, 'ordering': '-volume'}).json()]
+        self.assertEqual(len(volumes), 2)
+        self.assertEqual(volumes, sorted(volumes, reverse=True))
+        self.assertEqual(self.client.get(url, {'volume_max': 1}).json(), [])
+        self.assertEqual(
+            self.client.get(url, {'volume_min': 'x'}).status_code, 400)
+
+    def test_viewer(self):
+        structure = structures.parse(POSCAR)
+        structures.save(self.subset, self.user, structure)
+        url = reverse('materials:get_jsmol_input',
+                      kwargs={'pk': self.subset.pk})
+        with self.assertNumQueries(1):
+            response = self.client.get(url)
+        script = response.content.decode()
+        self.assertTrue(script.startswith('load data "model"\ndata_'))
+        self.assertTrue(script.endswith('end "model" {1 1 1}'))
+        self.assertIn('max-age=', response['Cache-Control'])
+        cif = script.split('\n', 1)[1].rsplit('end', 1)[0]
+        self.assertTrue(numpy.allclose(structures.parse(cif, 'cif').positions,
+                                       structure.positions))
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        data = self.client.get(reverse(
+            'materials:compound_structures',
+            kwargs={'pk': self.compound.pk})).json()['structures']
+        self.assertIn({'subset': self.subset.pk,
+                       'dataset': self.subset.dataset_id,
+                       'title': self.subset.title, 'format': 'cif',
+                       'data': cif}, data)
+        # Molecules are loaded from an XYZ file
+        molecule = structures.Structure(None, structure.positions,
+                                        structure.elements, [False]*5)
+        xyz = structures.viewer_data(molecule)
+        self.assertNotIn('{1 1 1}', structures.jsmol_script(xyz))
+        self.assertEqual(structures.parse(xyz, 'xyz').elements,
+                         structure.elements)
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class ToleranceChartTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username=USERNAME, is_staff=True)
+        cls.compound = synthetic.create_compound(
+            cls.user, 'CsPbI3', n_subsets=30, n_space_groups=2)
+        cls.url = reverse('materials:tolerance_factor_chart', kwargs={
+            'data_source': models.ToleranceFactor.SHANNON, 'compound_pk': 0})
+
+    def test_points(self):
+        data = self.client.get(self.url).json()
+        self.assertEqual(data['mode'], 'points')
+        self.assertEqual([len(group['values']) for group in data['data']],
+                         [15, 15])
+
+    def test_bins(self):
+        data = self.client.get(self.url, {'max_points': 10}).json()
+        self.assertEqual(data['mode'], 'bins')
+        viewport = data['viewport']
+        for group in data['data']:
+            self.assertEqual(sum(b['count'] for b in group['bins']), 15)
+            for b in group['bins']:
+                self.assertTrue(viewport['x_min'] < b['x'] < viewport['x_max'])
+                self.assertTrue(viewport['y_min'] < b['y'] < viewport['y_max'])
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                self.client.get(self.url, {'max_points': 10}).json(), data)
+
+    def test_viewport(self):
+        viewport = tolerance_chart.Viewport(0.8, 0.95, 0.8, 1.1)
+        # Snapped to multiples of 16 bins of width 1/512
+        self.assertEqual(viewport.limits[0], (25/32, 31/32))
+        self.assertEqual(viewport.key(), tolerance_chart.Viewport(
+            0.79, 0.94, 0.81, 1.1).key())
+        params = {'x_min': 0.8, 'x_max': 0.95, 'y_min': 0.8, 'y_max': 1.1}
+        data = self.client.get(self.url, params).json()
+        self.assertEqual(data['viewport']['x_max'], 31/32)
+        n_inside = models.ToleranceFactor.objects.filter(
+            data_source=models.ToleranceFactor.SHANNON,
+            t_I__lt=31/32).count()
+        self.assertEqual(sum(len(group['values'])
+                             for group in data['data']), n_inside)
+        self.assertEqual(self.client.get(
+            self.url, {**params, 'max_points': 1}).json()['mode'], 'bins')
+        self.assertEqual(
+            self.client.get(self.url, {'x_min': 1}).status_code, 400)
+        self.assertEqual(self.client.get(
+            self.url, {**params, 'x_max': 0.5}).status_code, 400)
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class ToleranceSearchTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username=USERNAME, is_staff=True)
+        cls.compounds = [synthetic.create_compound(
+            cls.user, f'Cs{i}PbI3', n_subsets=4, n_space_groups=2)
+                         for i in range(6)]
+        cls.url = reverse('materials:tolerance_factor_neighbors')
+
+    def setUp(self):
+        tolerance_search._index = None
+
+    def brute_force(self, point, data_source=0):
+        nearest = {}
+        for compound, t_I, t_IV_V in models.ToleranceFactor.objects.filter(
+                data_source=data_source).values_list(
+                    'compound', 't_I', 't_IV_V'):
+            distance = numpy.hypot(t_I - point[0], t_IV_V - point[1])
+            nearest[compound] = min(nearest.get(compound, numpy.inf),
+                                    distance)
+        return sorted((distance, compound)
+                      for compound, distance in nearest.items())
+
+    def test_search(self):
+        for data_source in (0, 2):
+            results = self.client.get(self.url, {
+                't_I': 0.9, 't_IV_V': 1.0, 'k': 4,
+                'data_source': data_source}).json()['results']
+            expected = self.brute_force((0.9, 1.0), data_source)[:4]
+            self.assertEqual([result['compound'] for result in results],
+                             [compound for _, compound in expected])
+            for result, (distance, _) in zip(results, expected):
+                self.assertAlmostEqual(result['distance'], distance)
+        # A new tolerance factor is found without restarting
+        compound = models.Compound.objects.create(formula='RbPbI3',
+                                                  created_by=self.user)
+        tolerance_factor = models.ToleranceFactor.objects.filter(
+            data_source=0).first()
+        tolerance_factor.pk = None
+        tolerance_factor.compound = compound
+        tolerance_factor.t_I = 0.9
+        tolerance_factor.t_IV_V = 1.0
+        tolerance_factor.save()
+        results = self.client.get(
+            self.url, {'t_I': 0.9, 't_IV_V': 1.0}).json()['results']
+        self.assertEqual(results[0]['formula'], 'RbPbI3')
+        self.assertAlmostEqual(results[0]['distance'], 0)
+        self.assertEqual(len(results), 7)
+
+    def test_filters(self):
+        compound = self.compounds[0]
+        results = self.client.get(
+            self.url, {'compound': compound.pk}).json()['results']
+        self.assertEqual(len(results), 5)
+        self.assertNotIn(compound.pk,
+                         [result['compound'] for result in results])
+        space_group = models.SpaceGroup.objects.get(name='P2')
+        results = self.client.get(self.url, {
+            't_I': 1, 't_IV_V': 1,
+            'space_group': space_group.pk}).json()['results']
+        self.assertEqual({result['space-group'] for result in results},
+                         {'P2'})
+        self.assertEqual(self.client.get(self.url, {'t_I': 1}).status_code,
+                         400)
+
+
+class UnitsTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username=USERNAME, is_staff=True)
+        cls.compound = synthetic.create_compound(cls.user, 'CsPbI3',
+                                                 n_subsets=2, n_points=40)
+
+    def test_convert(self):
+        self.assertEqual(units.convert([1, 2], 'eV', 'meV').tolist(),
+                         [1000, 2000])
+        self.assertAlmostEqual(units.convert(300, 'K', '°C'), 26.85)
+        self.assertAlmostEqual(units.convert(1, 'GPa', 'kbar'), 10)
+        self.assertAlmostEqual(units.convert(1, 'g/cm³', 'kg/m^3'), 1000)
+        self.assertAlmostEqual(units.convert(1, 'Å^3', 'nm3'), 1e-3)
+        self.assertAlmostEqual(units.convert(1, 'Ha', 'eV'), 27.2113862)
+        for from_label, to_label in (('eV', 'K'), ('a.u.', 'eV'),
+                                     ('°C/s', 'K/s'), ('eV', 'foo')):
+            with self.assertRaises(units.UnitError):
+                units.convert(1, from_label, to_label)
+        # A column of fixed values with mixed units
+        values = units.convert_column([1, 2, 300], ['K', 'mK', '°C'], 'mK')
+        self.assertTrue(numpy.allclose(values, [1000, 2, 573150]))
+        rows = models.FixedPropertyValue.objects.values_list(
+            'value', 'unit__label')
+        self.assertTrue(numpy.allclose(
+            units.convert_column([row[0] for row in rows],
+                                 [row[1] for row in rows], 'mK'),
+            [row[0]*1000 for row in rows]))
+        self.assertEqual(units.describe('meV')['dimensions'],
+                         {'m': 2, 'kg': 1, 's': -2})
+        self.assertIsNone(units.describe('foo'))
+
+    def test_chart(self):
+        subset = models.Subset.objects.filter(
+            dataset__compound=self.compound, curves__isnull=False).first()
+        url = reverse('materials:data_for_chart', kwargs={'pk': subset.pk})
+        data = self.client.get(url).json()
+        self.assertEqual(data['x unit'], 'eV')
+        self.assertEqual(len(data['data']), 2)
+        converted = self.client.get(url, {'x_unit': 'meV'}).json()
+        self.assertEqual(converted['x unit'], 'meV')
+        self.assertEqual(converted['y unit'], 'a.u.')
+        for curve, converted_curve in zip(data['data'], converted['data']):
+            self.assertEqual(len(curve['values']), 10)
+            for value, converted_value in zip(curve['values'],
+                                              converted_curve['values']):
+                self.assertAlmostEqual(converted_value['x'], 1000*value['x'])
+                self.assertEqual(converted_value['y'], value['y'])
+        self.assertEqual(
+            self.client.get(url, {'y_unit': 'eV'}).status_code, 400)
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class ComparisonTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username=USERNAME, is_staff=True)
+        cls.compound = synthetic.create_compound(cls.user, 'CsPbI3',
+                                                 n_points=40)
+        cls.subset = models.Subset.objects.filter(
+            dataset__compound=cls.compound, curves__isnull=False).first()
+        other_subset = models.Subset.objects.filter(
+            dataset__compound=cls.compound, curves__isnull=True).first()
+        cls.charts = []
+        # y = 2x in eV and y = 1 + 2x with x in meV
+        for x_unit, points in (('eV', ((0, 0), (1, 2))),
+                               ('meV', ((0, 1), (1000, 3), (500, 2)))):
+            chart = models.Chart.objects.create(
+                created_by=cls.user, subset=other_subset, x_unit=x_unit,
+                y_unit='a.u.')
+            models.Datapoint.objects.bulk_create(
+                models.Datapoint(created_by=cls.user, chart=chart,
+                                 x_value=x, y_value=y) for x, y in points)
+            cls.charts.append(chart.pk)
+        cls.url = reverse('materials:compare_curves')
+
+    def test_compare(self):
+        charts = ','.join(map(str, self.charts))
+        result = self.client.get(self.url, {
+            'charts': charts, 'n_points': 5}).json()
+        self.assertEqual(result['x'], [0, 0.25, 0.5, 0.75, 1])
+        self.assertEqual(result['x unit'], 'eV')
+        first, second = result['curves']
+        self.assertTrue(numpy.allclose(first['y'], [0, 0.5, 1, 1.5, 2]))
+        self.assertTrue(numpy.allclose(second['y'], [1, 1.5, 2, 2.5, 3]))
+        self.assertTrue(numpy.allclose(second['difference'], 1))
+        self.assertAlmostEqual(second['rmsd'], 1)
+        self.assertTrue(numpy.allclose(result['statistics']['std'], 0.5))
+        self.assertEqual(result['statistics']['count'], [2]*5)
+        # Cached regardless of the order of the curves
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(self.url, {
+                'charts': ','.join(map(str, self.charts[::-1])),
+                'n_points': 5}).json(), result)
+        result = self.client.get(self.url, {
+            'charts': charts, 'n_points': 3, 'x_min': -1, 'x_max': 1,
+            'x_unit': 'meV', 'reference': self.charts[1]}).json()
+        self.assertEqual(result['x'], [-1, 0, 1])
+        self.assertEqual(result['curves'][0]['y'], [None, 0, 0.002])
+        self.assertEqual(result['statistics']['mean'][0], None)
+        self.assertTrue(numpy.allclose(result['curves'][0]['difference'][1:],
+                                       -1))
+
+    def test_subsets(self):
+        result = self.client.get(self.url, {
+            'subsets': self.subset.pk, 'charts': self.charts[0]}).json()
+        self.assertEqual(len(result['curves']), 3)
+        self.assertEqual(len(result['x']), 200)
+        for params in ({'charts': self.charts[0], 'y_unit': 'eV'},
+                       {'charts': self.charts[0], 'n_points': 1},
+                       {'charts': self.charts[0], 'reference': 0},
+                       {'subsets': 'x'}, {}):
+            self.assertEqual(self.client.get(self.url, params).status_code,
+                             400)
@@ -0,0 +1,169 @@
+# This file is covered by the BSD license. See LICENSE in the root directory.
+"""Tolerance factor chart data for a viewport of the (t_I, t_IV_V) plane.
+
+If at most max_points tolerance factors fall into the viewport, they
+are returned as points. Otherwise they are counted in a 2-D histogram
+per space group, of which only the nonempty bins are returned.
+
+Viewports are snapped to tiles so that nearby viewports share cached
+results: the width of the bins is the largest power of two that gives
+at least the requested number of bins along each axis, and the
+viewport is extended to multiples of TILE_BINS bins. The bins are
+therefore aligned across all viewports at the same zoom level.
+
+"""
+import math
+
+import numpy
+from django.db.models import Max
+from django.db.models import Min
+
+from . import caching
+from . import models
+
+TILE_BINS = 16
+DEFAULT_BINS = 64
+AXES = ('t_I', 't_IV_V')
+
+
+class Viewport:
+    """Rectangle of the chart snapped to tiles (see module docstring)."""
+    def __init__(self, x_min, x_max, y_min, y_max, bins=DEFAULT_BINS):
+        if not x_min < x_max or not y_min < y_max:
+            raise ValueError('The viewport must have a positive size.')
+        self.bins = []
+        self.bin_widths = []
+        self.limits = []
+        for lower, upper in ((x_min, x_max), (y_min, y_max)):
+            width = 2.0**math.floor(math.log2((upper - lower)/bins))
+            tile = width*TILE_BINS
+            lower = math.floor(lower/tile)*tile
+            upper = max(math.ceil(upper/tile)*tile, lower + tile)
+            self.bin_widths.append(width)
+            self.bins.append(int(round((upper - lower)/width)))
+            self.limits.append((lower, upper))
+
+    def key(self):
+        return (*self.limits[0], *self.limits[1], *self.bin_widths)
+
+    def as_dict(self):
+        (x_min, x_max), (y_min, y_max) = self.limits
+        return {'x_min': x_min, 'x_max': x_max,
+                'y_min': y_min, 'y_max': y_max}
+
+
+def get_queryset(data_source, compound_pk):
+    queryset = models.ToleranceFactor.objects.filter(data_source=data_source)
+    if compound_pk:
+        queryset = queryset.filter(compound__pk=compound_pk)
+    return queryset
+
+
+def full_viewport(queryset, bins=DEFAULT_BINS):
+    """Return the viewport covering all tolerance factors or None."""
+    extent = queryset.aggregate(x_min=Min('t_I'), x_max=Max('t_I'),
+                                y_min=Min('t_IV_V'), y_max=Max('t_IV_V'))
+    if None in extent.values():
+        return None
+    # Add a margin so that points on the edges are inside
+    margin = {axis: max(extent[f'{axis}_max'] - extent[f'{axis}_min'],
+                        1e-3)*0.01 for axis in 'xy'}
+    return Viewport(extent['x_min'] - margin['x'],
+                    extent['x_max'] + margin['x'],
+                    extent['y_min'] - margin['y'],
+                    extent['y_max'] + margin['y'], bins)
+
+
+def points(queryset):
+    """Return the tolerance factors grouped by space group."""
+    data = []
+    group = {}
+    for tolerance_factor in queryset.select_related(
+            'compound', 'space_group').order_by('space_group', 'pk'):
+        if group.get('space-group') != tolerance_factor.space_group.name:
+            group = {
+                'space-group': tolerance_factor.space_group.name,
+                'compounds': [],
+                'values': [],
+            }
+            data.append(group)
+        group['compounds'].append((tolerance_factor.compound.formula,
+                                   tolerance_factor.compound.pk))
+        group['values'].append({
+            'x': ('%.4f' % tolerance_factor.t_I
+                  if tolerance_factor.t_I else None),
+            'y': ('%.4f' % tolerance_factor.t_IV_V
+                  if tolerance_factor.t_IV_V else None),
+        })
+    return data
+
+
+def histogram(queryset, viewport):
+    """Return the nonempty bins of each space group in the viewport.
+
+    Each bin is given by its center and the number of tolerance factors
+    in it.
+    """
+    rows = numpy.array(list(queryset.order_by().values_list(
+        'space_group', *AXES).iterator()), dtype=float).reshape(-1, 3)
+    groups = rows[:, 0].astype(numpy.int64)
+    values = rows[:, 1:]
+    n_bins = numpy.array(viewport.bins)
+    lower = numpy.array([limits[0] for limits in viewport.limits])
+    indices = numpy.minimum(
+        ((values - lower)/viewport.bin_widths).astype(numpy.int64),
+        n_bins - 1)
+    group_pks, group_indices = numpy.unique(groups, return_inverse=True)
+    keys = (group_indices.ravel()*n_bins[0] + indices[:, 0])*n_bins[1]
+    keys += indices[:, 1]
+    keys, counts = numpy.unique(keys, return_counts=True)
+    group_indices, keys = numpy.divmod(keys, n_bins.prod())
+    centers = (numpy.column_stack(numpy.divmod(keys, n_bins[1])) + 0.5)
+    centers = centers*viewport.bin_widths + lower
+    names = dict(models.SpaceGroup.objects.filter(
+        pk__in=group_pks.tolist()).values_list('pk', 'name'))
+    data = []
+    for i_group, pk in enumerate(group_pks.tolist()):
+        mask = group_indices == i_group
+        data.append({
+            'space-group': names[pk],
+            'bins': [{'x': x, 'y': y, 'count': count} for (x, y), count in
+                     zip(centers[mask].tolist(), counts[mask].tolist())],
+        })
+    return data
+
+
+def compute(data_source, compound_pk, viewport, max_points):
+    """Return the points or bins of the tolerance factors in viewport.
+
+    viewport may be None for all tolerance factors. The result says
+    which of the two it contains under "mode".
+    """
+    queryset = get_queryset(data_source, compound_pk)
+    if viewport is None:
+        if queryset.count() <= max_points:
+            return {'mode': 'points', 'viewport': None,
+                    'data': points(queryset)}
+        viewport = full_viewport(queryset)
+        if viewport is None:
+            return {'mode': 'bins', 'viewport': None, 'data': []}
+    (x_min, x_max), (y_min, y_max) = viewport.limits
+    queryset = queryset.filter(t_I__gte=x_min, t_I__lt=x_max,
+                               t_IV_V__gte=y_min, t_IV_V__lt=y_max)
+    result = {'viewport': viewport.as_dict(),
+              'bin-widths': viewport.bin_widths}
+    if queryset.count() <= max_points:
+        result.update(mode='points', data=points(queryset))
+    else:
+        result.update(mode='bins', data=histogram(queryset, viewport))
+    return result
+
+
+def get_data(data_source, compound_pk, viewport, max_points):
+    """Return compute(...) from the cache if possible."""
+    return caching.get_or_set(
+        'tolerance_chart', (models.ToleranceFactor, models.Compound,
+                            models.SpaceGroup),
+        (data_source, compound_pk, max_points,
+         *(viewport.key() if viewport else ())),
+        lambda: compute(data_source, compound_pk, viewport, max_points))
@@ -0,0 +1,142 @@
+# This file is covered by the BSD license. See LICENSE in the root directory.
+"""In-memory index for finding compounds with similar tolerance factors.
+
+Each worker keeps the (t_I, t_IV_V) points of all tolerance factors in
+one KD-tree per data source (see similarity.KDTree). The space group is
+an optional filter of the search. Like the index of similar cells, the
+index is synced incrementally before each search whenever the version
+counter of the tolerance factors has changed (see
+similarity.IncrementalIndex).
+
+A compound can have several tolerance factors for a data source. Only
+the nearest one counts, so the search is repeated with more neighbors
+until k distinct compounds are found.
+
+"""
+import math
+import threading
+
+import numpy
+
+from . import models
+from . import similarity
+
+_lock = threading.RLock()
+_index = None
+
+
+class Index(similarity.IncrementalIndex):
+    """Tolerance factors and a KD-tree for each data source.
+
+    The rows are (data source, space group, compound, point).
+    """
+    model = models.ToleranceFactor
+    labels = (models.ToleranceFactor,)
+    fields = ('data_source', 'space_group', 'compound', 't_I', 't_IV_V')
+
+    def __init__(self):
+        super().__init__()
+        self.trees = {}  # Data source -> (pks, KDTree)
+
+    def get_queryset(self):
+        return models.ToleranceFactor.objects.filter(
+            t_I__isnull=False, t_IV_V__isnull=False)
+
+    def make_row(self, values):
+        data_source, space_group, compound, *point = values
+        return data_source, space_group, compound, numpy.array(point)
+
+    def rebuild(self):
+        pks = {}
+        for pk, row in self.rows.items():
+            pks.setdefault(row[0], []).append(pk)
+        self.trees = {}
+        for data_source, source_pks in pks.items():
+            source_pks = numpy.array(sorted(source_pks), dtype=int)
+            self.trees[data_source] = (source_pks, similarity.KDTree(
+                [self.rows[pk][3] for pk in source_pks], dimensions=2))
+
+    def search(self, data_source, point, k=10, space_group=None,
+               exclude=None):
+        """Return the k nearest (distance, ToleranceFactor pk).
+
+        Only tolerance factors of the data source and, if given, the
+        space group are considered. Compounds listed in exclude are
+        skipped.
+        """
+        query = numpy.asarray(point, dtype=float)
+        exclude = set(exclude or ())
+
+        def distances(pks, in_tree=True):
+            result = []
+            for pk in pks:
+                row = self.rows.get(pk)
+                if (row is None or in_tree and pk in self.removed or
+                        row[0] != data_source or row[2] in exclude or
+                        space_group is not None and row[1] != space_group):
+                    result.append(math.inf)
+                else:
+                    result.append(float(numpy.linalg.norm(row[3] - query)))
+            return result
+        results = []
+        if data_source in self.trees:
+            tree_pks, tree = self.trees[data_source]
+            results = [(distance, int(tree_pks[i])) for distance, i in
+                       tree.search(query, k,
+                                   lambda i: distances(tree_pks[i]))]
+        pending = list(self.pending)
+        results += zip(distances(pending, in_tree=False), pending)
+        return [result for result in sorted(results)[:k]
+                if math.isfinite(result[0])]
+
+    def nearest_compounds(self, data_source, point, k=10, space_group=None,
+                          exclude=None):
+        """Return the nearest tolerance factor of the k nearest compounds.
+
+        The results are (distance, ToleranceFactor pk) as in search.
+        """
+        n_neighbors = k
+        while True:
+            results = self.search(data_source, point, n_neighbors,
+                                  space_group, exclude)
+            nearest = {}
+            for distance, pk in results:
+                nearest.setdefault(self.rows[pk][2], (distance, pk))
+            if len(nearest) >= k or len(results) < n_neighbors:
+                return sorted(nearest.values())[:k]
+            n_neighbors *= 2
+
+
+def get_index():
+    """Return the index of this worker, brought up to date."""
+    global _index
+    with _lock:
+        if _index is None:
+            _index = Index()
+        _index.sync()
+        return _index
+
+
+def search(data_source, point, k=10, space_group=None, exclude=None):
+    """Return the compounds with the nearest tolerance factors.
+
+    Each result is a dict with the compound, its formula, the space
+    group, the subset and values of the tolerance factor, and the
+    distance.
+    """
+    with _lock:
+        results = get_index().nearest_compounds(data_source, point, k,
+                                                space_group, exclude)
+    distances = dict((pk, distance) for distance, pk in results)
+    rows = models.ToleranceFactor.objects.filter(pk__in=distances).values(
+        'pk', 'compound', 'compound__formula', 'space_group__name', 'subset',
+        't_I', 't_IV_V')
+    return sorted(({
+        'compound': row['compound'],
+        'formula': row['compound__formula'],
+        'space-group': row['space_group__name'],
+        'subset': row['subset'],
+        't_I': row['t_I'],
+        't_IV_V': row['t_IV_V'],
+        'distance': distances[row['pk']],
+    } for row in rows), key=lambda result: result['distance'])
@@ -0,0 +1,183 @@
+# This file is covered by the BSD license. See LICENSE in the root directory.
+"""Registry of units and vectorized conversion between them.
+
+Unit labels (see models.Unit and the units of the curves) are parsed
+into a Definition: the factor and offset that convert a value into SI
+units and the exponents of the base dimensions. Labels may combine the
+units of UNITS with the prefixes of PREFIXES, e.g., "meV", "GPa", or
+"kcal/mol", and with exponents, e.g., "Å^3", "Å³", "cm^-1", "cm⁻¹", or
+"eV/Å". Units with an offset (°C and °F) can only be used alone.
+Arbitrary units ("a.u.") have a dimension of their own, so that they
+can only be converted into themselves.
+
+Whole columns of values are converted at once with NumPy (see
+convert and convert_column), e.g., the data points of a curve or the
+fixed values of many subsets.
+
+"""
+import collections
+import functools
+import re
+
+import numpy
+
+# Length, mass, time, current, temperature, amount, arbitrary
+DIMENSIONS = ('m', 'kg', 's', 'A', 'K', 'mol', 'a.u.')
+
+Definition = collections.namedtuple('Definition',
+                                    'factor offset dimensions')
+
+
+def _dimensions(**exponents):
+    return tuple(exponents.get(name, 0) for name in
+                 ('L', 'M', 'T', 'I', 'Theta', 'N', 'X'))
+
+
+ENERGY = _dimensions(L=2, M=1, T=-2)
+PRESSURE = _dimensions(L=-1, M=1, T=-2)
+ELECTRON_VOLT = 1.602176634e-19
+# Symbol: (factor, offset, dimensions, whether prefixes are allowed)
+UNITS = {
+    'm': (1, 0, _dimensions(L=1), True),
+    'Å': (1e-10, 0, _dimensions(L=1), False),
+    'g': (1e-3, 0, _dimensions(M=1), True),
+    'u': (1.66053906660e-27, 0, _dimensions(M=1), False),
+    's': (1, 0, _dimensions(T=1), True),
+    'min': (60, 0, _dimensions(T=1), False),
+    'h': (3600, 0, _dimensions(T=1), False),
+    'A': (1, 0, _dimensions(I=1), True),
+    'K': (1, 0, _dimensions(Theta=1), True),
+    '°C': (1, 273.15, _dimensions(Theta=1), False),
+    '°F': (5/9, 273.15 - 32*5/9, _dimensions(Theta=1), False),
+    'mol': (1, 0, _dimensions(N=1), True),
+    'Hz': (1, 0, _dimensions(T=-1), True),
+    'N': (1, 0, _dimensions(L=1, M=1, T=-2), True),
+    'J': (1, 0, ENERGY, True),
+    'cal': (4.184, 0, ENERGY, True),
+    'eV': (ELECTRON_VOLT, 0, ENERGY, True),
+    'Ry': (13.605693122994*ELECTRON_VOLT, 0, ENERGY, False),
+    'Ha': (27.211386245988*ELECTRON_VOLT, 0, ENERGY, False),
+    'W': (1, 0, _dimensions(L=2, M=1, T=-3), True),
+    'Pa': (1, 0, PRESSURE, True),
+    'bar': (1e5, 0, PRESSURE, True),
+    'atm': (101325, 0, PRESSURE, False),
+    'Torr': (101325/760, 0, PRESSURE, False),
+    'C': (1, 0, _dimensions(T=1, I=1), True),
+    'V': (1, 0, _dimensions(L=2, M=1, T=-3, I=-1), True),
+    'Ω': (1, 0, _dimensions(L=2, M=1, T=-3, I=-2), True),
+    'S': (1, 0, _dimensions(L=-2, M=-1, T=3, I=2), True),
+    'F': (1, 0, _dimensions(L=-2, M=-1, T=4, I=2), True),
+    'L': (1e-3, 0, _dimensions(L=3), True),
+    '%': (0.01, 0, _dimensions(), False),
+    'a.u.': (1, 0, _dimensions(X=1), False),
+}
+UNITS['ohm'] = UNITS['Ω']
+UNITS['℃'] = UNITS['°C']
+PREFIXES = {
+    'P': 1e15, 'T': 1e12, 'G': 1e9, 'M': 1e6, 'k': 1e3, 'h': 1e2,
+    'd': 1e-1, 'c': 1e-2, 'm': 1e-3, 'µ': 1e-6, 'μ': 1e-6, 'u': 1e-6,
+    'n': 1e-9, 'p': 1e-12, 'f': 1e-15,
+}
+SUPERSCRIPTS = str.maketrans('⁻⁰¹²³⁴⁵⁶⁷⁸⁹', '-0123456789')
+TERM = re.compile(r'(?P<symbol>[^\d^+-]+?)\^?(?P<exponent>[-+]?\d+)?')
+
+
+class UnitError(ValueError):
+    pass
+
+
+def parse_symbol(symbol):
+    """Return the factor, offset, and dimensions of a single unit."""
+    if symbol in UNITS:
+        return UNITS[symbol][:3]
+    for prefix, prefix_factor in PREFIXES.items():
+        unit = UNITS.get(symbol[len(prefix):])
+        if symbol.startswith(prefix) and unit and unit[3]:
+            return unit[0]*prefix_factor, unit[1], unit[2]
+    raise UnitError(f'Unknown unit "{symbol}".')
+
+
+@functools.lru_cache(maxsize=1024)
+def parse(label):
+    """Return the Definition of a unit label.
+
+    An empty label means a dimensionless quantity.
+    """
+    label = label.strip()
+    if label in UNITS:
+        return Definition(*UNITS[label][:3])
+    factor = 1.0
+    dimensions = numpy.zeros(len(DIMENSIONS), dtype=int)
+    for i_part, part in enumerate(label.translate(SUPERSCRIPTS).split('/')):
+        for term in re.split(r'[\s*·]+', part.strip()):
+            if not term:
+                continue
+            match = TERM.fullmatch(term)
+            if not match:
+                raise UnitError(f'Invalid unit "{label}".')
+            term_factor, offset, term_dimensions = parse_symbol(
+                match.group('symbol'))
+            if offset:
+                raise UnitError(
+                    f'"{match.group("symbol")}" cannot be combined with '
+                    'other units.')
+            exponent = int(match.group('exponent') or 1)
+            if i_part > 0:
+                exponent = -exponent
+            factor *= term_factor**exponent
+            dimensions += exponent*numpy.array(term_dimensions)
+    return Definition(factor, 0, tuple(dimensions.tolist()))
+
+
+def describe(label):
+    """Return the SI factor and base units of a label or None if unknown.
+
+    For example, "meV" gives {"factor": 1.602e-22, "dimensions":
+    {"m": 2, "kg": 1, "s": -2}}.
+    """
+    try:
+        definition = parse(label)
+    except UnitError:
+        return None
+    return {
+        'factor': definition.factor,
+        'offset': definition.offset,
+        'dimensions': {name: exponent for name, exponent in
+                       zip(DIMENSIONS, definition.dimensions) if exponent},
+    }
+
+
+def conversion(from_label, to_label):
+    """Return the scale and shift that convert from_label to to_label.
+
+    A value is converted as value*scale + shift.
+    """
+    source = parse(from_label)
+    target = parse(to_label)
+    if source.dimensions != target.dimensions:
+        raise UnitError(f'Cannot convert "{from_label}" to "{to_label}".')
+    return (source.factor/target.factor,
+            (source.offset - target.offset)/target.factor)
+
+
+def convert(values, from_label, to_label):
+    """Return an array of the values converted into to_label."""
+    scale, shift = conversion(from_label, to_label)
+    return numpy.asarray(values, dtype=float)*scale + shift
+
+
+def convert_column(values, labels, to_label):
+    """Return the values, each in the unit of labels, in to_label.
+
+    labels gives the unit of each value, e.g., the units of the
+    FixedPropertyValues of many subsets. Each distinct unit is looked
+    up once.
+    """
+    unique_labels, indices = numpy.unique(
+        numpy.asarray(labels, dtype=str), return_inverse=True)
+    scales, shifts = numpy.array(
+        [conversion(label, to_label) for label in unique_labels],
+        dtype=float).reshape(-1, 2).T
+    indices = indices.ravel()
+    return (numpy.asarray(values, dtype=float)*scales[indices] +
+            shifts[indices])
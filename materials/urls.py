@@ -11,6 +11,7 @@ router.register('references', views.ReferenceViewSet)
 router.register('properties', views.PropertyViewSet)
 router.register('units', views.UnitViewSet)
 router.register('space-groups', views.SpaceGroupViewSet)
+router.register('structure-descriptors', views.StructureDescriptorViewSet)
 # router.register('datasets', views.DatasetViewSet)
 
 app_name = 'materials'
@@ -31,17 +32,39 @@ urlpatterns = [
     path('update-dataset/<int:pk>', views.UpdateDatasetView.as_view(), name='update_dataset'),
     path('import-data', views.ImportDataView.as_view(), name='import_data'),
     path('submit-data', views.submit_data, name='submit_data'),
+    path('ingestion-job/<int:pk>', views.ingestion_job, name='ingestion_job'),
+    path('ingestion-job/<int:pk>/status', views.ingestion_job_page,
+         name='ingestion_job_page'),
+    path('subset/<int:pk>/structure', views.subset_structure,
+         name='subset_structure'),
     path('tolerance-factor', views.ToleranceFactorView.as_view(), name='tolerance_factor'),
     path('tolerance-factor-chart/<int:data_source>/<int:compound_pk>', views.data_for_tf, name='tolerance_factor_chart'),
 #     path('reference/<int:pk>', views.ReferenceDetailView.as_view(),
 #          name='reference'),
+    path('export/dataset/<int:dataset_pk>/<str:file_format>',
+         views.export_data, name='export_dataset'),
+    path('export/compound/<int:compound_pk>/<str:file_format>',
+         views.export_data, name='export_compound'),
+    path('export/all/<str:file_format>', views.export_data,
+         name='export_all'),
+    path('export/structures/<str:file_format>', views.export_structures,
+         name='export_structures'),
+    path('changes', views.change_feed, name='change_feed'),
     path('autofill-input-data', views.autofill_input_data),
     path('data-for-chart/<int:pk>', views.data_for_chart,
          name='data_for_chart'),
+    path('compare-curves', views.compare_curves, name='compare_curves'),
+    path('bond-lengths/<int:pk>', views.bond_lengths, name='bond_lengths'),
+    path('similar-structures', views.similar_structures,
+         name='similar_structures'),
+    path('tolerance-factor-neighbors', views.tolerance_factor_neighbors,
+         name='tolerance_factor_neighbors'),
 #     path('get-subset-values/<int:pk>', views.get_subset_values,
 #          name='get_subset_values'),
     path('get-jsmol-input/<int:pk>', views.get_jsmol_input,
          name='get_jsmol_input'),
+    path('compound-structures/<int:pk>', views.compound_structures,
+         name='compound_structures'),
 #     path('report-issue', views.report_issue, name='report_issue'),
     # path('prefilled-form/<int:pk>', views.prefilled_form,
     #      name='prefilled_form'),
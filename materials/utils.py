@@ -14,6 +14,28 @@ matplotlib.use('Agg')  # noqa
 from matplotlib import pyplot
 
 
+def iterate_in_chunks(queryset, fields, chunk_size=2000):
+    """Yield value tuples of the queryset, reading chunk_size rows at a time.
+
+    The rows are fetched in order of the primary key with keyset
+    pagination (pk > last seen pk) so that memory use is constant even
+    on database backends that cannot stream results, such as MySQL.
+    The primary key is prepended to each tuple.
+
+    """
+    last_pk = None
+    while True:
+        chunk = queryset
+        if last_pk is not None:
+            chunk = chunk.filter(pk__gt=last_pk)
+        rows = list(chunk.order_by('pk').values_list('pk', *fields)[
+            :chunk_size])
+        yield from rows
+        if len(rows) < chunk_size:
+            break
+        last_pk = rows[-1][0]
+
+
 def atomic_coordinates_as_json(pk):
     """Get atomic coordinates from database."""
     subset = models.Subset.objects.get(pk=pk)
@@ -1,5 +1,6 @@
 # This file is covered by the BSD license. See LICENSE in the root directory.
 from functools import reduce
+import hashlib
 import io
 import json
 import logging
@@ -8,23 +9,22 @@ import os
 import re
 import requests
 import zipfile
-import math
 
+import numpy
+from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.auth.models import User
-from django.core.files.uploadedfile import SimpleUploadedFile
 from django.core.files.uploadedfile import UploadedFile
 from django.core.mail import send_mail
 from django.db import transaction
 from django.db.models import BooleanField
 from django.db.models import Case
+from django.db.models import F
 from django.db.models import Q
 from django.db.models import Value
 from django.db.models import When
-from django.db.models import Avg
-from django.db.models import Max
 from django.db.models.fields import TextField, FloatField
 from django.forms import ModelChoiceField
 from django.forms.models import model_to_dict
@@ -32,27 +32,52 @@ from django.http import Http404
 from django.http import HttpResponse
 from django.http import HttpResponseForbidden
 from django.http import JsonResponse
+from django.http import StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from django.shortcuts import redirect
 from django.shortcuts import render
 from django.shortcuts import reverse
+from django.template.loader import render_to_string
+from django.utils.cache import get_conditional_response
+from django.utils.cache import patch_cache_control
+from django.utils.decorators import method_decorator
 from django.utils.html import escape
+from django.utils.http import quote_etag
 from django.utils.safestring import mark_safe
 from django.views import generic
+from django.views.decorators.http import require_POST
 from rest_framework import viewsets
 from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
 
+from mainproject import replicas
 
+from . import caching
+from . import changes
+from . import comparison
+from . import export
 from . import forms
+from . import ingestion
 from . import models
+from . import neighbors
 from . import permissions
 from . import qresp
 from . import serializers
+from . import similarity
+from . import structures
+from . import tolerance_chart
+from . import tolerance_search
+from . import units
 from . import utils
 
 logger = logging.getLogger(__name__)
 
+# Models shown in the search results
+SEARCH_MODELS = (models.Compound, models.Dataset, models.Property,
+                 models.Subset, models.Reference, models.Author)
+
+
 def dataset_author_check(view):
     """Test whether the logged on user is the creator of the data set."""
     @login_required
@@ -119,67 +144,86 @@ class SearchFormView(generic.TemplateView):
         })
 
     def post(self, request):
+        """Return the search results as an HTML fragment.
+
+        The fragment is cached until any compound, data set, reference,
+        or author changes.
+        """
         template_name = 'materials/search_results.html'
         form = forms.SearchForm(request.POST)
-        search_text = ''
-        # default search_term
-        search_term = 'formula'
-        if form.is_valid():
-            search_text = form.cleaned_data['search_text']
-            search_term = request.POST.get('search_term')
-            systems_info = []
-            if search_term == 'formula':
-                compounds = models.Compound.objects.filter(
-                    formula__icontains=search_text).exclude(
-                    datasets__isnull=True).order_by(
-                        'formula')
-            elif search_term == 'primary_property':
-                compounds = models.Compound.objects.filter(
-                    datasets__primary_property__name__icontains=search_text).exclude(
-                    datasets__isnull=True).order_by(
+        if not form.is_valid():
+            return render(request, template_name, {
+                'compounds_map': [], 'search_term': 'formula'})
+        search_text = form.cleaned_data['search_text']
+        search_term = request.POST.get('search_term')
+        return HttpResponse(caching.get_or_set(
+            'search', SEARCH_MODELS, [search_term, search_text],
+            lambda: render_to_string(template_name, {
+                'compounds_map': self.search(search_term, search_text),
+                'search_term': search_term,
+            })))
+
+    def search(self, search_term, search_text):
+        """Return the matching compounds with properties and authors."""
+        if search_term == 'formula':
+            compounds = models.Compound.objects.filter(
+                formula__icontains=search_text).exclude(
+                datasets__isnull=True).order_by(
                     'formula')
-            elif search_term == 'author':
-                keywords = search_text.split()
-                query = reduce(operator.or_, (
-                    Q(datasets__subsets__reference__authors__last_name__icontains=x) for
-                    x in keywords))
-                compounds = models.Compound.objects.filter(query).exclude(
-                    datasets__isnull=True).distinct()
-            else:
-                raise KeyError('Invalid search term.')
-            compounds_map = []
-            for compound in compounds:
-                primary_properties = models.Property.objects.filter(
-                    datasets__compound__formula=compound.formula).values_list('name', flat=True).distinct()
-                authors = ""
-                for reference in models.Reference.objects.filter(
-                    subsets__dataset__compound__formula=compound.formula):
-                    authors += reference.getAuthorsAsString()
-                compounds_map.append([compound, primary_properties, authors])
-        args = {
-            'compounds_map': compounds_map,
-            'search_term': search_term,
-        }
-        return render(request, template_name, args)
-
-
+        elif search_term == 'primary_property':
+            compounds = models.Compound.objects.filter(
+                datasets__primary_property__name__icontains=search_text).exclude(
+                datasets__isnull=True).order_by(
+                'formula')
+        elif search_term == 'author':
+            keywords = search_text.split()
+            query = reduce(operator.or_, (
+                Q(datasets__subsets__reference__authors__last_name__icontains=x) for
+                x in keywords))
+            compounds = models.Compound.objects.filter(query).exclude(
+                datasets__isnull=True).distinct()
+        else:
+            raise KeyError('Invalid search term.')
+        compounds = list(compounds)
+        primary_properties = {compound.pk: [] for compound in compounds}
+        for compound_pk, name in models.Dataset.objects.filter(
+                compound__in=compounds).values_list(
+                    'compound', 'primary_property__name').order_by(
+                        'primary_property').distinct():
+            primary_properties[compound_pk].append(name)
+        authors = {compound.pk: '' for compound in compounds}
+        references = models.Reference.objects.filter(
+            subsets__dataset__compound__in=compounds).annotate(
+                compound_pk=F('subsets__dataset__compound')).distinct(
+                ).prefetch_related('authors').order_by('pk')
+        for reference in references:
+            authors[reference.compound_pk] += (
+                reference.getAuthorsAsString())
+        return [[compound, primary_properties[compound.pk],
+                 authors[compound.pk]] for compound in compounds]
+
+
+def compound_version(request, pk):
+    return caching.get_compound_version(pk)
+
+
+@method_decorator(caching.cache_response(models.Property,
+                                         depends_on=compound_version),
+                  name='get')
 class CompoundView(generic.ListView):
     template_name = 'materials/compound.html'
     context_object_name = 'dataset_list'
 
     def get_queryset(self, **kwargs):
-        conditions = models.Dataset.objects.filter(
-            compound__pk=self.kwargs['pk']).values(
-            'primary_property').annotate(
-            last_updated=Max('updated'))
-        dataset_list = []
-        for c in conditions:
-            dataset = models.Dataset.objects.filter(
-                compound__pk=self.kwargs['pk'],
-                primary_property__pk=c['primary_property'],
-                updated=c['last_updated'])[0]
-            dataset_list.append(dataset)
-        return dataset_list
+        """Return the latest version of each property of the compound."""
+        datasets = models.Dataset.objects.filter(
+            compound__pk=self.kwargs['pk']).select_related(
+                'compound', 'primary_property').order_by(
+                    'primary_property', '-updated')
+        latest = {}
+        for dataset in datasets:
+            latest.setdefault(dataset.primary_property_id, dataset)
+        return list(latest.values())
 
 
 def dataset_versions(request, compound_pk=None, property_pk=None):
@@ -190,7 +234,8 @@ def dataset_versions(request, compound_pk=None, property_pk=None):
 
 
 def dataset_details(request, pk=None):
-    obj = get_object_or_404(models.Dataset, pk=pk)
+    obj = get_object_or_404(models.Dataset.objects.select_related(
+        'primary_property', 'space_group'), pk=pk)
     response = {
         'general': {},
         'synthesis': {},
@@ -205,124 +250,415 @@ def dataset_details(request, pk=None):
     response['general']['Space group'] = obj.space_group.name
 
     # synthesis method
-    if obj.synthesis.exists():
+    synthesis_method = obj.synthesis.select_related('comment').first()
+    if synthesis_method:
         synthesis = response['synthesis']
-        synthesis['Starting materials'] = obj.synthesis.first().starting_materials
-        synthesis['Product'] = obj.synthesis.first().product
-        synthesis['Description'] = obj.synthesis.first().description
-        synthesis['Comment'] = obj.synthesis.first().comment.text if hasattr(obj.synthesis.first(), 'comment') else ''
+        synthesis['Starting materials'] = synthesis_method.starting_materials
+        synthesis['Product'] = synthesis_method.product
+        synthesis['Description'] = synthesis_method.description
+        synthesis['Comment'] = synthesis_method.comment.text if hasattr(synthesis_method, 'comment') else ''
 
     # experimental details
-    if obj.experimental.exists():
+    experimental_details = obj.experimental.select_related('comment').first()
+    if experimental_details:
         experimental = response['experimental']
-        experimental['Method'] = obj.experimental.first().method
-        experimental['Description'] = obj.experimental.first().description
-        experimental['Comment'] = obj.experimental.first().comment.text if hasattr(obj.experimental.first(), 'comment') else ''
+        experimental['Method'] = experimental_details.method
+        experimental['Description'] = experimental_details.description
+        experimental['Comment'] = experimental_details.comment.text if hasattr(experimental_details, 'comment') else ''
 
     # computational details
-    if obj.computational.exists():
+    computational_details = obj.computational.select_related(
+        'comment').prefetch_related('repositories').first()
+    if computational_details:
         computational = response['computational']
-        computational['Code'] = obj.computational.first().code
-        computational['Level of theory'] = obj.computational.first().level_of_theory
-        computational['Exchange-correlation functional'] = obj.computational.first().xc_functional
-        computational['K-point grid'] = obj.computational.first().k_point_grid
-        computational['Level of relativity'] = obj.computational.first().level_of_relativity
-        computational['Basis set definition'] = obj.computational.first().basis_set_definition
-        computational['Numerical accuracy'] = obj.computational.first().numerical_accuracy
-        if obj.computational.first().repositories.exists():
-            computational['External repositories'] = [x.url for x in obj.computational.first().repositories.all()]
-        computational['Comment'] = obj.computational.first().comment.text if hasattr(obj.computational.first(), 'comment') else ''
-
-    # subset data
-    if obj.subsets.exists():
-        data = response['data']
-        for s in obj.subsets.all():
-            subset = {
-                'pk': s.pk,
-                'primary property': s.dataset.primary_property.name,
-                'title': s.title,
-                'reference': model_to_dict(s.reference) if s.reference else {},
-                'authors': list(s.reference.authors.values()) if s.reference and s.reference.authors else [],
-                'additional files': [],
-            }
-            for x in s.get_additional_files_path():
-                ext = os.path.splitext(x)
-                subset['additional files'].append({
-                    'path': x,
-                    'name': x.split('/')[-1],
-                    'extension': ext,
-                })
-            if s.dataset.primary_property.name == 'atomic structure':
-                subset['lattice constants'] = []
-                subset['atomic coordinates'] = []
-                if s.lattice_constants.first():
-                    for x in s.get_lattice_constants():
-                        subset['lattice constants'].append({
-                            'symbol': x[0],
-                            'value': x[1],
-                            'unit': x[2],
-                        })
-                if s.atomic_coordinates.first():
-                    subset['atomic coordinates'] = s.get_atomic_coordinates()
-            elif s.dataset.primary_property.name == 'tolerance factor related parameters':
-                subset['bond lengths'] = []
-                if s.bond_length.first():
-                    subset['bond lengths'] = s.get_bond_lengths()
-                subset['tolerance factors'] = []
-                if s.tolerance_factors.first():
-                    subset['tolerance factors'] = s.get_tolerance_factors()
-            else:
-                if s.fixed_values.first():
-                    subset['fixed properties'] = s.get_fixed_properties()  
-            data.append(subset)         
+        computational['Code'] = computational_details.code
+        computational['Level of theory'] = computational_details.level_of_theory
+        computational['Exchange-correlation functional'] = computational_details.xc_functional
+        computational['K-point grid'] = computational_details.k_point_grid
+        computational['Level of relativity'] = computational_details.level_of_relativity
+        computational['Basis set definition'] = computational_details.basis_set_definition
+        computational['Numerical accuracy'] = computational_details.numerical_accuracy
+        repositories = computational_details.repositories.all()
+        if repositories:
+            computational['External repositories'] = [x.url for x in repositories]
+        computational['Comment'] = computational_details.comment.text if hasattr(computational_details, 'comment') else ''
+
+    # subset data. Only the contents needed for the primary property
+    # are fetched, each with one query for all subsets.
+    prefetch = ['reference__authors', 'additional_files']
+    if obj.primary_property.name == 'atomic structure':
+        prefetch += ['lattice_constants', 'atomic_coordinates']
+    elif obj.primary_property.name == 'tolerance factor related parameters':
+        prefetch += ['bond_length', 'tolerance_factors__space_group']
+    else:
+        prefetch += ['fixed_values__fixed_property', 'fixed_values__unit']
+    data = response['data']
+    for s in obj.subsets.select_related('reference').prefetch_related(
+            *prefetch):
+        subset = {
+            'pk': s.pk,
+            'primary property': obj.primary_property.name,
+            'title': s.title,
+            'reference': model_to_dict(s.reference) if s.reference else {},
+            'authors': [{'id': x.pk, 'first_name': x.first_name,
+                         'last_name': x.last_name,
+                         'institution': x.institution}
+                        for x in s.reference.authors.all()] if s.reference else [],
+            'additional files': [],
+        }
+        for x in s.get_additional_files_path():
+            ext = os.path.splitext(x)
+            subset['additional files'].append({
+                'path': x,
+                'name': x.split('/')[-1],
+                'extension': ext,
+            })
+        if obj.primary_property.name == 'atomic structure':
+            subset['lattice constants'] = []
+            subset['atomic coordinates'] = []
+            if s.lattice_constants.all():
+                for x in s.get_lattice_constants():
+                    subset['lattice constants'].append({
+                        'symbol': x[0],
+                        'value': x[1],
+                        'unit': x[2],
+                    })
+            if s.atomic_coordinates.all():
+                subset['atomic coordinates'] = s.get_atomic_coordinates()
+        elif obj.primary_property.name == 'tolerance factor related parameters':
+            subset['bond lengths'] = s.get_bond_lengths()
+            subset['tolerance factors'] = s.get_tolerance_factors()
+        else:
+            if s.fixed_values.all():
+                subset['fixed properties'] = s.get_fixed_properties()
+        data.append(subset)
 
     return JsonResponse(response)
 
 
+def export_data(request, file_format, dataset_pk=None, compound_pk=None):
+    """Stream a data set, a compound, or the whole database.
+
+    file_format is "csv", "ndjson", or "zip". CSV covers a single
+    table, which is chosen with the "table" query parameter (default:
+    datapoints).
+
+    """
+    datasets = models.Dataset.objects.all()
+    if dataset_pk:
+        datasets = datasets.filter(pk=get_object_or_404(
+            models.Dataset, pk=dataset_pk).pk)
+        file_name = f'dataset_{dataset_pk}'
+    elif compound_pk:
+        datasets = datasets.filter(compound=get_object_or_404(
+            models.Compound, pk=compound_pk))
+        file_name = f'compound_{compound_pk}'
+    else:
+        file_name = 'all'
+    if file_format == 'csv':
+        table_name = request.GET.get('table', 'datapoints')
+        if table_name not in export.TABLE_NAMES:
+            raise Http404
+        response = StreamingHttpResponse(
+            export.stream_csv(datasets, table_name), content_type='text/csv')
+        file_name += f'_{table_name}'
+    elif file_format == 'ndjson':
+        response = StreamingHttpResponse(
+            export.stream_ndjson(datasets),
+            content_type='application/x-ndjson')
+    elif file_format == 'zip':
+        response = StreamingHttpResponse(
+            export.stream_zip(datasets), content_type='application/zip')
+    else:
+        raise Http404
+    response['Content-Disposition'] = (
+        f'attachment; filename="matd3_{file_name}.{file_format}"')
+    return response
+
+
+def export_structures(request, file_format):
+    """Stream atomic structures as extended XYZ or a zip of CIF files.
+
+    The structures are selected with the query parameters "compound",
+    "property" (primary property), "formula" (part of the formula of
+    the compound), and "subsets" (comma-separated IDs, e.g., from a
+    similarity search). Without parameters, all structures are
+    exported.
+
+    """
+    if file_format not in export.STRUCTURE_FORMATS:
+        raise Http404
+    try:
+        subsets = request.GET.get('subsets')
+        selection = export.select_subsets(
+            compound=int(request.GET['compound'])
+            if 'compound' in request.GET else None,
+            primary_property=int(request.GET['property'])
+            if 'property' in request.GET else None,
+            formula=request.GET.get('formula'),
+            subsets=[int(pk) for pk in subsets.split(',')]
+            if subsets else None)
+    except ValueError:
+        return JsonResponse({'error': 'IDs must be integers.'}, status=400)
+    response = StreamingHttpResponse(
+        export.stream_structures(selection, file_format),
+        content_type=('application/zip' if file_format == 'zip' else
+                      'chemical/x-xyz'))
+    response['Content-Disposition'] = (
+        f'attachment; filename="matd3_structures.{file_format}"')
+    return response
+
+
+def change_feed(request):
+    """Return the changes following the given cursor.
+
+    See changes.py. The query parameters are "cursor" (omit to start
+    from the beginning) and "limit", the maximum number of changes.
+
+    """
+    try:
+        limit = min(int(request.GET.get('limit', 100)),
+                    settings.CHANGE_FEED_MAX_LIMIT)
+        page = changes.get_changes(request.GET.get('cursor'), max(limit, 1))
+    except ValueError as error:
+        return JsonResponse({'error': str(error)}, status=400)
+    return JsonResponse(page)
+
+
+def viewer_response(request, response):
+    """Let the browser cache a 3D viewer response.
+
+    The ETag is the hash of the content, so a cached copy is revalidated
+    without sending the content again once VIEWER_MAX_AGE has passed.
+    """
+    etag = quote_etag(hashlib.md5(response.content).hexdigest())
+    response = get_conditional_response(request, etag=etag) or response
+    response['ETag'] = etag
+    patch_cache_control(response, public=True,
+                        max_age=settings.VIEWER_MAX_AGE)
+    return response
+
+
 def get_jsmol_input(request, pk):
-    """Return a statement to be executed by JSmol."""
-    subset = models.Subset.objects.get(pk=pk)
-    if not subset:
-        return HttpResponse()
-    if subset.input_data_file:
-        subsets = subset.dataset.subsets.all()
-        subsets_with_file = []
-        for s in subsets:
-            if s.input_data_file:
-                subsets_with_file.append(s)
-        if subset.input_data_file.path == subsets_with_file[0].input_data_file.path:
-            filename = os.path.basename(
-                subset.input_data_file.path)
-            return HttpResponse(
-                f'load /media/data_files/dataset_{subset.dataset.pk}/{filename} '
-                '{1 1 1}')
+    """Return a statement to be executed by JSmol.
+
+    The structure is loaded from the file stored with the descriptors
+    of the subset (see descriptors.py). If there are no stored atomic
+    coordinates, the uploaded file of the first subset of the data set
+    is loaded instead.
+    """
+    data = models.StructureDescriptor.objects.filter(subset=pk).exclude(
+        viewer_data='').values_list('viewer_data', flat=True).first()
+    if data:
+        return viewer_response(
+            request, HttpResponse(structures.jsmol_script(data),
+                                  content_type='text/plain'))
+    subset = models.Subset.objects.filter(dataset__subsets=pk).exclude(
+        input_data_file='').exclude(input_data_file=None).first()
+    if subset and subset.pk == pk:
+        filename = os.path.basename(subset.input_data_file.name)
+        return HttpResponse(
+            f'load /media/data_files/dataset_{subset.dataset_id}/{filename} '
+            '{1 1 1}')
     return HttpResponse()
 
 
+def compound_structures(request, pk):
+    """Return the 3D viewer files of all structures of a compound.
+
+    Each structure is in the format given by "format" ("cif" or "xyz").
+    structures.jsmol_script turns the data into a JSmol script.
+    """
+    rows = models.StructureDescriptor.objects.filter(
+        subset__dataset__compound=pk).exclude(viewer_data='').order_by(
+            'subset').values_list('subset', 'subset__dataset',
+                                  'subset__title', 'viewer_data')
+    return viewer_response(request, JsonResponse({'structures': [{
+        'subset': subset,
+        'dataset': dataset,
+        'title': title,
+        'format': 'cif' if data.startswith('data_') else 'xyz',
+        'data': data,
+    } for subset, dataset, title, data in rows]}))
+
+
+def bond_lengths(request, pk):
+    """Propose bond lengths from the atomic structure of a subset.
+
+    The query parameters "I", "II", "IV", and "X" are the elements of
+    the tolerance factor form. The proposals are keyed by the names of
+    the bond length fields of the form (see neighbors.py).
+
+    """
+    subset = get_object_or_404(models.Subset, pk=pk)
+    elements = {label: request.GET.get(label, '')
+                for label in ('I', 'II', 'IV', 'X')}
+
+    def compute():
+        structure = structures.load(subset)
+        if structure is None:
+            return None
+        return neighbors.propose_bond_lengths(structure, elements)
+    proposals = caching.get_or_set(
+        'bond_lengths', (models.AtomicCoordinate, models.LatticeConstant),
+        (pk, *elements.values()), compute)
+    if proposals is None:
+        raise Http404
+    return JsonResponse({'subset': subset.pk, 'elements': elements,
+                         'bond_lengths': proposals})
+
+
+def similar_structures(request):
+    """Return the subsets whose unit cells are most similar to a query.
+
+    The query cell is given by the parameters "a", "b", "c", "alpha",
+    "beta", and "gamma", or by "subset", the ID of a subset with
+    lattice constants (which is then excluded from the results).
+    "formula" optionally adds the composition to the comparison, and
+    "k" is the number of results (see similarity.py).
+
+    """
+    try:
+        k = min(int(request.GET.get('k', 10)),
+                settings.SIMILARITY_MAX_RESULTS)
+        exclude = []
+        if 'subset' in request.GET:
+            lattice_constant = models.LatticeConstant.objects.filter(
+                subset=request.GET['subset']).first()
+            if lattice_constant is None:
+                raise Http404
+            cell = [getattr(lattice_constant, field)
+                    for field in similarity.CELL_FIELDS]
+            exclude.append(lattice_constant.subset_id)
+        else:
+            cell = [float(request.GET[field])
+                    for field in similarity.CELL_FIELDS]
+    except (KeyError, ValueError):
+        return JsonResponse(
+            {'error': 'Give either all lattice constants or a subset.'},
+            status=400)
+    return JsonResponse({'results': similarity.search(
+        cell, max(k, 1), request.GET.get('formula'), exclude)})
+
+
+def tolerance_factor_neighbors(request):
+    """Return the compounds with the nearest tolerance factors.
+
+    The query point is given by "t_I" and "t_IV_V", or by "compound",
+    whose tolerance factor of the data source is used (the compound is
+    then excluded from the results). "data_source" defaults to the
+    Shannon radii, "space_group" optionally restricts the results to a
+    space group (ID), and "k" is the number of results (see
+    tolerance_search.py).
+
+    """
+    try:
+        k = min(int(request.GET.get('k', 10)),
+                settings.SIMILARITY_MAX_RESULTS)
+        data_source = int(request.GET.get(
+            'data_source', models.ToleranceFactor.SHANNON))
+        space_group = request.GET.get('space_group')
+        space_group = int(space_group) if space_group else None
+        exclude = []
+        if 'compound' in request.GET:
+            tolerance_factor = models.ToleranceFactor.objects.filter(
+                compound=request.GET['compound'], data_source=data_source,
+                t_I__isnull=False, t_IV_V__isnull=False).first()
+            if tolerance_factor is None:
+                raise Http404
+            point = [tolerance_factor.t_I, tolerance_factor.t_IV_V]
+            exclude.append(tolerance_factor.compound_id)
+        else:
+            point = [float(request.GET[key]) for key in ('t_I', 't_IV_V')]
+    except (KeyError, ValueError):
+        return JsonResponse(
+            {'error': 'Give either t_I and t_IV_V or a compound.'},
+            status=400)
+    return JsonResponse({'results': tolerance_search.search(
+        data_source, point, max(k, 1), space_group, exclude)})
+
+
 def data_for_chart(request, pk):
+    """Return the curves of a subset.
+
+    The optional query parameters "x_unit" and "y_unit" convert the
+    values of all curves into the given units (see units.py).
+
+    """
     subset = models.Subset.objects.get(pk=pk)
-    if subset.curves.first():
-        obj = subset.curves.first()
-        response = {'x title': obj.x_title,
-                    'x unit': obj.x_unit,
-                    'y title': obj.y_title,
-                    'y unit': obj.y_unit,
-                    'data': []}
-    for curve in subset.curves.all():
-        if curve.datapoints.exists():
-            data = {
-                'legend': curve.legend,
-                'values': []
-            }
-            for value in curve.datapoints.all():
-                data['values'].append({
-                    'x': value.x_value,
-                    'y': value.y_value,
-                })
-            response['data'].append(data)
+    curves = list(subset.curves.order_by('pk'))
+    response = {'data': []}
+    if curves:
+        response.update({'x title': curves[0].x_title,
+                         'x unit': curves[0].x_unit,
+                         'y title': curves[0].y_title,
+                         'y unit': curves[0].y_unit})
+    rows = numpy.array(models.Datapoint.objects.filter(
+        chart__subset=subset).order_by('chart', 'point_counter').values_list(
+            'chart', 'x_value', 'y_value'), dtype=float).reshape(-1, 3)
+    chart_pks = rows[:, 0].astype(int)
+    columns = {'x': rows[:, 1], 'y': rows[:, 2]}
+    curve_pks = [curve.pk for curve in curves]
+    # Index of the curve of each data point
+    curve_indices = numpy.searchsorted(curve_pks, chart_pks)
+    try:
+        for axis in columns:
+            unit = request.GET.get(f'{axis}_unit')
+            if unit is None:
+                continue
+            curve_units = numpy.array(
+                [getattr(curve, f'{axis}_unit') for curve in curves] or [''])
+            columns[axis] = units.convert_column(
+                columns[axis], curve_units[curve_indices], unit)
+            response[f'{axis} unit'] = unit
+    except units.UnitError as error:
+        return JsonResponse({'error': str(error)}, status=400)
+    starts = numpy.searchsorted(chart_pks, curve_pks)
+    ends = numpy.searchsorted(chart_pks, curve_pks, side='right')
+    for curve, start, end in zip(curves, starts, ends):
+        if start == end:
+            continue
+        response['data'].append({
+            'legend': curve.legend,
+            'values': [{'x': x, 'y': y} for x, y in zip(
+                columns['x'][start:end].tolist(),
+                columns['y'][start:end].tolist())],
+        })
     return JsonResponse(response)
 
 
+def compare_curves(request):
+    """Return curves of several subsets on a common grid of x values.
+
+    The curves are selected with "charts" and/or "subsets" (comma-
+    separated IDs). "x_unit" and "y_unit" set common units, "n_points",
+    "x_min", and "x_max" the grid, and "reference" the curve that the
+    others are compared with (see comparison.py).
+
+    """
+    def ids(name):
+        value = request.GET.get(name)
+        return [int(pk) for pk in value.split(',')] if value else []
+
+    def number(name, cast=float):
+        value = request.GET.get(name)
+        return cast(value) if value else None
+    try:
+        n_points = number('n_points', int) or comparison.DEFAULT_POINTS
+        if not 2 <= n_points <= comparison.MAX_POINTS:
+            raise ValueError('n_points must be between 2 and '
+                             f'{comparison.MAX_POINTS}.')
+        result = comparison.get_comparison(
+            ids('charts'), ids('subsets'),
+            x_unit=request.GET.get('x_unit'),
+            y_unit=request.GET.get('y_unit'),
+            n_points=n_points, x_min=number('x_min'), x_max=number('x_max'),
+            reference=number('reference', int))
+    except ValueError as error:
+        return JsonResponse({'error': str(error)}, status=400)
+    return JsonResponse(result)
+
+
 class AddDataView(StaffStatusMixin, generic.TemplateView):
     """View for adding new data."""
     template_name = 'materials/add_data.html'
@@ -435,14 +771,10 @@ class UpdateDatasetView(StaffStatusMixin, generic.TemplateView):
                     for field in filter(lambda field: type(field) is FloatField,
                                     models.LatticeConstant._meta.get_fields()):
                         d[f'lattice_constant_{field.name}_1_{i+1}'] = getattr(lattice, field.name)
-                coords = subset.atomic_coordinates.all()
-                if coords:
-                    lines = ""
-                    for coord in coords:
-                        line = coord.label + ' ' + str(coord.coord_1) + ' ' + str(coord.coord_2) \
-                             + ' ' + str(coord.coord_3) + ' ' + coord.element + '\n'
-                        lines += line
-                    d[f'atomic_coordinates_1_{i+1}'] = lines
+                structure = structures.load(subset)
+                if structure:
+                    d[f'atomic_coordinates_1_{i+1}'] = structures.to_aims(
+                        structure)
             elif dataset.primary_property.name == 'tolerance factor related parameters':
                 for shannon in subset.shannon_ionic_radiis.all():
                     element_label = models \
@@ -471,10 +803,10 @@ class UpdateDatasetView(StaffStatusMixin, generic.TemplateView):
                     d[f'number_of_curves_1_{i+1}'] = len(subset.curves.all())
                 for curve in subset.curves.all():
                     d[f'legend_1_{i+1}_{curve.curve_counter}'] = curve.legend
-                    y_list = list(curve.datapoints.all().values_list('y_value', flat=True))
+                    y_list = list(curve.datapoints.order_by('point_counter').values_list('y_value', flat=True))
                     y_values = ['%.5g' % y for y in y_list]
                     if curve.curve_counter == 1:
-                        x_list = list(curve.datapoints.all().values_list('x_value', flat=True))
+                        x_list = list(curve.datapoints.order_by('point_counter').values_list('x_value', flat=True))
                         x_values = ['%.5g' % x for x in x_list]
                         datapoints = [" ".join(t) for t in zip(x_values, y_values)]
                     else:
@@ -598,10 +930,52 @@ class SpaceGroupViewSet(viewsets.ModelViewSet):
         serializer.save(created_by=self.request.user)
 
 
+class StructureDescriptorViewSet(viewsets.ReadOnlyModelViewSet):
+    """Descriptors of atomic structures (see descriptors.py).
+
+    Filter with the query parameters <field>_min and <field>_max for
+    volume, density, and n_atoms, and with reduced_formula. Sort with
+    "ordering", e.g., "-volume".
+    """
+    queryset = models.StructureDescriptor.objects.all()
+    serializer_class = serializers.StructureDescriptorSerializer
+    permission_classes = (permissions.IsStaffOrReadOnly,)
+    RANGE_FIELDS = ('volume', 'density', 'n_atoms')
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        params = self.request.query_params
+        filters = {}
+        for field in self.RANGE_FIELDS:
+            for suffix, lookup in (('min', 'gte'), ('max', 'lte')):
+                if params.get(f'{field}_{suffix}'):
+                    try:
+                        filters[f'{field}__{lookup}'] = float(
+                            params[f'{field}_{suffix}'])
+                    except ValueError:
+                        raise ValidationError(
+                            {f'{field}_{suffix}': 'Not a number.'})
+        if params.get('reduced_formula'):
+            filters['reduced_formula'] = params['reduced_formula']
+        ordering = params.get('ordering', 'subset')
+        if ordering.lstrip('-') not in self.RANGE_FIELDS + ('subset',):
+            ordering = 'subset'
+        return queryset.filter(**filters).order_by(ordering)
+
+
 @staff_status_required
 @transaction.atomic
 def submit_data(request):
-    """Primary function for submitting data from the user."""
+    """Primary function for submitting data from the user.
+
+    If ASYNC_INGESTION is set or the form contains the field
+    "asynchronous", the validated data is only queued as an ingestion
+    job and the job ID is returned at once (or, unless the form was
+    submitted with XMLHttpRequest, the user is sent to the status page
+    of the job). The job is then processed by the
+    process_ingestion_jobs management command.
+
+    """
 
     def error_and_return(form, dataset=None, text=None):
         """Shortcut for returning with info about the error."""
@@ -621,35 +995,7 @@ def submit_data(request):
             'base_template': base_template
         })
 
-
-    def skip_this_line(line):
-        """Test whether the line is empty or a comment."""
-        return re.match(r'\s*#', line) or not line or line == '\r'
-
-
-    def create_input_file(subset, import_file_name, data_as_str, i_dataset, i_subset):
-        """Read data points from the input form and save as file.
-
-        If the name of the original file from which the data was
-        imported is on the form, use that name for creating the
-        file. If not and if multiple_subsets, then the files are named
-        data1.txt, data2.txt, etc. Otherwise, a single file called
-        data.txt is created and i_subset is ignored.
-
-        """
-        if data_as_str:
-            if import_file_name:
-                file_name = import_file_name
-            # elif multiple_subsets:
-            #     file_name = f'data{i_subset}.txt'
-            else:
-                file_name = f'data_{i_dataset}_{i_subset}.txt'
-            f = SimpleUploadedFile(file_name, data_as_str.encode())
-            subset.input_data_file = f
-    
-
-    # Submit data to database
-    form = forms.AddDataForm(request.POST)
+    form = forms.AddDataForm(request.POST, request.FILES)
     if not form.is_valid():
         # Show formatted field labels in the error message, not the
         # dictionary keys
@@ -660,375 +1006,25 @@ def submit_data(request):
         messages.error(request, form.errors)
         form._errors = errors_save
         return error_and_return(form)
+    if settings.ASYNC_INGESTION or request.POST.get('asynchronous'):
+        job = ingestion.queue_job(request)
+        if not request.is_ajax():
+            messages.success(request, 'The data was queued for submission.')
+            return redirect(reverse('materials:ingestion_job_page',
+                                    kwargs={'pk': job.pk}))
+        return JsonResponse({
+            'job': job.pk,
+            'state': job.get_state_display(),
+            'status_url': reverse('materials:ingestion_job',
+                                  kwargs={'pk': job.pk}),
+        }, status=202)
+
+    # Submit data to database
+    try:
+        dataset = ingestion.save_data(form, request.FILES, request.user)[-1]
+    except ingestion.IngestionError as error:
+        return error_and_return(form, error.dataset, str(error))
 
-    # Create compound
-    compound_list = [x[0] for x in models.Compound.objects.all().values_list('formula')]
-    cur_compound = form.cleaned_data['formula']
-    if cur_compound in compound_list:
-        compound = models.Compound.objects.filter(formula=cur_compound)[0]
-    else:
-        compound = models.Compound.objects.create(
-            created_by=request.user,
-            formula=form.cleaned_data['formula'])
-    # Create dataset
-    for i_dataset in range(1, int(form.cleaned_data['number_of_datasets']) + 1):
-        dataset = models.Dataset(created_by=request.user, compound=compound)
-        dataset.primary_property = form.cleaned_data[f'primary_property_{i_dataset}']
-        dataset.is_experimental = (
-            form.cleaned_data[f'origin_of_data_{i_dataset}'] == 'is_experimental')
-        dataset.sample_type = form.cleaned_data[f'sample_type_{i_dataset}']
-        dataset.crystal_system = form.cleaned_data[f'crystal_system_{i_dataset}']
-        dataset.space_group = form.cleaned_data[f'space_group_{i_dataset}']
-        if f'update_comments_{i_dataset}' in form.cleaned_data:
-            dataset.update_comments = form.cleaned_data[f'update_comments_{i_dataset}']
-        dataset.save()
-        logger.info(f'Create dataset #{dataset.pk}')
-        if form.cleaned_data[f'with_synthesis_details_{i_dataset}']:
-            synthesis = models.SynthesisMethod(created_by=request.user,
-                                               dataset=dataset)
-            synthesis.starting_materials = form.cleaned_data[f'starting_materials_{i_dataset}']
-            synthesis.product = form.cleaned_data[f'product_{i_dataset}']
-            synthesis.description = form.cleaned_data[f'synthesis_description_{i_dataset}']
-            synthesis.save()
-            logger.info(f'Creating synthesis details #{synthesis.pk}')
-            if form.cleaned_data[f'synthesis_comment_{i_dataset}']:
-                models.Comment.objects.create(
-                    synthesis_method=synthesis,
-                    created_by=request.user,
-                    text=form.cleaned_data[f'synthesis_comment_{i_dataset}'])
-        # Experimental details
-        if form.cleaned_data[f'with_experimental_details_{i_dataset}']:
-            experimental = models.ExperimentalDetails(created_by=request.user,
-                                                      dataset=dataset)
-            experimental.method = form.cleaned_data[f'experimental_method_{i_dataset}']
-            experimental.description = form.cleaned_data[
-                f'experimental_description_{i_dataset}']
-            experimental.save()
-            logger.info(f'Creating experimental details #{experimental.pk}')
-            if form.cleaned_data[f'experimental_comment_{i_dataset}']:
-                models.Comment.objects.create(
-                    experimental_details=experimental,
-                    created_by=request.user,
-                    text=form.cleaned_data[f'experimental_comment_{i_dataset}'])
-        # Computational details
-        if form.cleaned_data[f'with_computational_details_{i_dataset}']:
-            computational = models.ComputationalDetails(created_by=request.user,
-                                                        dataset=dataset)
-            computational.code = form.cleaned_data[f'code_{i_dataset}']
-            computational.level_of_theory = form.cleaned_data[f'level_of_theory_{i_dataset}']
-            computational.xc_functional = form.cleaned_data[f'xc_functional_{i_dataset}']
-            computational.k_point_grid = form.cleaned_data[f'k_point_grid_{i_dataset}']
-            computational.level_of_relativity = form.cleaned_data[
-                f'level_of_relativity_{i_dataset}']
-            computational.basis_set_definition = form.cleaned_data[
-                f'basis_set_definition_{i_dataset}']
-            computational.numerical_accuracy = form.cleaned_data[
-                f'numerical_accuracy_{i_dataset}']
-            computational.save()
-            logger.info(f'Creating computational details #{computational.pk}')
-            if form.cleaned_data[f'computational_comment_{i_dataset}']:
-                models.Comment.objects.create(
-                    computational_details=computational,
-                    created_by=request.user,
-                    text=form.cleaned_data[f'computational_comment_{i_dataset}'])
-            if form.cleaned_data[f'external_repositories_{i_dataset}']:
-                for url in form.cleaned_data[f'external_repositories_{i_dataset}'].split():
-                    if not requests.head(url).ok:
-                        return error_and_return(form, dataset,
-                                                'Could not process url for the '
-                                                f'external repository: "{url}"')
-                    models.ExternalRepository.objects.create(
-                        computational_details=computational,
-                        created_by=request.user,
-                        url=url)
-        # For best performance, the main data should be inserted with
-        # calls to bulk_create. The following work arrays are are
-        # populated with data during the loop over subsets and then
-        # inserted into the database after the main loop.
-        datapoints = []
-        lattice_constants = []
-        atomic_coordinates = []
-        # multiple_subsets = int(form.cleaned_data['number_of_subsets' + '_' + i_dataset]) > 1
-        for i_subset in range(1, int(form.cleaned_data[f'number_of_subsets_{i_dataset}']) + 1):
-            suffix = str(i_dataset) + '_' + str(i_subset)
-            # Create data subset
-            subset = models.Subset(created_by=request.user, dataset=dataset)
-            subset.title = form.cleaned_data[f'sub_title_{suffix}']
-            subset.reference = form.cleaned_data[f'select_reference_{suffix}']
-            # Atomic structure data
-            if dataset.primary_property.name == 'atomic structure':
-                create_input_file(
-                    subset,
-                    form.cleaned_data[f'import_file_name_atomic_{suffix}'],
-                    form.cleaned_data[f'atomic_coordinates_{suffix}'],
-                    i_dataset,
-                    i_subset
-                )
-                subset.save()
-                # Store lattice constants into database
-                lattice_constant = models.LatticeConstant(
-                    created_by=request.user,
-                    subset=subset)
-                for key in ['a', 'b', 'c', 'alpha', 'beta', 'gamma']:
-                    try:
-                        value = float(form.cleaned_data[f'lattice_constant_{key}_{suffix}'])
-                        setattr(lattice_constant, key, value)
-                    except ValueError:
-                        return error_and_return(form, dataset, f'Could not process lattice constant {key}.')
-                lattice_constants.append(lattice_constant)
-                # Store atomic coordinates into database
-                lattice_vectors = []
-                for line in form.cleaned_data[
-                        f'atomic_coordinates_{suffix}'].split('\n'):
-                    if form.cleaned_data[f'geometry_format_{suffix}'] != 'aims':
-                        break
-                    try:
-                        m = re.match(r'\s*lattice_vector' +
-                                     3*r'\s+(-?\d+(?:\.\d+)?)' + r'\b', line)
-                        if m:
-                            atomic_coordinate = models.AtomicCoordinate(
-                                    created_by=request.user,
-                                    subset=subset,
-                                    label='lattice_vector'
-                                    )
-                            coords = m.groups()
-                            for i, coord in enumerate(coords):
-                                setattr(atomic_coordinate, f'coord_{i+1}', coord)
-                        else:
-                            m = re.match(
-                                r'\s*(atom|atom_frac)\s+' +
-                                3*r'(-?\d+(?:\.\d+)?(?:\(\d+\))?)\s+' +
-                                r'(\w+)\b', line)
-                            atomic_coordinate = models.AtomicCoordinate(
-                                    created_by=request.user,
-                                    subset=subset
-                                    )
-                            coord_type, *coords, element = m.groups()
-                            atomic_coordinate.label = coord_type
-                            atomic_coordinate.element = element
-                            for i, coord in enumerate(coords):
-                                setattr(atomic_coordinate, f'coord_{i+1}', coord)
-                        atomic_coordinates.append(atomic_coordinate)
-                    except AttributeError:
-                        # Skip comments and empty lines
-                        if not re.match(r'(?:\r?$|#|//)', line):
-                            return error_and_return(
-                                form, dataset, f'Could not process line: {line}')
-            # Tolerance factor related parameters
-            elif dataset.primary_property.name == 'tolerance factor related parameters':
-                subset.save()
-                label_list = ['I', 'II', 'IV', 'X']
-                # Query for Shannon ionic radii
-                r_dict = {}
-                for i in range(4):
-                    label = label_list[i]
-                    shannon_r = models.ShannonIonicRadii(
-                                    created_by=request.user,
-                                    compound=compound,
-                                    subset=subset,
-                                    element_label=i)
-                    shannon_r.element = form.cleaned_data[f'element_{label}_' + suffix]
-                    shannon_r.charge = form.cleaned_data[f'charge_{label}_' + suffix]
-                    shannon_r.coordination = form.cleaned_data[f'coord_{label}_' + suffix]
-                    if f'spin_state_{label}_' + suffix in form.cleaned_data:
-                        shannon_r.spin_state = form.cleaned_data[f'spin_state_{label}_' + suffix]
-                    try:
-                        if shannon_r.element and shannon_r.charge and shannon_r.coordination:
-                            shannon_r.ionic_radius = models.ShannonRadiiTable.objects.filter(
-                                element=shannon_r.element,
-                                charge=shannon_r.charge,
-                                coordination=shannon_r.coordination,
-                                spin_state=shannon_r.spin_state)[0].ionic_radius
-                            r_dict[f'r_{label}'] = shannon_r.ionic_radius
-                        shannon_r.save()
-                    except:
-                        return error_and_return(form, dataset, 
-                            f'Query for Shannon ionic radii of element {label}: {shannon_r.element} failed.')
-                
-                # Create bond length object for each bond
-                for i in range(3):
-                    label = label_list[i]
-                    # If element_a, element_b is not filled, pad it with shannon inputs.
-                    if form.cleaned_data[f'element_{label}_X_a_' + suffix]:
-                        element_a = form.cleaned_data[f'element_{label}_X_a_' + suffix]
-                    else:
-                        element_a = form.cleaned_data[f'element_{label}_' + suffix]
-                    if form.cleaned_data[f'element_{label}_X_b_' + suffix]:
-                        element_b = form.cleaned_data[f'element_{label}_X_b_' + suffix]
-                    else:
-                        element_b = form.cleaned_data[f'element_X_' + suffix]
-                    bond_obj = models.BondLength(
-                        created_by=request.user,
-                        compound=compound,
-                        subset=subset,
-                        r_label=i,
-                        element_a=element_a,
-                        element_b=element_b,
-                        bond_id=element_a + '-' + element_b)
-                    if form.cleaned_data[f'R_{label}_X_{suffix}']:
-                        try:
-                            # Experimental R assignment
-                            bond_obj.experimental_r = float(form.cleaned_data[f'R_{label}_X_{suffix}'])
-                            bond_obj.save()
-                            bond_objs = models.BondLength.objects.filter(
-                                bond_id=bond_obj.bond_id,
-                                experimental_r__isnull=False)
-                            # Averaged R assignment
-                            avg_r = bond_objs.aggregate(Avg('experimental_r'))['experimental_r__avg']
-                            count_r = bond_objs.count()
-                            bond_objs.update(averaged_r=avg_r, counter=count_r)
-                        except:
-                            return error_and_return(form, dataset, f'Can not process experimental_r of {bond_obj.bond_id}.')
-                    elif models.BondLength.objects.filter(
-                                bond_id=bond_obj.bond_id,
-                                experimental_r__isnull=False):
-                        bond_objs = models.BondLength.objects.filter(
-                                bond_id=bond_obj.bond_id,
-                                experimental_r__isnull=False)
-                        bond_obj.averaged_r = bond_objs[0].averaged_r
-                        count_r = bond_objs.count()
-                        count_r += 1
-                        bond_objs.update(counter=count_r)
-                        bond_obj.counter = count_r
-                        bond_obj.save()
-                    else:
-                        bond_obj.save()
-
-                # Shannon R assignment
-                bond_obj_list = models.BondLength.objects.filter(
-                                compound=compound, 
-                                subset=subset).order_by('r_label')
-                if 'r_I' in r_dict and 'r_X' in r_dict:
-                    bond_obj_list.filter(r_label=0).update(shannon_r=r_dict['r_I']+r_dict['r_X'])
-                if 'r_II' in r_dict and 'r_X' in r_dict:
-                    bond_obj_list.filter(r_label=1).update(shannon_r=r_dict['r_II']+r_dict['r_X'])
-                if 'r_IV' in r_dict and 'r_X' in r_dict:
-                    bond_obj_list.filter(r_label=2).update(shannon_r=r_dict['r_IV']+r_dict['r_X'])
-
-
-                # Create tolerance factor objects
-                R_I_X_obj = models.BondLength.objects.filter(compound=compound, subset=subset, r_label=0)[0]
-                R_II_X_obj = models.BondLength.objects.filter(compound=compound, subset=subset, r_label=1)[0]
-                R_IV_X_obj = models.BondLength.objects.filter(compound=compound, subset=subset, r_label=2)[0]
-                fields = ['shannon_r', 'experimental_r', 'averaged_r']
-                for i in range(3):
-                    field = fields[i]
-                    tf_obj = models.ToleranceFactor(
-                        created_by=request.user,
-                        compound=compound,
-                        subset=subset,
-                        data_source=i,
-                        space_group=dataset.space_group)
-                    if getattr(R_I_X_obj, field) and getattr(R_II_X_obj, field):
-                        t_I = math.sqrt((4 + math.sqrt(2)) / 3) * getattr(R_I_X_obj, field) / getattr(R_II_X_obj, field)
-                        setattr(tf_obj, 't_I', t_I)
-                    if getattr(R_IV_X_obj, field) and getattr(R_II_X_obj, field):
-                        t_IV_V = math.sqrt((4 + math.sqrt(2)) / 3) * getattr(R_IV_X_obj, field) / getattr(R_II_X_obj, field)
-                        setattr(tf_obj, 't_IV_V', t_IV_V)
-                    tf_obj.save()              
-
-
-            # Normal properties data
-            else:
-                create_input_file(
-                    subset,
-                    form.cleaned_data[f'import_file_name_{suffix}'],
-                    form.cleaned_data[f'datapoints_{suffix}'],
-                    i_dataset,
-                    i_subset
-                    )
-                subset.save()
-                # Create chart objects
-                charts = []
-                for i_curve in range(1, int(form.cleaned_data[f'number_of_curves_{suffix}'])+1):
-                    charts.append(models.Chart(
-                        created_by=request.user,
-                        subset=subset,
-                        x_title=form.cleaned_data[f'x_title_{suffix}'],
-                        x_unit=form.cleaned_data[f'x_unit_{suffix}'],
-                        y_title=form.cleaned_data[f'y_title_{suffix}'],
-                        y_unit=form.cleaned_data[f'y_unit_{suffix}'],
-                        legend=form.cleaned_data[f'legend_{suffix}_{i_curve}'],
-                        curve_counter=i_curve
-                        )
-                    )
-                models.Chart.objects.bulk_create(charts)
-                charts_q = models.Chart.objects.filter(subset=subset)
-
-                # Create datapoint objects
-                try:
-                    for i_line, line in enumerate(form.cleaned_data[f'datapoints_{suffix}'].splitlines()):
-                        if skip_this_line(line):
-                            continue
-                        for i_col, value in enumerate(line.split()):
-                            if i_col == 0:
-                                x_value = float(value)
-                            else:
-                                datapoints.append(models.Datapoint(
-                                    created_by=request.user,
-                                    chart=charts_q[i_col-1],
-                                    x_value=x_value,
-                                    y_value=float(value),
-                                    point_counter=i_line + 1)
-                                )
-                except ValueError:
-                    return error_and_return(
-                        form, dataset, f'Could not process line: {line}')
-
-                # Fixed properties
-                counter = 1
-                for key in form.cleaned_data:
-                    if key.startswith(f'fixed_property_{i_dataset}_{i_subset}_'):
-                        suffix = key.split('fixed_property_')[1]
-                        value = float(form.cleaned_data['fixed_value_' + suffix])
-                        subset.fixed_values.create(
-                            created_by=request.user,
-                            fixed_property=form.cleaned_data[
-                                'fixed_property_' + suffix],
-                            value=value,
-                            value_type=form.cleaned_data['fixed_sign_' + suffix],
-                            unit=form.cleaned_data['fixed_unit_' + suffix],
-                            counter=counter)
-                        counter += 1
-            
-            # Additional files
-            for f in request.FILES.getlist(f'additional_files_{i_dataset}_{i_subset}'):
-                subset.additional_files.create(
-                    created_by=request.user, 
-                    additional_file=f)
-
-        # Insert the main data into the database
-        models.Datapoint.objects.bulk_create(datapoints)
-        models.LatticeConstant.objects.bulk_create(lattice_constants)
-        models.AtomicCoordinate.objects.bulk_create(atomic_coordinates)
-
-        # # Create static files for Qresp
-        # qresp.create_static_files(request, dataset)
-        # # Import data from Qresp
-        # if form.cleaned_data['qresp_fetch_url']:
-        #     paper_detail = requests.get(
-        #         form.cleaned_data['qresp_fetch_url'], verify=False).json()
-        #     download_url = paper_detail['fileServerPath']
-        #     chart_detail = paper_detail['charts'][
-        #         form.cleaned_data['qresp_chart_nr']]
-        #     chart = requests.get(f'{download_url}/{chart_detail["imageFile"]}',
-        #                          verify=False)
-        #     file_name = chart_detail["imageFile"].replace('/', '_')
-        #     f = SimpleUploadedFile(file_name, chart.content)
-        #     dataset.files.create(created_by=dataset.created_by, dataset_file=f)
-        # If all went well, let the user know how much data was successfully added
-        # n_data_points = 0
-        # for subset in dataset.subsets.all():
-        #     n_data_points += subset.datapoints.count()
-        # if n_data_points > 0:
-        #     message = (f'{n_data_points} new '
-        #                f'data point{"s" if n_data_points != 1 else ""} '
-        #                'successfully added to the database.')
-        # else:
-        #     message = 'New data successfully added to the database.'
-        # dataset_url = reverse('materials:dataset', kwargs={'pk': dataset.pk})
-        # message = mark_safe(message +
-        #                     f' <a href="{dataset_url}">View</a> the data set.')
     if form.cleaned_data['qresp_search_url']:
         message = 'New data successfully added to the database.'
         messages.success(request, message)
@@ -1045,6 +1041,96 @@ def submit_data(request):
         return redirect(reverse('materials:add_data'))
 
 
+@replicas.use_primary
+def ingestion_job(request, pk):
+    """Report the state of an ingestion job.
+
+    The progress lists, for each data set of the submission, its state
+    and the primary keys of the data set and of its subsets once the
+    data set has been committed.
+
+    """
+    job = get_object_or_404(models.IngestionJob, pk=pk)
+    if not can_view_job(request.user, job):
+        return HttpResponseForbidden()
+    return JsonResponse({
+        'job': job.pk,
+        'state': job.get_state_display(),
+        'created': job.created,
+        'started': job.started,
+        'finished': job.finished,
+        'error': job.error,
+        'datasets': job.get_progress(),
+    })
+
+
+@replicas.use_primary
+def ingestion_job_page(request, pk):
+    """Show the state of an ingestion job to the submitter.
+
+    The page polls ingestion_job until the job is finished and then
+    links to the compound of the submitted data.
+
+    """
+    job = get_object_or_404(models.IngestionJob, pk=pk)
+    if not can_view_job(request.user, job):
+        return HttpResponseForbidden()
+    compound = None
+    if job.state == models.IngestionJob.DONE:
+        formula = json.loads(job.form_data)['formula'][0]
+        compound = models.Compound.objects.filter(formula=formula).first()
+    return render(request, 'materials/ingestion_job.html', {
+        'job': job,
+        'compound': compound,
+        'finished': job.state in (models.IngestionJob.DONE,
+                                  models.IngestionJob.FAILED),
+    })
+
+
+def can_view_job(user, job):
+    """Test whether the user submitted the job or is a superuser."""
+    return user.is_staff and (job.created_by == user or user.is_superuser)
+
+
+@require_POST
+@staff_status_required
+@transaction.atomic
+def subset_structure(request, pk):
+    """Replace the atomic structure of a subset.
+
+    The structure is read from the uploaded file "file" or from the
+    field "structure" in any of structures.FORMATS, which is detected
+    unless given as "format". Only the creator of the data set may
+    replace it.
+
+    """
+    subset = get_object_or_404(
+        models.Subset.objects.select_related('dataset'), pk=pk)
+    if not (subset.dataset.created_by == request.user or
+            request.user.is_superuser):
+        return HttpResponseForbidden()
+    file_name = ''
+    try:
+        if 'file' in request.FILES:
+            file_name = request.FILES['file'].name
+            text = request.FILES['file'].read().decode('utf-8')
+        else:
+            text = request.POST.get('structure', '')
+        structure = structures.parse(text, request.POST.get('format'),
+                                     file_name)
+    except UnicodeDecodeError:
+        return JsonResponse(
+            {'error': f'{file_name} is not a UTF-8 text file.'}, status=400)
+    except structures.StructureError as error:
+        return JsonResponse({'error': str(error)}, status=400)
+    structures.save(subset, request.user, structure)
+    return JsonResponse({
+        'subset': subset.pk,
+        'atoms': len(structure),
+        'lattice_constants': structure.lattice_constants(),
+    })
+
+
 def resolve_return_url(pk, view_name):
     """Determine URL from the view name and other arguments.
 
@@ -1093,29 +1179,38 @@ def autofill_input_data(request):
 
 
 def data_for_tf(request, data_source, compound_pk):
-    response = {'data-source': data_source,
-                'data': []}
-    for space_group in models.SpaceGroup.objects.all():
-        if compound_pk:
-            datapoints = models.ToleranceFactor.objects.filter(
-                data_source=data_source,
-                space_group=space_group,
-                compound__pk=compound_pk)
-        else:  
-            datapoints = models.ToleranceFactor.objects.filter(data_source=data_source, space_group=space_group)
-        if datapoints:  
-            response['data'].append({})
-            dataset = response['data'][-1]
-            dataset['space-group'] = space_group.name
-            dataset['compounds'] = list(datapoints.values_list('compound__formula', 'compound__pk'))
-            dataset['values'] = []
-            for datapoint in datapoints:
-                dataset['values'].append({
-                    'x': '%.4f' % datapoint.t_I if datapoint.t_I else None, 
-                    'y': '%.4f' % datapoint.t_IV_V if datapoint.t_IV_V else None,
-                })
+    """Return the tolerance factors of a data source for the chart.
 
-    return JsonResponse(response)
+    compound_pk 0 selects all compounds. The optional query parameters
+    "x_min", "x_max", "y_min", and "y_max" give the viewport, "bins"
+    the approximate number of histogram bins along each axis, and
+    "max_points" the number of tolerance factors above which they are
+    binned (see tolerance_chart.py).
+
+    """
+    try:
+        bins = min(int(request.GET.get('bins', tolerance_chart.DEFAULT_BINS)),
+                   settings.TF_MAX_BINS)
+        max_points = min(int(request.GET.get('max_points',
+                                             settings.TF_MAX_POINTS)),
+                         settings.TF_MAX_POINTS)
+        viewport = None
+        if 'x_min' in request.GET:
+            viewport = tolerance_chart.Viewport(
+                *(float(request.GET[key])
+                  for key in ('x_min', 'x_max', 'y_min', 'y_max')),
+                max(bins, 1))
+    except KeyError:
+        return JsonResponse(
+            {'error': 'Give all of x_min, x_max, y_min, and y_max.'},
+            status=400)
+    except (OverflowError, ValueError) as error:
+        return JsonResponse({'error': str(error)}, status=400)
+    return JsonResponse({
+        'data-source': data_source,
+        **tolerance_chart.get_data(data_source, compound_pk, viewport,
+                                   max_points),
+    })
 
 
 # def get_subset_values(request, pk):